@@ -47,3 +47,9 @@ ZULIP_API_PATH: Optional[str] = None
 
 # Set this to your Zulip server's API URI
 ZULIP_SITE = "https://zulip.example.com"
+
+# Set this to the socket of a running zulip-send-daemon to hand it the
+# notices, rather than connecting to the server on every push; the
+# daemon sends them as its own user.  If it isn't running, notices are
+# sent directly.
+ZULIP_SEND_SOCKET: Optional[str] = None
@@ -6,11 +6,13 @@
 # `hg push`). See https://zulip.com/integrations for installation instructions.
 
 import sys
+from typing import Optional
 
 from mercurial import repository as repo
 from mercurial import ui
 
 import zulip
+from zulip import send_daemon
 
 VERSION = "0.9"
 
@@ -64,15 +66,24 @@ def format_commit_lines(web_url: str, repo: repo, base: int, tip: int) -> str:
 
 
 def send_zulip(
-    email: str, api_key: str, site: str, stream: str, subject: str, content: str
+    email: str,
+    api_key: str,
+    site: str,
+    stream: str,
+    subject: str,
+    content: str,
+    send_socket: Optional[str] = None,
 ) -> None:
     """
     Send a message to Zulip using the provided credentials, which should be for
-    a bot in most cases.
+    a bot in most cases.  If `send_socket` is given, the message is handed to
+    the zulip-send-daemon listening on it instead, if it is running.
     """
-    client = zulip.Client(
-        email=email, api_key=api_key, site=site, client="ZulipMercurial/" + VERSION
-    )
+
+    def get_client() -> zulip.Client:
+        return zulip.Client(
+            email=email, api_key=api_key, site=site, client="ZulipMercurial/" + VERSION
+        )
 
     message_data = {
         "type": "stream",
@@ -81,7 +92,10 @@ def send_zulip(
         "content": content,
     }
 
-    client.send_message(message_data)
+    if send_socket:
+        send_daemon.send_message(message_data, get_client, send_socket)
+    else:
+        get_client().send_message(message_data)
 
 
 def get_config(ui: ui, item: str) -> str:
@@ -155,4 +169,5 @@ def hook(ui: ui, repo: repo, **kwargs: str) -> None:
     ui.debug("Sending to Zulip:\n")
     ui.debug(content + "\n")
 
-    send_zulip(email, api_key, site, stream, subject, content)
+    send_socket = get_config(ui, "send_socket")
+    send_zulip(email, api_key, site, stream, subject, content, send_socket)
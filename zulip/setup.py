@@ -58,6 +58,7 @@ setup(
     entry_points={
         "console_scripts": [
             "zulip-send=zulip.send:main",
+            "zulip-send-daemon=zulip.send_daemon:main",
             "zulip-api-examples=zulip.api_examples:main",
             "zulip-matrix-bridge=integrations.bridge_with_matrix.matrix_bridge:main",
             "zulip-api=zulip.cli:cli",
@@ -69,5 +70,9 @@ setup(
         "click",
         "typing_extensions>=4.5.0",
     ],
+    extras_require={
+        "async": ["aiohttp"],
+        "http2": ["httpx[http2]"],
+    },
     packages=find_packages(exclude=["tests"]),
 )
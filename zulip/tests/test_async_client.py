@@ -0,0 +1,303 @@
+import asyncio
+import json
+import os
+import tempfile
+from typing import Any, Dict, List, Tuple
+from unittest import IsolatedAsyncioTestCase
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from typing_extensions import override
+
+from zulip import RequestRecord
+from zulip.async_client import AsyncClient
+
+
+class TestAsyncClient(IsolatedAsyncioTestCase):
+    @override
+    async def asyncSetUp(self) -> None:
+        self.requests: List[Dict[str, Any]] = []
+        self.events: List[Dict[str, Any]] = [
+            {"id": 0, "type": "heartbeat"},
+            {"id": 1, "type": "message", "message": {"id": 11, "content": "hello"}},
+        ]
+
+        async def server_settings(request: web.Request) -> web.Response:
+            return web.json_response(
+                {"result": "success", "zulip_version": "8.0", "zulip_feature_level": 185}
+            )
+
+        async def send_message(request: web.Request) -> web.Response:
+            data = {key: str(value) for key, value in (await request.post()).items()}
+            self.requests.append(data)
+            return web.json_response({"result": "success", "msg": "", "id": int(data["id"])})
+
+        async def register(request: web.Request) -> web.Response:
+            return web.json_response({"result": "success", "queue_id": "q:1", "last_event_id": -1})
+
+        async def get_events(request: web.Request) -> web.Response:
+            last_event_id = int(request.query["last_event_id"])
+            events = [event for event in self.events if event["id"] > last_event_id]
+            if not events:
+                await asyncio.sleep(10)
+            return web.json_response({"result": "success", "events": events})
+
+        async def get_messages(request: web.Request) -> web.Response:
+            query = request.query
+            self.requests.append(dict(query))
+            anchor = {"newest": 25, "oldest": 1}.get(query["anchor"]) or int(query["anchor"])
+            first = anchor - int(query["num_before"])
+            last = anchor + int(query["num_after"])
+            ids = [i for i in range(1, 26) if first <= i <= last]
+            if query.get("include_anchor") == "false":
+                ids.remove(anchor)
+            return web.json_response(
+                {
+                    "result": "success",
+                    "messages": [{"id": i, "content": "hi"} for i in ids],
+                    "found_oldest": first <= 1,
+                    "found_newest": last >= 25,
+                }
+            )
+
+        async def upload_file(request: web.Request) -> web.Response:
+            data = await request.post()
+            (upload,) = data.values()
+            assert isinstance(upload, web.FileField)
+            size = len(upload.file.read())
+            return web.json_response(
+                {"result": "success", "uri": f"/user_uploads/{upload.filename}", "size": size}
+            )
+
+        async def update_message_flags(request: web.Request) -> web.Response:
+            data = await request.post()
+            messages = json.loads(str(data["messages"]))
+            self.requests.append({"messages": messages})
+            return web.json_response({"result": "success", "messages": messages})
+
+        app = web.Application()
+        app.router.add_get("/api/v1/server_settings", server_settings)
+        app.router.add_post("/api/v1/messages", send_message)
+        app.router.add_get("/api/v1/messages", get_messages)
+        app.router.add_post("/api/v1/register", register)
+        app.router.add_get("/api/v1/events", get_events)
+        app.router.add_post("/api/v1/user_uploads", upload_file)
+        app.router.add_post("/api/v1/messages/flags", update_message_flags)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.site = str(self.server.make_url(""))
+
+    @override
+    async def asyncTearDown(self) -> None:
+        await self.server.close()
+
+    async def test_send_message(self) -> None:
+        async with AsyncClient(email="bot@example.com", api_key="key", site=self.site) as client:
+            self.assertEqual(client.feature_level, 185)
+            result = await client.send_message(
+                {"type": "stream", "to": ["devel"], "topic": "test", "content": "hi", "id": 42}
+            )
+        self.assertEqual(result["id"], 42)
+        self.assertEqual(
+            self.requests,
+            [{"type": "stream", "to": '["devel"]', "topic": "test", "content": "hi", "id": "42"}],
+        )
+
+    async def test_send_compressed_message(self) -> None:
+        content = "All work and no play makes Jack a dull boy. " * 100
+        async with AsyncClient(
+            email="bot@example.com", api_key="key", site=self.site, compress_requests=True
+        ) as client:
+            records: List[RequestRecord] = []
+            client.request_hooks.append(records.append)
+            result = await client.send_message(
+                {"type": "stream", "to": "devel", "topic": "test", "content": content, "id": 1}
+            )
+        self.assertEqual(result["id"], 1)
+        self.assertEqual(self.requests[0]["content"], content)
+        self.assertLess(records[0].bytes_sent, len(content) / 2)
+
+    async def test_compressed_message_rejected_as_bad_request(self) -> None:
+        encodings: List[str] = []
+
+        # A server that doesn't decode compressed bodies.
+        async def send_message(request: web.Request) -> web.Response:
+            encodings.append(request.headers.get("Content-Encoding", ""))
+            if request.headers.get("Content-Encoding"):
+                return web.json_response({"result": "error", "msg": "Bad request"}, status=400)
+            return web.json_response({"result": "success", "id": 1})
+
+        async def server_settings(request: web.Request) -> web.Response:
+            return web.json_response({"result": "success", "zulip_version": "8.0"})
+
+        app = web.Application()
+        app.router.add_get("/api/v1/server_settings", server_settings)
+        app.router.add_post("/api/v1/messages", send_message)
+        server = TestServer(app)
+        await server.start_server()
+        self.addAsyncCleanup(server.close)
+        content = "All work and no play makes Jack a dull boy. " * 100
+        async with AsyncClient(
+            email="bot@example.com",
+            api_key="key",
+            site=str(server.make_url("")),
+            compress_requests=True,
+        ) as client:
+            with self.assertLogs("zulip", "WARNING"):
+                result = await client.send_message(
+                    {"type": "stream", "to": "devel", "topic": "test", "content": content}
+                )
+            await client.send_message(
+                {"type": "stream", "to": "devel", "topic": "test", "content": content}
+            )
+        self.assertEqual(result["result"], "success")
+        self.assertEqual(encodings, ["gzip", "", ""])
+        self.assertFalse(client.compress_requests)
+
+    async def test_mark_messages_as_read(self) -> None:
+        async with AsyncClient(email="bot@example.com", api_key="key", site=self.site) as client:
+            result = await client.mark_messages_as_read(range(3000), max_in_flight=2)
+        self.assertEqual(result["result"], "success")
+        self.assertEqual(result["messages"], list(range(3000)))
+        self.assertEqual(result["requests"], len(self.requests))
+        self.assertEqual(self.requests[0]["messages"], list(range(1000)))
+
+    async def test_send_messages(self) -> None:
+        messages = [
+            {"type": "private", "to": [f"user{i % 3}@example.com"], "content": "hi", "id": i}
+            for i in range(20)
+        ]
+        async with AsyncClient(email="bot@example.com", api_key="key", site=self.site) as client:
+            results = [result async for result in client.send_messages(messages, max_in_flight=4)]
+        self.assertEqual([result["id"] for result in results], list(range(20)))
+        for recipient in range(3):
+            self.assertEqual(
+                [
+                    int(r["id"])
+                    for r in self.requests
+                    if r["to"] == f'["user{recipient}@example.com"]'
+                ],
+                list(range(recipient, 20, 3)),
+            )
+
+    async def test_call_on_each_message(self) -> None:
+        received: List[Dict[str, Any]] = []
+        done = asyncio.Event()
+
+        async def callback(message: Dict[str, Any]) -> None:
+            received.append(message)
+            done.set()
+
+        async with AsyncClient(email="bot@example.com", api_key="key", site=self.site) as client:
+            task = asyncio.create_task(client.call_on_each_message(callback))
+            await asyncio.wait_for(done.wait(), timeout=5)
+            task.cancel()
+        self.assertEqual(received, [{"id": 11, "content": "hello"}])
+
+    async def test_iter_messages(self) -> None:
+        async with AsyncClient(email="bot@example.com", api_key="key", site=self.site) as client:
+            messages = [message async for message in client.iter_messages(batch_size=5)]
+        self.assertEqual([message["id"] for message in messages], list(range(20, 26)))
+        self.assertEqual(self.requests, [{"anchor": "newest", "num_before": "5", "num_after": "0"}])
+
+    async def test_iter_messages_rate_limited(self) -> None:
+        statuses: List[int] = []
+
+        # Rate-limits the first request.
+        async def get_messages(request: web.Request) -> web.Response:
+            statuses.append(429 if not statuses else 200)
+            if statuses[-1] == 429:
+                return web.json_response(
+                    {"result": "error", "code": "RATE_LIMIT_HIT", "retry-after": 0.01},
+                    status=429,
+                )
+            return web.json_response({"result": "success", "messages": [{"id": 1}]})
+
+        async def server_settings(request: web.Request) -> web.Response:
+            return web.json_response({"result": "success", "zulip_version": "8.0"})
+
+        app = web.Application()
+        app.router.add_get("/api/v1/server_settings", server_settings)
+        app.router.add_get("/api/v1/messages", get_messages)
+        server = TestServer(app)
+        await server.start_server()
+        self.addAsyncCleanup(server.close)
+        records: List[RequestRecord] = []
+        client = AsyncClient(email="bot@example.com", api_key="key", site=str(server.make_url("")))
+        client.request_hooks.append(records.append)
+        async with client:
+            messages = [message async for message in client.iter_messages()]
+        self.assertEqual(messages, [{"id": 1}])
+        self.assertEqual(statuses, [429, 200])
+        self.assertEqual(
+            [(record.endpoint, record.status, record.retries) for record in records],
+            [("server_settings", 200, 0), ("messages", 200, 1)],
+        )
+
+    async def test_iter_history(self) -> None:
+        async with AsyncClient(email="bot@example.com", api_key="key", site=self.site) as client:
+            messages = [
+                message async for message in client.iter_history(direction="newer", page_size=10)
+            ]
+        self.assertEqual([message["id"] for message in messages], list(range(1, 26)))
+        self.assertEqual(
+            [(r["anchor"], r.get("include_anchor")) for r in self.requests],
+            [("oldest", None), ("11", "false"), ("21", "false")],
+        )
+
+    async def test_upload_files(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [os.path.join(directory, "big.bin"), os.path.join(directory, "missing.bin")]
+            with open(paths[0], "wb") as f:
+                f.write(b"x" * 200_000)
+            progress: List[Tuple[int, int]] = []
+            async with AsyncClient(
+                email="bot@example.com", api_key="key", site=self.site
+            ) as client:
+                results = await client.upload_files(
+                    paths,
+                    progress_callback=lambda path, sent, total: progress.append((sent, total)),
+                )
+        self.assertEqual(results[0]["uri"], "/user_uploads/big.bin")
+        self.assertEqual(results[0]["size"], 200_000)
+        self.assertEqual(results[1]["result"], "error")
+        self.assertGreater(len(progress), 1)
+        self.assertEqual(progress[-1][0], progress[-1][1])
+
+    async def test_request_hooks(self) -> None:
+        records: List[RequestRecord] = []
+        client = AsyncClient(email="bot@example.com", api_key="key", site=self.site)
+        client.request_hooks.append(records.append)
+        async with client:
+            await client.send_message({"type": "stream", "to": "devel", "id": 7})
+        self.assertEqual(
+            [(record.method, record.endpoint) for record in records],
+            [("GET", "server_settings"), ("POST", "messages")],
+        )
+        self.assertEqual([record.status for record in records], [200, 200])
+        self.assertGreater(records[1].bytes_sent, 0)
+        self.assertGreater(records[1].bytes_received or 0, 0)
+        # The connection is opened once, and then kept alive.
+        self.assertGreater(records[0].connect_time, 0)
+        self.assertEqual(records[1].connect_time, 0)
+
+    async def test_call_on_each_event_batch(self) -> None:
+        batches: "asyncio.Queue[List[Dict[str, Any]]]" = asyncio.Queue()
+        progress: List[Tuple[str, int]] = []
+        async with AsyncClient(email="bot@example.com", api_key="key", site=self.site) as client:
+            task = asyncio.ensure_future(
+                client.call_on_each_event_batch(
+                    batches.put,
+                    max_batch=10,
+                    max_wait=0.1,
+                    event_types=["message"],
+                    progress_callback=lambda queue_id, last_event_id: progress.append(
+                        (queue_id, last_event_id)
+                    ),
+                )
+            )
+            batch = await asyncio.wait_for(batches.get(), 5)
+            await asyncio.sleep(0)
+            task.cancel()
+        self.assertEqual(batch, [self.events[1]])
+        self.assertEqual(progress, [("q:1", 1)])
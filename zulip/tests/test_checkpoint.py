@@ -0,0 +1,130 @@
+import os
+import tempfile
+from typing import Any, Dict, List
+from unittest import TestCase
+from unittest.mock import patch
+
+from typing_extensions import override
+
+from zulip.checkpoint import (
+    CheckpointedEventConsumer,
+    CheckpointStore,
+    FileCheckpointStore,
+    SQLiteCheckpointStore,
+)
+
+from .test_client import StopConsumerError, make_client
+
+
+def message_event(event_id: int, message_id: int) -> Dict[str, Any]:
+    return {"id": event_id, "type": "message", "message": {"id": message_id}, "flags": []}
+
+
+class MemoryCheckpointStore(CheckpointStore):
+    def __init__(self, checkpoint: Dict[str, Any]) -> None:
+        self.checkpoints = [checkpoint]
+
+    @override
+    def load(self) -> Dict[str, Any]:
+        return self.checkpoints[-1]
+
+    @override
+    def save(self, checkpoint: Dict[str, Any]) -> None:
+        self.checkpoints.append(checkpoint)
+
+
+class TestCheckpointStores(TestCase):
+    def test_stores(self) -> None:
+        checkpoint = {"queue_id": "q:1", "last_event_id": 7, "last_message_id": 42}
+        with tempfile.TemporaryDirectory() as directory:
+            file_store = FileCheckpointStore(os.path.join(directory, "checkpoint.json"))
+            sqlite_store = SQLiteCheckpointStore(os.path.join(directory, "checkpoints.db"))
+            for store in [file_store, sqlite_store]:
+                self.assertIsNone(store.load())
+                store.save(checkpoint)
+                store.save(dict(checkpoint, last_event_id=8))
+                self.assertEqual(store.load(), dict(checkpoint, last_event_id=8))
+
+            # Other consumers' checkpoints are kept apart.
+            other_store = SQLiteCheckpointStore(os.path.join(directory, "checkpoints.db"), "other")
+            self.assertIsNone(other_store.load())
+            sqlite_store.close()
+            other_store.close()
+            # The checkpoint file is written through a temporary one.
+            self.assertFalse([name for name in os.listdir(directory) if name.startswith(".")])
+
+
+class TestCheckpointedEventConsumer(TestCase):
+    def run_consumer(
+        self, store: CheckpointStore, responses: List[Any], history: List[Dict[str, Any]]
+    ) -> List[int]:
+        client = make_client()
+        handled: List[int] = []
+        responses = [*responses, StopConsumerError()]
+        with patch.object(
+            client,
+            "register",
+            return_value={"result": "success", "queue_id": "q:2", "last_event_id": -1},
+        ), patch.object(client, "get_events", side_effect=responses), patch.object(
+            client, "iter_history", return_value=iter(history)
+        ) as iter_history, patch("time.sleep"), self.assertRaises(StopConsumerError):
+            CheckpointedEventConsumer(client, store).call_on_each_message(
+                lambda message: handled.append(message["id"])
+            )
+        if history:
+            iter_history.assert_called_once_with([], direction="newer", start_anchor=10)
+        return handled
+
+    def test_resume_queue(self) -> None:
+        store = MemoryCheckpointStore(
+            {"queue_id": "q:1", "last_event_id": 5, "last_message_id": 10}
+        )
+        responses = [
+            {"result": "success", "events": [message_event(6, 11), message_event(7, 12)]},
+            {"result": "success", "events": [{"id": 8, "type": "heartbeat"}]},
+        ]
+        self.assertEqual(self.run_consumer(store, responses, []), [11, 12])
+        self.assertEqual(
+            store.checkpoints[1:],
+            [
+                {"queue_id": "q:1", "last_event_id": 7, "last_message_id": 12},
+                {"queue_id": "q:1", "last_event_id": 8, "last_message_id": 12},
+            ],
+        )
+
+    def test_backfill_after_losing_queue(self) -> None:
+        store = MemoryCheckpointStore(
+            {"queue_id": "q:1", "last_event_id": 5, "last_message_id": 10}
+        )
+        responses = [
+            {"result": "error", "code": "BAD_EVENT_QUEUE_ID", "msg": "Bad event queue id: q:1"},
+            # The new queue has the last message fetched too.
+            {"result": "success", "events": [message_event(0, 12), message_event(1, 13)]},
+        ]
+        history = [{"id": 10}, {"id": 11}, {"id": 12}]
+        self.assertEqual(self.run_consumer(store, responses, history), [11, 12, 13])
+        self.assertEqual(
+            store.checkpoints[1:],
+            [
+                {"queue_id": "q:2", "last_event_id": -1, "last_message_id": 12},
+                {"queue_id": "q:2", "last_event_id": 1, "last_message_id": 13},
+            ],
+        )
+
+    def test_first_run(self) -> None:
+        client = make_client()
+        with tempfile.TemporaryDirectory() as directory:
+            store = FileCheckpointStore(os.path.join(directory, "checkpoint.json"))
+            with patch.object(
+                client,
+                "register",
+                return_value={"result": "success", "queue_id": "q:1", "last_event_id": -1},
+            ), patch.object(client, "get_events", side_effect=StopConsumerError), patch.object(
+                client,
+                "get_messages",
+                return_value={"result": "success", "messages": [{"id": 99}]},
+            ), self.assertRaises(StopConsumerError):
+                CheckpointedEventConsumer(client, store).call_on_each_message(lambda message: None)
+            self.assertEqual(
+                store.load(), {"queue_id": "q:1", "last_event_id": -1, "last_message_id": 99}
+            )
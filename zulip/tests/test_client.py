@@ -0,0 +1,906 @@
+import email.parser
+import email.policy
+import gzip
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import urllib.parse
+from typing import Any, Callable, Dict, List, Tuple, Union
+from unittest import TestCase
+from unittest.mock import patch
+
+import requests
+from typing_extensions import Literal
+
+import zulip
+import zulip.connections
+from zulip import StreamingArrayDecoder, ZulipError, message_recipient_key
+
+SERVER_SETTINGS = {"result": "success", "zulip_version": "8.0", "zulip_feature_level": 185}
+
+
+def make_client(**kwargs: Any) -> zulip.Client:
+    kwargs.setdefault("email", "bot@example.com")
+    kwargs.setdefault("api_key", "key")
+    kwargs.setdefault("site", "https://zulip.example.com")
+    with patch.object(zulip.Client, "get_server_settings", return_value=SERVER_SETTINGS):
+        return zulip.Client(**kwargs)
+
+
+class TestConnectionPool(TestCase):
+    def test_defaults(self) -> None:
+        client = make_client()
+        client.ensure_session()
+        assert isinstance(client.session, requests.Session)
+        adapter = client.session.get_adapter("https://zulip.example.com/api/")
+        assert isinstance(adapter, requests.adapters.HTTPAdapter)
+        pool_kw = adapter.poolmanager.connection_pool_kw
+        self.assertEqual(pool_kw["maxsize"], requests.adapters.DEFAULT_POOLSIZE)
+        self.assertEqual(pool_kw["block"], False)
+
+    def test_constructor_arguments(self) -> None:
+        client = make_client(pool_connections=2, pool_maxsize=64, pool_block=True)
+        with patch.object(
+            zulip.connections, "TimedHTTPAdapter", wraps=zulip.connections.TimedHTTPAdapter
+        ) as adapter_class:
+            client.ensure_session()
+        adapter_class.assert_called_once_with(pool_connections=2, pool_maxsize=64, pool_block=True)
+        assert isinstance(client.session, requests.Session)
+        self.assertIs(
+            client.session.get_adapter("https://zulip.example.com/api/"),
+            client.session.get_adapter("http://localhost:9991/api/"),
+        )
+
+    def test_zuliprc(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config_file = os.path.join(tmpdir, "zuliprc")
+            with open(config_file, "w") as f:
+                f.write(
+                    "[api]\nkey=key\nemail=bot@example.com\nsite=https://zulip.example.com\n"
+                    "pool_maxsize=32\npool_block=true\n"
+                )
+            client = make_client(config_file=config_file, email=None, api_key=None, site=None)
+            self.assertEqual(client.pool_maxsize, 32)
+            self.assertEqual(client.pool_block, True)
+
+            # Constructor arguments take precedence over the config file.
+            client = make_client(config_file=config_file, pool_maxsize=4)
+            self.assertEqual(client.pool_maxsize, 4)
+
+            with open(config_file, "a") as f:
+                f.write("pool_connections=many\n")
+            with self.assertRaisesRegex(ZulipError, "pool_connections is set to 'many'"):
+                make_client(config_file=config_file)
+
+    def test_session_created_once_across_threads(self) -> None:
+        client = make_client()
+        sessions: List[object] = []
+        barrier = threading.Barrier(8)
+
+        def worker() -> None:
+            barrier.wait()
+            client.ensure_session()
+            assert client.session is not None
+            sessions.append(client.session)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len({id(session) for session in sessions}), 1)
+
+
+class TestSendMessages(TestCase):
+    def test_results_in_order_and_per_recipient_ordering(self) -> None:
+        client = make_client()
+        sent: List[str] = []
+        lock = threading.Lock()
+
+        def send_message(message: Dict[str, Any]) -> Dict[str, Any]:
+            # Make earlier messages slower, so that any reordering shows.
+            time.sleep(0.01 * (10 - int(message["content"])))
+            if message["content"] == "3":
+                raise requests.exceptions.ConnectionError("connection reset")
+            with lock:
+                sent.append(message["content"])
+            return {"result": "success", "id": int(message["content"])}
+
+        messages = [
+            {
+                "type": "stream",
+                "to": "devel" if i % 2 else "social",
+                "topic": "t",
+                "content": str(i),
+            }
+            for i in range(10)
+        ]
+        with patch.object(client, "send_message", side_effect=send_message):
+            results = list(client.send_messages(messages, max_in_flight=4))
+
+        self.assertEqual([result.get("id") for result in results], [0, 1, 2, None, *range(4, 10)])
+        self.assertEqual(results[3]["result"], "error")
+        self.assertIn("connection reset", results[3]["msg"])
+        self.assertEqual([c for c in sent if int(c) % 2], ["1", "5", "7", "9"])
+        self.assertEqual([c for c in sent if not int(c) % 2], ["0", "2", "4", "6", "8"])
+
+    def test_message_recipient_key(self) -> None:
+        self.assertEqual(
+            message_recipient_key({"type": "stream", "to": "devel", "topic": "a"}),
+            message_recipient_key({"type": "stream", "to": ["devel"], "subject": "a"}),
+        )
+        self.assertNotEqual(
+            message_recipient_key({"type": "stream", "to": "devel", "topic": "a"}),
+            message_recipient_key({"type": "stream", "to": "devel", "topic": "b"}),
+        )
+        self.assertEqual(
+            message_recipient_key({"type": "private", "to": ["a@example.com", "b@example.com"]}),
+            message_recipient_key({"type": "private", "to": "b@example.com,a@example.com"}),
+        )
+
+
+def message_event(event_id: int) -> Dict[str, Any]:
+    return {"id": event_id, "type": "message", "message": {"id": event_id}}
+
+
+class StopConsumerError(BaseException):
+    # Not an Exception, so that call_on_each_event doesn't retry it.
+    pass
+
+
+class TestCallOnEachEvent(TestCase):
+    def run_consumer(
+        self, client: zulip.Client, **kwargs: Any
+    ) -> Tuple[List[Dict[str, Any]], List[Tuple[str, int]]]:
+        events: List[Dict[str, Any]] = []
+        progress: List[Tuple[str, int]] = []
+
+        def progress_callback(queue_id: str, last_event_id: int) -> None:
+            progress.append((queue_id, last_event_id))
+            if len(progress) == 2:
+                raise StopConsumerError
+
+        with self.assertRaises(StopConsumerError):
+            client.call_on_each_event(
+                events.append, ["message"], progress_callback=progress_callback, **kwargs
+            )
+        return events, progress
+
+    def test_resume_existing_queue(self) -> None:
+        client = make_client()
+        responses = [
+            {"result": "success", "events": [{"id": 8, "type": "message"}]},
+            {"result": "success", "events": [{"id": 9, "type": "heartbeat"}]},
+        ]
+        with patch.object(client, "register") as register, patch.object(
+            client, "get_events", side_effect=responses
+        ) as get_events:
+            events, progress = self.run_consumer(client, queue_id="q:1", last_event_id=7)
+        register.assert_not_called()
+        get_events.assert_any_call(queue_id="q:1", last_event_id=7)
+        get_events.assert_called_with(queue_id="q:1", last_event_id=8)
+        self.assertEqual(events, [{"id": 8, "type": "message"}])
+        self.assertEqual(progress, [("q:1", 8), ("q:1", 9)])
+
+    def test_backoff_and_reregister(self) -> None:
+        client = make_client()
+        responses: List[Any] = [
+            requests.exceptions.ConnectionError(),
+            {"result": "error", "code": "BAD_EVENT_QUEUE_ID", "msg": "Bad event queue id: q:1"},
+            {"result": "success", "events": [{"id": 0, "type": "message"}]},
+            {"result": "success", "events": [{"id": 1, "type": "message"}]},
+        ]
+        with patch.object(
+            client,
+            "register",
+            return_value={"result": "success", "queue_id": "q:2", "last_event_id": -1},
+        ), patch.object(client, "get_events", side_effect=responses) as get_events, patch(
+            "time.sleep"
+        ) as sleep:
+            events, progress = self.run_consumer(
+                client, queue_id="q:1", last_event_id=5, max_backoff=1.5
+            )
+        self.assertEqual(
+            [call.kwargs for call in get_events.call_args_list],
+            [
+                dict(queue_id="q:1", last_event_id=5),
+                dict(queue_id="q:1", last_event_id=5, dont_block=True),
+                dict(queue_id="q:2", last_event_id=-1, dont_block=True),
+                dict(queue_id="q:2", last_event_id=0),
+            ],
+        )
+        self.assertEqual(len(sleep.call_args_list), 2)
+        for call in sleep.call_args_list:
+            self.assertLessEqual(call.args[0], 1.5)
+        self.assertEqual(progress, [("q:2", 0), ("q:2", 1)])
+
+
+class TestCallOnEachEventBatch(TestCase):
+    def test_batches(self) -> None:
+        client = make_client()
+        responses = iter(
+            [
+                {"result": "success", "events": [message_event(0), message_event(1)]},
+                {"result": "success", "events": [{"id": 2, "type": "heartbeat"}, message_event(3)]},
+                {"result": "success", "events": [message_event(4)]},
+            ]
+        )
+        done = threading.Event()
+
+        def get_events(**request: Any) -> Dict[str, Any]:
+            response = next(responses, None)
+            if response is None:
+                done.wait(5)
+                return {"result": "success", "events": []}
+            return response
+
+        batches: List[Tuple[List[int], float]] = []
+        progress: List[Tuple[str, int]] = []
+
+        def callback(events: List[Dict[str, Any]]) -> None:
+            batches.append(([event["id"] for event in events], time.monotonic()))
+            if len(batches) == 2:
+                raise StopConsumerError
+
+        started = time.monotonic()
+        with patch.object(client, "get_events", side_effect=get_events), self.assertRaises(
+            StopConsumerError
+        ):
+            client.call_on_each_event_batch(
+                callback,
+                max_batch=3,
+                max_wait=0.2,
+                event_types=["message"],
+                queue_id="q:1",
+                last_event_id=-1,
+                progress_callback=lambda queue_id, last_event_id: progress.append(
+                    (queue_id, last_event_id)
+                ),
+            )
+        done.set()
+
+        self.assertEqual([ids for ids, _ in batches], [[0, 1, 3], [4]])
+        # The first batch is full; the second waits for more events.
+        self.assertLess(batches[0][1] - started, 0.2)
+        self.assertGreaterEqual(batches[1][1] - batches[0][1], 0.2)
+        self.assertEqual(progress, [("q:1", 1), ("q:1", 3)])
+
+
+class TestEventWorkerPool(TestCase):
+    def test_ordering_and_progress(self) -> None:
+        handled: List[Tuple[int, int]] = []
+        progress: List[Tuple[str, int]] = []
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def callback(event: Dict[str, Any]) -> None:
+            # Sender 0 is slow; the other senders must not wait for it.
+            if event["sender"] == 0:
+                time.sleep(0.005)
+            with lock:
+                handled.append((event["sender"], event["id"]))
+
+        def progress_callback(queue_id: str, last_event_id: int) -> None:
+            progress.append((queue_id, last_event_id))
+            if last_event_id == 59:
+                done.set()
+
+        pool = zulip.EventWorkerPool(
+            callback,
+            num_workers=4,
+            max_buffered_events=8,
+            ordering_key=lambda event: event["sender"],
+            progress_callback=progress_callback,
+        )
+        for batch_start in range(0, 60, 10):
+            events = [{"id": i, "sender": i % 3} for i in range(batch_start, batch_start + 10)]
+            pool.submit("q:1", batch_start + 9, events)
+        pool.submit("q:1", 59, [])
+        self.assertTrue(done.wait(timeout=5))
+
+        self.assertEqual(len(handled), 60)
+        for sender in range(3):
+            ids = [event_id for s, event_id in handled if s == sender]
+            self.assertEqual(ids, sorted(ids))
+        self.assertEqual(
+            [event_id for _, event_id in progress], sorted(event_id for _, event_id in progress)
+        )
+        self.assertEqual(progress[-1], ("q:1", 59))
+
+    def test_close(self) -> None:
+        handled: List[int] = []
+
+        def callback(event: Dict[str, Any]) -> None:
+            time.sleep(0.01)
+            handled.append(event["id"])
+
+        with zulip.EventWorkerPool(
+            callback,
+            num_workers=2,
+            ordering_key=lambda event: event.get("message", {}).get("sender_id"),
+        ) as pool:
+            pool.submit(
+                "q:1",
+                2,
+                [
+                    {"id": 0, "type": "message", "message": {"sender_id": 1}},
+                    {"id": 1, "type": "heartbeat"},
+                    {"id": 2, "type": "message", "message": {"sender_id": 2}},
+                ],
+            )
+        # Closing waits for the submitted events to be handled.
+        self.assertEqual(sorted(handled), [0, 1, 2])
+        self.assertEqual(pool.workers, [])
+
+    def test_callback_exits(self) -> None:
+        handled: List[int] = []
+
+        def callback(event: Dict[str, Any]) -> None:
+            if event["id"] == 0:
+                raise SystemExit(1)
+            handled.append(event["id"])
+
+        pool = zulip.EventWorkerPool(callback, num_workers=1, max_buffered_events=2)
+        # The queue stays full of events nobody handles, but submit()
+        # raises the exit instead of blocking.
+        with self.assertRaises(SystemExit):
+            for event_id in range(100):
+                pool.submit("q:1", event_id, [{"id": event_id}])
+        with self.assertRaises(SystemExit):
+            pool.close()
+        self.assertEqual(handled, [])
+        self.assertEqual(pool.workers, [])
+
+    def test_call_on_each_event_with_workers(self) -> None:
+        client = make_client()
+        handled: List[int] = []
+        finished = threading.Event()
+
+        def callback(event: Dict[str, Any]) -> None:
+            handled.append(event["id"])
+
+        def progress_callback(queue_id: str, last_event_id: int) -> None:
+            if last_event_id == 2:
+                finished.set()
+
+        responses: List[Any] = [
+            {
+                "result": "success",
+                "events": [{"id": 0, "type": "message"}, {"id": 1, "type": "message"}],
+            },
+            {"result": "success", "events": [{"id": 2, "type": "heartbeat"}]},
+        ]
+
+        def get_events(**request: Any) -> Dict[str, Any]:
+            if responses:
+                return responses.pop(0)
+            self.assertTrue(finished.wait(timeout=5))
+            raise StopConsumerError
+
+        with patch.object(client, "get_events", side_effect=get_events), self.assertRaises(
+            StopConsumerError
+        ):
+            client.call_on_each_event(
+                callback,
+                queue_id="q:1",
+                num_workers=2,
+                progress_callback=progress_callback,
+            )
+        self.assertEqual(sorted(handled), [0, 1])
+        # The workers were stopped when the consumer stopped.
+        self.assertFalse(
+            any(thread.name.startswith("zulip-event-worker") for thread in threading.enumerate())
+        )
+
+
+MESSAGES_RESPONSE: Dict[str, Any] = {
+    "result": "success",
+    "msg": "",
+    "found_oldest": True,
+    "messages": [
+        {"id": i, "content": 'a "[quoted]" {x},\\ \u00e9 ' * i, "flags": ["read"]}
+        for i in range(30)
+    ],
+    "anchor": 29,
+}
+
+
+class TestIterMessages(TestCase):
+    def test_decoder(self) -> None:
+        for ensure_ascii in [True, False]:
+            body = json.dumps(MESSAGES_RESPONSE, ensure_ascii=ensure_ascii).encode()
+            loads_functions: List[Callable[[Union[bytes, str]], Any]] = [
+                json.loads,
+                zulip.fast_json_loads(),
+            ]
+            for loads in loads_functions:
+                decoder = StreamingArrayDecoder("messages", loads=loads)
+                messages = []
+                pos = 0
+                while pos < len(body):
+                    size = 1 + pos * 7 % 50
+                    messages += decoder.feed(body[pos : pos + size])
+                    pos += size
+                self.assertEqual(messages, MESSAGES_RESPONSE["messages"])
+                self.assertEqual(decoder.close(), {**MESSAGES_RESPONSE, "messages": []})
+
+        decoder = StreamingArrayDecoder("messages")
+        decoder.feed(b'{"result": "success", "messages": [{"id": 1}')
+        with self.assertRaises(ValueError):
+            decoder.close()
+
+    def make_response(self, body: Dict[str, Any]) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = io.BytesIO(json.dumps(body).encode())
+        return response
+
+    def test_iter_messages(self) -> None:
+        client = make_client()
+        with patch.object(
+            client, "do_api_request", return_value=self.make_response(MESSAGES_RESPONSE)
+        ) as do_api_request:
+            messages = client.iter_messages([{"operator": "stream", "operand": "devel"}], 30)
+            self.assertEqual(next(messages), MESSAGES_RESPONSE["messages"][0])
+            do_api_request.assert_called_once_with(
+                {
+                    "anchor": "newest",
+                    "num_before": 30,
+                    "num_after": 0,
+                    "narrow": [{"operator": "stream", "operand": "devel"}],
+                },
+                "v1/messages",
+                method="GET",
+                stream=True,
+            )
+            self.assertEqual(list(messages), MESSAGES_RESPONSE["messages"][1:])
+
+        error = {"result": "error", "msg": "Invalid narrow operator: unknown"}
+        with patch.object(
+            client, "do_api_request", return_value=self.make_response(error)
+        ), self.assertRaisesRegex(ZulipError, "Invalid narrow operator"):
+            list(client.iter_messages())
+
+
+class TestIterHistory(TestCase):
+    def get_messages(self, request: Dict[str, Any], *args: Any, **kwargs: Any) -> requests.Response:
+        self.requests.append(request)
+        ids = list(range(1, 26))
+        anchor = {"newest": 25, "oldest": 1}.get(request["anchor"], request["anchor"])
+        before = [i for i in ids if i < anchor][-request["num_before"] :][: request["num_before"]]
+        after = [i for i in ids if i > anchor][: request["num_after"]]
+        # Like servers older than feature level 155, always include the anchor.
+        page = [*before, anchor, *after]
+        body = {
+            "result": "success",
+            "messages": [{"id": i} for i in page],
+            "found_oldest": page[0] == 1,
+            "found_newest": page[-1] == 25,
+        }
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = io.BytesIO(json.dumps(body).encode())
+        return response
+
+    def test_directions(self) -> None:
+        client = make_client()
+        directions: List[Tuple[Literal["older", "newer"], range]] = [
+            ("older", range(25, 0, -1)),
+            ("newer", range(1, 26)),
+        ]
+        for direction, expected in directions:
+            self.requests: List[Dict[str, Any]] = []
+            with patch.object(client, "do_api_request", side_effect=self.get_messages):
+                messages = list(client.iter_history(direction=direction, page_size=10))
+            self.assertEqual([message["id"] for message in messages], list(expected))
+            self.assertEqual(len(self.requests), 3)
+            self.assertNotIn("include_anchor", self.requests[0])
+            self.assertEqual(self.requests[1]["include_anchor"], False)
+
+        self.requests = []
+        client.feature_level = 154
+        with patch.object(client, "do_api_request", side_effect=self.get_messages):
+            messages = list(client.iter_history(page_size=10, start_anchor=12))
+        self.assertEqual([message["id"] for message in messages], list(range(12, 0, -1)))
+        self.assertEqual([request["anchor"] for request in self.requests], [12, 2])
+        self.assertNotIn("include_anchor", self.requests[1])
+
+    def test_error(self) -> None:
+        client = make_client()
+        with patch.object(
+            client, "do_api_request", side_effect=requests.exceptions.ConnectionError()
+        ), self.assertRaises(requests.exceptions.ConnectionError):
+            list(client.iter_history())
+
+
+class TestResponseCache(TestCase):
+    def test_cache(self) -> None:
+        client = make_client(cache_ttl=60, cache_maxsize=2)
+        with patch.object(
+            client, "do_api_query", return_value={"result": "success", "stream_id": 5}
+        ) as do_api_query:
+            self.assertEqual(client.get_stream_id("devel")["stream_id"], 5)
+            self.assertEqual(client.get_stream_id("devel")["stream_id"], 5)
+            self.assertEqual(do_api_query.call_count, 1)
+
+            # Responses are cached per request, and the least recently
+            # used ones are evicted.
+            client.get_user_by_id(8)
+            client.get_user_by_id(8, include_custom_profile_fields=True)
+            self.assertEqual(do_api_query.call_count, 3)
+            client.get_stream_id("devel")
+            self.assertEqual(do_api_query.call_count, 4)
+
+            # Writes and events invalidate what they may change.
+            client.get_subscriptions()
+            client.add_subscriptions([{"name": "new"}])
+            client.get_subscriptions()
+            self.assertEqual(do_api_query.call_count, 7)
+            client.invalidate_cache_for_event({"type": "subscription", "op": "peer_add"})
+            client.get_subscriptions()
+            self.assertEqual(do_api_query.call_count, 8)
+            client.invalidate_cache_for_event({"type": "message"})
+            client.get_subscriptions()
+            self.assertEqual(do_api_query.call_count, 8)
+
+            # Entries expire.
+            with patch("time.monotonic", return_value=time.monotonic() + 61):
+                client.get_subscriptions()
+            self.assertEqual(do_api_query.call_count, 9)
+
+            # Only GET requests to the cached endpoints are cached.
+            client.get_profile()
+            client.get_profile()
+            self.assertEqual(do_api_query.call_count, 11)
+
+        with patch.object(
+            client, "do_api_query", return_value={"result": "error", "msg": "Invalid stream"}
+        ) as do_api_query:
+            client.get_stream_id("missing")
+            client.get_stream_id("missing")
+            self.assertEqual(do_api_query.call_count, 2)
+
+    def test_responses_are_copied(self) -> None:
+        client = make_client(cache_ttl=60, cache_maxsize=2)
+        subscriptions = [{"name": "devel", "subscribers": [1, 2]}]
+        with patch.object(
+            client,
+            "do_api_query",
+            return_value={"result": "success", "subscriptions": subscriptions},
+        ):
+            # The first caller gets the fetched response itself.
+            client.get_subscriptions()["subscriptions"][0]["subscribers"].append(3)
+            client.get_subscriptions()["subscriptions"][0]["subscribers"].append(4)
+            client.get_subscriptions()["subscriptions"].clear()
+            self.assertEqual(
+                client.get_subscriptions()["subscriptions"],
+                [{"name": "devel", "subscribers": [1, 2]}],
+            )
+
+    def test_disabled_by_default(self) -> None:
+        client = make_client()
+        with patch.object(
+            client, "do_api_query", return_value={"result": "success", "stream_id": 5}
+        ) as do_api_query:
+            client.get_stream_id("devel")
+            client.get_stream_id("devel")
+        self.assertEqual(do_api_query.call_count, 2)
+
+
+class TestRateLimiter(TestCase):
+    def test_pacing(self) -> None:
+        limiter = zulip.RateLimiter()
+        with patch("time.time", return_value=1000.0):
+            self.assertEqual(limiter.reserve(), 0)
+            # 2 requests left, and 10 more come back over the next 5s.
+            limiter.update(
+                {
+                    "X-RateLimit-Limit": "12",
+                    "X-RateLimit-Remaining": "2",
+                    "X-RateLimit-Reset": "1005",
+                }
+            )
+            self.assertEqual([limiter.reserve() for _ in range(4)], [0, 0, 0.5, 1.0])
+            self.assertEqual(limiter.stats()["remaining"], 0)
+        with patch("time.time", return_value=1002.0):
+            self.assertEqual(limiter.stats()["remaining"], 2)
+
+            limiter.record_rate_limited(3)
+            self.assertEqual(limiter.reserve(), 3)
+        stats = limiter.stats()
+        self.assertEqual(stats["limit"], 12)
+        self.assertEqual(stats["delayed_requests"], 3)
+        self.assertEqual(stats["total_delay"], 4.5)
+        self.assertEqual(stats["rate_limited_responses"], 1)
+
+    def test_retry_rate_limited_requests(self) -> None:
+        client = make_client()
+        rate_limited = requests.Response()
+        rate_limited.status_code = 429
+        rate_limited.headers["Retry-After"] = "2"
+        rate_limited.raw = io.BytesIO(
+            b'{"result": "error", "code": "RATE_LIMIT_HIT", "retry-after": 0.5}'
+        )
+        success = requests.Response()
+        success.status_code = 200
+        success.raw = io.BytesIO(b'{"result": "success"}')
+        client.ensure_session()
+        with patch.object(
+            client.session, "request", side_effect=[rate_limited, success]
+        ) as request, patch("time.sleep") as sleep:
+            self.assertEqual(client.get_profile(), {"result": "success"})
+        self.assertEqual(request.call_count, 2)
+        sleep.assert_called_once()
+        self.assertAlmostEqual(sleep.call_args.args[0], 0.5, places=2)
+
+    def test_rate_limited_retries_are_bounded(self) -> None:
+        client = make_client()
+        client.ensure_session()
+        with patch.object(
+            client.session,
+            "request",
+            side_effect=lambda *args, **kwargs: json_response(
+                429, b'{"result": "error", "code": "RATE_LIMIT_HIT", "retry-after": 0.1}'
+            ),
+        ) as request, patch("time.sleep"):
+            self.assertEqual(client.get_profile()["code"], "RATE_LIMIT_HIT")
+        self.assertEqual(request.call_count, zulip.MAX_ERROR_RETRIES + 1)
+
+
+def json_response(status_code: int, content: bytes, **headers: str) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers)
+    response.raw = io.BytesIO(content)
+    return response
+
+
+FLAGS_REQUEST = {"messages": list(range(1000)), "op": "add", "flag": "read"}
+
+
+class TestRequestBodies(TestCase):
+    def test_encoded_once(self) -> None:
+        client = make_client()
+        client.ensure_session()
+        with patch.object(
+            client.session,
+            "request",
+            side_effect=[
+                json_response(502, b"Bad gateway"),
+                json_response(200, b'{"result": "success"}'),
+            ],
+        ) as request, patch("time.sleep"):
+            client.update_message_flags(FLAGS_REQUEST)
+        first, retry = (call.kwargs for call in request.call_args_list)
+        self.assertNotIn("Content-Encoding", first["headers"])
+        self.assertEqual(
+            urllib.parse.parse_qs(first["data"].decode()),
+            {"messages": [json.dumps(list(range(1000)))], "op": ["add"], "flag": ["read"]},
+        )
+        # The retry only adds dont_block to the body.
+        self.assertEqual(
+            urllib.parse.parse_qs(retry["data"].decode()),
+            dict(urllib.parse.parse_qs(first["data"].decode()), dont_block=["true"]),
+        )
+
+        encoded = zulip.EncodedRequest(FLAGS_REQUEST)
+        self.assertIs(encoded.body(), encoded.body())
+        self.assertIs(encoded.gzipped_body(), encoded.gzipped_body())
+
+    def test_compression(self) -> None:
+        client = make_client()
+        client.ensure_session()
+        success = b'{"result": "success"}'
+        with patch.object(
+            client.session,
+            "request",
+            side_effect=[
+                json_response(200, success, **{"Accept-Encoding": "gzip, deflate"}),
+                json_response(200, success),
+                json_response(200, success),
+            ],
+        ) as request:
+            # Until the server says it accepts gzip, nothing is compressed.
+            client.update_message_flags(FLAGS_REQUEST)
+            client.update_message_flags(FLAGS_REQUEST)
+            client.update_message_flags({"messages": [1], "op": "add", "flag": "read"})
+        uncompressed, compressed, small = (call.kwargs for call in request.call_args_list)
+        self.assertNotIn("Content-Encoding", uncompressed["headers"])
+        self.assertEqual(compressed["headers"]["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(compressed["data"]), uncompressed["data"])
+        self.assertLess(len(compressed["data"]), len(uncompressed["data"]) / 2)
+        self.assertNotIn("Content-Encoding", small["headers"])
+
+    def test_compression_refused(self) -> None:
+        client = make_client(compress_requests=True)
+        client.ensure_session()
+        with patch.object(
+            client.session,
+            "request",
+            side_effect=[
+                json_response(415, b'{"result": "error", "msg": "Unsupported Media Type"}'),
+                json_response(200, b'{"result": "success"}'),
+            ],
+        ) as request, self.assertLogs("zulip", "WARNING"):
+            self.assertEqual(client.update_message_flags(FLAGS_REQUEST), {"result": "success"})
+        refused, retry = (call.kwargs for call in request.call_args_list)
+        self.assertEqual(refused["headers"]["Content-Encoding"], "gzip")
+        self.assertNotIn("Content-Encoding", retry["headers"])
+        self.assertFalse(client.compress_requests)
+
+    def test_compression_rejected_as_bad_request(self) -> None:
+        client = make_client(compress_requests=True)
+        client.ensure_session()
+        bad_request = b'{"result": "error", "msg": "Invalid request"}'
+        with patch.object(
+            client.session,
+            "request",
+            side_effect=[
+                # A genuinely bad request doesn't turn compression off.
+                json_response(400, bad_request),
+                json_response(400, bad_request),
+                json_response(400, bad_request),
+                json_response(200, b'{"result": "success"}'),
+                json_response(200, b'{"result": "success"}'),
+            ],
+        ) as request, self.assertLogs("zulip", "WARNING"):
+            self.assertEqual(client.update_message_flags(FLAGS_REQUEST)["result"], "error")
+            self.assertTrue(client.compress_requests)
+            self.assertEqual(client.update_message_flags(FLAGS_REQUEST), {"result": "success"})
+            self.assertFalse(client.compress_requests)
+            client.update_message_flags(FLAGS_REQUEST)
+        encodings = [
+            call.kwargs["headers"].get("Content-Encoding") for call in request.call_args_list
+        ]
+        self.assertEqual(encodings, ["gzip", None, "gzip", None, None])
+
+
+class TestBulkFlagUpdate(TestCase):
+    def test_chunk_size(self) -> None:
+        update = zulip.BulkFlagUpdate(range(100_000), "add", "read", 2.0, 3, None)
+        chunk, attempts = update.next_chunk()
+        self.assertEqual((chunk, attempts), (list(range(1000)), 0))
+        # Quick requests make the chunks grow, at most doubling at once.
+        update.record_response(chunk, attempts, {"result": "success", "messages": []}, 0.1)
+        self.assertEqual(update.chunk_size, 2000)
+        chunk, _ = update.next_chunk()
+        update.record_response(chunk, 0, {"result": "success", "messages": []}, 2.0)
+        self.assertEqual(update.chunk_size, 2000)
+        chunk, _ = update.next_chunk()
+        update.record_response(chunk, 0, {"result": "success", "messages": []}, 8.0)
+        self.assertEqual(update.chunk_size, 1250)
+        # A failed chunk is sent again in halves.
+        chunk, _ = update.next_chunk()
+        update.record_error(chunk, 0, "Timeout")
+        self.assertEqual(update.chunk_size, 625)
+        self.assertEqual([len(chunk) for chunk, _ in update.retries], [625, 625])
+        self.assertEqual(update.next_chunk(), (list(range(5000, 5625)), 1))
+        self.assertEqual(update.done, 5000)
+
+    def test_update(self) -> None:
+        client = make_client()
+        chunks: List[List[int]] = []
+        lock = threading.Lock()
+
+        def update_message_flags(request: Dict[str, Any]) -> Dict[str, Any]:
+            with lock:
+                chunks.append(request["messages"])
+                if len(chunks) == 1:
+                    raise requests.exceptions.ReadTimeout("Read timed out")
+            if 4321 in request["messages"]:
+                return {"result": "error", "msg": "Invalid message(s)"}
+            # Messages with an odd id were read already.
+            return {"result": "success", "messages": [i for i in request["messages"] if i % 2 == 0]}
+
+        progress: List[Tuple[int, int]] = []
+        with patch.object(client, "update_message_flags", side_effect=update_message_flags):
+            result = client.mark_messages_as_read(
+                [*range(5000), 42], progress_callback=lambda *p: progress.append(p)
+            )
+        self.assertEqual(result["result"], "error")
+        self.assertEqual(result["msg"], "Invalid message(s)")
+        failed = result["failed_messages"]
+        self.assertIn(4321, failed)
+        self.assertEqual(
+            sorted(result["messages"] + [i for i in failed if i % 2 == 0]),
+            list(range(0, 5000, 2)),
+        )
+        self.assertEqual(result["requests"], len(chunks))
+        # The ids of the chunk that timed out were sent again, in smaller chunks.
+        self.assertEqual(sorted(id for chunk in chunks[1:] for id in chunk), list(range(5000)))
+        self.assertEqual(progress[-1], (5000, 5000))
+
+
+class TestUploadFiles(TestCase):
+    def test_encoder(self) -> None:
+        with tempfile.NamedTemporaryFile(suffix=".txt") as f:
+            f.write(b"x" * 100_000)
+            f.flush()
+            f.seek(0)
+            progress: List[Tuple[int, int]] = []
+            body = zulip.MultipartEncoder(
+                {"topic": 'a "quoted" topic'},
+                [f],
+                lambda sent, total: progress.append((sent, total)),
+            )
+            data = b"".join(iter(lambda: body.read(4096), b""))
+            self.assertEqual(len(data), len(body))
+            self.assertEqual(progress[-1], (len(body), len(body)))
+            self.assertEqual(len(progress), -(-len(body) // 4096))
+
+            # Reading again after rewinding gives the same body.
+            body.rewind()
+            self.assertEqual(body.read(), data)
+
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                b"Content-Type: " + body.content_type.encode() + b"\r\n\r\n" + data
+            )
+            field, upload = message.get_payload()
+            self.assertEqual(field.get_param("name", header="content-disposition"), "topic")
+            self.assertEqual(field.get_payload(decode=True), b'a "quoted" topic')
+            self.assertEqual(upload.get_filename(), os.path.basename(f.name))
+            self.assertEqual(upload.get_payload(decode=True), b"x" * 100_000)
+
+    def test_upload_files(self) -> None:
+        client = make_client()
+        client.ensure_session()
+        uploaded: Dict[str, int] = {}
+        lock = threading.Lock()
+
+        def request(method: str, url: str, **kwargs: Any) -> requests.Response:
+            body = kwargs["data"]
+            self.assertEqual(kwargs["headers"]["Content-Type"], body.content_type)
+            data = body.read()
+            name = re.search(rb'filename="([^"]*)"', data)
+            assert name is not None
+            with lock:
+                uploaded[name.group(1).decode()] = len(data)
+            response = requests.Response()
+            response.status_code = 200
+            response.raw = io.BytesIO(
+                json.dumps(
+                    {"result": "success", "uri": "/user_uploads/" + name.group(1).decode()}
+                ).encode()
+            )
+            return response
+
+        with tempfile.TemporaryDirectory() as directory:
+            paths = []
+            for i in range(5):
+                paths.append(os.path.join(directory, f"file{i}.txt"))
+                with open(paths[-1], "wb") as f:
+                    f.write(b"x" * i * 1000)
+            paths.insert(2, os.path.join(directory, "missing.txt"))
+
+            progress: Dict[str, Tuple[int, int]] = {}
+            with patch.object(client.session, "request", side_effect=request):
+                results = client.upload_files(
+                    paths,
+                    max_parallel=3,
+                    progress_callback=lambda path, sent, total: progress.update(
+                        {path: (sent, total)}
+                    ),
+                )
+
+        self.assertEqual(
+            [result.get("uri") for result in results],
+            [
+                "/user_uploads/file0.txt",
+                "/user_uploads/file1.txt",
+                None,
+                "/user_uploads/file2.txt",
+                "/user_uploads/file3.txt",
+                "/user_uploads/file4.txt",
+            ],
+        )
+        self.assertEqual(results[2]["result"], "error")
+        self.assertIn("missing.txt", results[2]["msg"])
+        self.assertEqual(len(uploaded), 5)
+        for path in paths[:2] + paths[3:]:
+            sent, total = progress[path]
+            self.assertEqual(sent, total)
+            self.assertEqual(total, uploaded[os.path.basename(path)])
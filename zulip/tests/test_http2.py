@@ -0,0 +1,147 @@
+import http.server
+import importlib.util
+import io
+import json
+import os
+import tempfile
+import threading
+import urllib.parse
+from typing import Any, Dict, List, Optional, Union
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+import requests
+from typing_extensions import override
+
+import zulip
+from zulip import MultipartEncoder, RequestRecord, Transport, ZulipError
+
+from .test_client import make_client
+
+
+class RecordingTransport(Transport):
+    def __init__(self) -> None:
+        self.requests: List[Dict[str, Any]] = []
+
+    @override
+    def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        params: Optional[bytes] = None,
+        data: Union[None, bytes, MultipartEncoder] = None,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+        stream: bool = False,
+    ) -> requests.Response:
+        self.requests.append({"method": method, "url": url, "data": data})
+        response = requests.Response()
+        response.status_code = 503 if len(self.requests) == 1 else 200
+        response.raw = io.BytesIO(b'{"result": "success", "id": 42}')
+        return response
+
+
+class MessagesHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def respond(self, response: Dict[str, Any]) -> None:
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:  # noqa: N802
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        num_before = int(query.get("num_before", ["0"])[0])
+        messages = [{"id": i, "content": "hi"} for i in range(1, num_before + 1)]
+        self.respond({"result": "success", "messages": messages, "found_oldest": True})
+
+    def do_POST(self) -> None:  # noqa: N802
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        fields = urllib.parse.parse_qs(body.decode())
+        self.respond({"result": "success", "id": 1, "content": fields["content"][0]})
+
+    @override
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+class TestTransports(TestCase):
+    def test_custom_transport(self) -> None:
+        transport = RecordingTransport()
+        client = make_client(transport=lambda client: transport)
+        client.ensure_session()
+        self.assertIs(client.session, transport)
+        with patch("time.sleep"):
+            response = client.send_message(
+                {"type": "stream", "to": "devel", "topic": "t", "content": "hi"}
+            )
+        self.assertEqual(response, {"result": "success", "id": 42})
+        # The 503 was retried, with the same body plus dont_block.
+        first, retry = transport.requests
+        self.assertEqual(first["url"], "https://zulip.example.com/api/v1/messages")
+        self.assertIn(b"content=hi", first["data"])
+        self.assertIn(b"dont_block=true", retry["data"])
+
+    def test_zuliprc(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config_file = os.path.join(tmpdir, "zuliprc")
+            with open(config_file, "w") as f:
+                f.write("[api]\nkey=key\nemail=bot@example.com\ntransport=http3\n")
+            with self.assertRaisesRegex(ZulipError, "transport is set to 'http3'"):
+                make_client(config_file=config_file)
+
+
+@skipUnless(importlib.util.find_spec("httpx") is not None, "needs httpx")
+class TestHTTP2Transport(TestCase):
+    @override
+    def setUp(self) -> None:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MessagesHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        def stop() -> None:
+            server.shutdown()
+            server.server_close()
+
+        self.addCleanup(stop)
+        self.site = f"http://127.0.0.1:{server.server_address[1]}"
+
+    def test_requests(self) -> None:
+        from zulip.http2 import HTTP2Transport
+
+        client = make_client(site=self.site, transport="http2")
+        records: List[RequestRecord] = []
+        client.request_hooks.append(records.append)
+        response = client.send_message(
+            {"type": "stream", "to": "devel", "topic": "t", "content": "zażółć"}
+        )
+        self.assertIsInstance(client.session, HTTP2Transport)
+        self.assertEqual(response, {"result": "success", "id": 1, "content": "zażółć"})
+        self.assertEqual(
+            [message["id"] for message in client.iter_messages(batch_size=3)], [1, 2, 3]
+        )
+
+        first, second = records
+        self.assertEqual((first.status, second.status), (200, 200))
+        self.assertGreater(first.bytes_sent, 0)
+        self.assertGreater(first.connect_time, 0)
+        self.assertEqual(second.connect_time, 0)
+
+    def test_errors(self) -> None:
+        import httpx
+
+        from zulip.http2 import requests_error
+
+        self.assertIsInstance(
+            requests_error(httpx.ReadTimeout("timed out")), requests.exceptions.Timeout
+        )
+        self.assertIsInstance(
+            requests_error(httpx.ConnectError("refused")), requests.exceptions.ConnectionError
+        )
+
+        client = make_client(site="http://127.0.0.1:1", transport="http2")
+        with self.assertRaises(zulip.UnrecoverableNetworkError):
+            client.get_profile()
@@ -0,0 +1,188 @@
+import http.server
+import io
+import os
+import tempfile
+import threading
+from typing import List
+from unittest import TestCase
+from unittest.mock import patch
+
+import requests
+from typing_extensions import override
+
+from zulip import RequestRecord, UnrecoverableNetworkError, request_endpoint
+from zulip.metrics import Histogram, RequestMetrics
+
+from .test_client import make_client
+
+
+def make_response(status_code: int, content: bytes) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response.raw = io.BytesIO(content)
+    return response
+
+
+def make_record(method: str, url: str, status: int, total_time: float) -> RequestRecord:
+    record = RequestRecord(url, method)
+    record.status = status
+    record.ttfb = total_time / 2
+    record.total_time = total_time
+    record.bytes_sent = 10
+    record.bytes_received = 100
+    return record
+
+
+class ServerSettingsHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:  # noqa: N802
+        body = b'{"result": "success"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @override
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+class TestRequestRecords(TestCase):
+    def test_request_endpoint(self) -> None:
+        self.assertEqual(request_endpoint("v1/messages"), "messages")
+        self.assertEqual(request_endpoint("v1/messages/42/reactions"), "messages/{id}/reactions")
+        self.assertEqual(
+            request_endpoint("v1/users/hamlet@example.com/presence"), "users/{email}/presence"
+        )
+        self.assertEqual(request_endpoint("v1/get_stream_id?stream=devel"), "get_stream_id")
+
+    def test_retries(self) -> None:
+        client = make_client()
+        records: List[RequestRecord] = []
+        client.request_hooks.append(records.append)
+        client.ensure_session()
+        responses = [
+            make_response(502, b"Bad gateway"),
+            make_response(200, b'{"result": "success", "id": 42}'),
+        ]
+        with patch.object(client.session, "request", side_effect=responses), patch("time.sleep"):
+            client.send_message({"type": "stream", "to": "devel", "topic": "t", "content": "hi"})
+
+        (record,) = records
+        self.assertEqual((record.method, record.endpoint), ("POST", "messages"))
+        self.assertEqual(record.status, 200)
+        self.assertIsNone(record.error)
+        self.assertEqual(record.retries, 1)
+        self.assertEqual(record.backoff_time, 1)
+        self.assertEqual(record.bytes_received, len(b'{"result": "success", "id": 42}'))
+        self.assertGreaterEqual(record.total_time, 0)
+
+    def test_failure(self) -> None:
+        client = make_client()
+        records: List[RequestRecord] = []
+        client.request_hooks.append(records.append)
+        client.ensure_session()
+        with patch.object(
+            client.session, "request", side_effect=requests.exceptions.ConnectionError
+        ), self.assertRaises(UnrecoverableNetworkError):
+            client.get_profile()
+        (record,) = records
+        self.assertIsNone(record.status)
+        self.assertEqual(record.error, "UnrecoverableNetworkError")
+
+    def test_broken_hook(self) -> None:
+        client = make_client()
+
+        def broken_hook(record: RequestRecord) -> None:
+            raise RuntimeError("broken hook")
+
+        client.request_hooks.append(broken_hook)
+        client.ensure_session()
+        with patch.object(
+            client.session, "request", return_value=make_response(200, b'{"result": "success"}')
+        ), self.assertLogs("zulip", "ERROR"):
+            self.assertEqual(client.get_profile(), {"result": "success"})
+
+    def test_connect_time(self) -> None:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ServerSettingsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            client = make_client(site=f"http://127.0.0.1:{server.server_address[1]}")
+            records: List[RequestRecord] = []
+            client.request_hooks.append(records.append)
+            client.get_profile()
+            client.get_profile()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual([record.status for record in records], [200, 200])
+        self.assertGreater(records[0].connect_time, 0)
+        # Opening the connection isn't counted in the time to first byte too.
+        assert records[0].ttfb is not None
+        self.assertLessEqual(records[0].ttfb + records[0].connect_time, records[0].total_time)
+        # The second request reuses the kept-alive connection.
+        self.assertEqual(records[1].connect_time, 0)
+        assert records[1].ttfb is not None
+        self.assertLessEqual(records[1].ttfb, records[1].total_time)
+
+
+class TestRequestMetrics(TestCase):
+    def test_histogram(self) -> None:
+        histogram = Histogram([0.1, 1, 10])
+        for value in [0.05, 0.5, 0.5, 5, 50]:
+            histogram.observe(value)
+        self.assertEqual(
+            histogram.cumulative_counts(), [(0.1, 1), (1, 3), (10, 4), (float("inf"), 5)]
+        )
+        self.assertAlmostEqual(histogram.quantile(0.5), 0.1 + 0.9 * 1.5 / 2)
+        self.assertEqual(histogram.quantile(1), 10)
+        self.assertEqual(Histogram([1]).quantile(0.5), 0)
+
+    def test_metrics(self) -> None:
+        metrics = RequestMetrics()
+        for total_time in [0.02, 0.03, 0.04]:
+            metrics(make_record("POST", "v1/messages", 200, total_time))
+        metrics(make_record("GET", "v1/messages/1", 200, 3))
+        failed = make_record("GET", "v1/messages/2", 200, 0.2)
+        failed.status = None
+        failed.error = "Timeout"
+        failed.retries = 2
+        metrics(failed)
+
+        self.assertEqual(
+            [(method, endpoint) for method, endpoint, _ in metrics.slowest_endpoints()],
+            [("GET", "messages/{id}"), ("POST", "messages")],
+        )
+
+        text = metrics.to_prometheus()
+        self.assertIn(
+            'zulip_api_request_duration_seconds_bucket{method="POST",endpoint="messages",le="0.025"} 1',
+            text,
+        )
+        self.assertIn(
+            'zulip_api_request_duration_seconds_bucket{method="POST",endpoint="messages",le="+Inf"} 3',
+            text,
+        )
+        self.assertIn(
+            'zulip_api_request_duration_seconds_count{method="POST",endpoint="messages"} 3', text
+        )
+        self.assertIn(
+            'zulip_api_requests_total{method="GET",endpoint="messages/{id}",status="Timeout"} 1',
+            text,
+        )
+        self.assertIn(
+            'zulip_api_request_retries_total{method="GET",endpoint="messages/{id}"} 2', text
+        )
+        self.assertIn("# TYPE zulip_api_request_ttfb_seconds histogram", text)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "zulip.prom")
+            metrics.write_prometheus(path)
+            with open(path) as f:
+                self.assertEqual(f.read(), text)
+            self.assertEqual(os.listdir(directory), ["zulip.prom"])
+
+        metrics.clear()
+        self.assertEqual(metrics.slowest_endpoints(), [])
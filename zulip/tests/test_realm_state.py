@@ -0,0 +1,166 @@
+import copy
+from typing import Any, Dict, List
+from unittest import TestCase
+from unittest.mock import patch
+
+import zulip
+from zulip.realm_state import RealmStateMirror
+
+SERVER_SETTINGS = {"result": "success", "zulip_version": "8.0", "zulip_feature_level": 185}
+
+STATE: Dict[str, Any] = {
+    "result": "success",
+    "queue_id": "q:1",
+    "last_event_id": -1,
+    "realm_users": [
+        {"user_id": 1, "email": "Hamlet@example.com", "full_name": "King Hamlet"},
+        {"user_id": 2, "email": "iago@example.com", "full_name": "Iago"},
+    ],
+    "realm_non_active_users": [
+        {"user_id": 3, "email": "old@example.com", "full_name": "Iago", "is_active": False},
+    ],
+    "streams": [
+        {"stream_id": 10, "name": "Denmark", "description": ""},
+        {"stream_id": 11, "name": "Verona", "description": ""},
+    ],
+    "subscriptions": [{"stream_id": 10, "name": "Denmark", "subscribers": [1, 2]}],
+    "unsubscribed": [],
+    "never_subscribed": [{"stream_id": 11, "name": "Verona", "subscribers": [2]}],
+    "realm_user_groups": [{"id": 20, "name": "admins", "members": [1], "direct_subgroup_ids": []}],
+}
+
+
+class StopConsumerError(BaseException):
+    pass
+
+
+class TestRealmStateMirror(TestCase):
+    def make_mirror(self) -> RealmStateMirror:
+        with patch.object(zulip.Client, "get_server_settings", return_value=SERVER_SETTINGS):
+            client = zulip.Client(
+                email="bot@example.com", api_key="key", site="https://zulip.example.com"
+            )
+        return RealmStateMirror(client)
+
+    def test_lookups(self) -> None:
+        mirror = self.make_mirror()
+        mirror.load(copy.deepcopy(STATE))
+        self.assertTrue(mirror.wait_until_loaded(0))
+        user = mirror.get_user_by_email("hamlet@example.com")
+        assert user is not None
+        self.assertEqual(user["user_id"], 1)
+        self.assertEqual({user["user_id"] for user in mirror.get_users_by_name("iago")}, {2, 3})
+        stream = mirror.get_stream_by_name("denmark")
+        assert stream is not None
+        self.assertEqual(stream["stream_id"], 10)
+        self.assertTrue(mirror.is_subscribed(10))
+        self.assertFalse(mirror.is_subscribed(11))
+        subscribers = mirror.get_subscribers(11)
+        self.assertEqual(subscribers, {2})
+        # A snapshot, not the mirror's own set.
+        mirror.apply_event(
+            {"type": "subscription", "op": "peer_add", "stream_ids": [11], "user_ids": [3]}
+        )
+        self.assertEqual(subscribers, {2})
+        self.assertEqual(mirror.get_subscribers(11), {2, 3})
+        group = mirror.get_user_group_by_name("Admins")
+        assert group is not None
+        self.assertEqual(group["members"], [1])
+
+    def test_events(self) -> None:
+        mirror = self.make_mirror()
+        mirror.load(copy.deepcopy(STATE))
+        events: List[Dict[str, Any]] = [
+            {"type": "realm_user", "op": "update", "person": {"user_id": 1, "full_name": "Ham"}},
+            {
+                "type": "realm_user",
+                "op": "update",
+                "person": {"user_id": 1, "new_email": "ham@example.com"},
+            },
+            {
+                "type": "realm_user",
+                "op": "add",
+                "person": {"user_id": 4, "email": "new@example.com", "full_name": "New"},
+            },
+            {"type": "realm_user", "op": "remove", "person": {"user_id": 2, "full_name": "Iago"}},
+            {
+                "type": "stream",
+                "op": "update",
+                "stream_id": 10,
+                "name": "Denmark",
+                "property": "name",
+                "value": "Elsinore",
+            },
+            {
+                "type": "stream",
+                "op": "update",
+                "stream_id": 10,
+                "name": "Elsinore",
+                "property": "description",
+                "value": "**Castle**",
+                "rendered_description": "<p><strong>Castle</strong></p>",
+            },
+            {"type": "stream", "op": "delete", "streams": [{"stream_id": 11, "name": "Verona"}]},
+            {"type": "subscription", "op": "peer_add", "stream_ids": [10], "user_ids": [4]},
+            {"type": "subscription", "op": "peer_remove", "stream_ids": [10], "user_ids": [2]},
+            {"type": "user_group", "op": "add_members", "group_id": 20, "user_ids": [4]},
+            {"type": "user_group", "op": "update", "group_id": 20, "data": {"name": "owners"}},
+            {"type": "message", "message": {}},
+        ]
+        for event in events:
+            mirror.apply_event(event)
+
+        self.assertIsNone(mirror.get_user_by_email("hamlet@example.com"))
+        user = mirror.get_user_by_email("ham@example.com")
+        assert user is not None
+        self.assertEqual(user["full_name"], "Ham")
+        self.assertEqual(mirror.get_users_by_name("King Hamlet"), [])
+        self.assertIsNone(mirror.get_user(2))
+        self.assertEqual([user["user_id"] for user in mirror.get_users_by_name("iago")], [3])
+        self.assertIsNotNone(mirror.get_user_by_email("new@example.com"))
+
+        self.assertIsNone(mirror.get_stream_by_name("Denmark"))
+        stream = mirror.get_stream_by_name("Elsinore")
+        assert stream is not None
+        self.assertEqual(stream["rendered_description"], "<p><strong>Castle</strong></p>")
+        subscription = mirror.get_subscription(10)
+        assert subscription is not None
+        self.assertEqual(subscription["name"], "Elsinore")
+        self.assertEqual(subscription["subscribers"], [1, 4])
+        self.assertIsNone(mirror.get_stream(11))
+
+        self.assertIsNone(mirror.get_user_group_by_name("admins"))
+        group = mirror.get_user_group_by_name("owners")
+        assert group is not None
+        self.assertEqual(group["members"], [1, 4])
+
+    def test_run(self) -> None:
+        mirror = self.make_mirror()
+        responses: List[Any] = [
+            {
+                "result": "success",
+                "events": [
+                    {
+                        "id": 0,
+                        "type": "stream",
+                        "op": "create",
+                        "streams": [{"stream_id": 12, "name": "Rome"}],
+                    }
+                ],
+            },
+            StopConsumerError(),
+        ]
+        with patch.object(
+            mirror.client, "register", return_value=copy.deepcopy(STATE)
+        ) as register, patch.object(
+            mirror.client, "get_events", side_effect=responses
+        ), self.assertRaises(StopConsumerError):
+            mirror.run()
+        register.assert_called_once_with(
+            RealmStateMirror.MIRRORED_EVENT_TYPES,
+            [],
+            fetch_event_types=RealmStateMirror.MIRRORED_EVENT_TYPES,
+            include_subscribers=True,
+        )
+        self.assertIsNotNone(mirror.get_stream_by_name("Denmark"))
+        self.assertIsNotNone(mirror.get_stream_by_name("Rome"))
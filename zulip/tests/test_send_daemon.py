@@ -0,0 +1,110 @@
+import os
+import socket
+import stat
+import tempfile
+import threading
+from typing import Any, Dict, List
+from unittest import TestCase
+from unittest.mock import patch
+
+from typing_extensions import override
+
+import zulip
+from zulip import send_daemon
+from zulip.send_daemon import SendDaemon, send_message, send_via_daemon
+
+from .test_client import make_client
+
+MESSAGE = {"type": "stream", "to": "devel", "subject": "hooks", "content": "pushed"}
+
+
+class TestSendDaemon(TestCase):
+    @override
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.socket_path = os.path.join(directory.name, "zulip-send.sock")
+
+    def start_daemon(self, client: zulip.Client) -> SendDaemon:
+        server = SendDaemon(client, self.socket_path)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        def stop() -> None:
+            server.shutdown()
+            server.server_close()
+
+        self.addCleanup(stop)
+        return server
+
+    def test_send(self) -> None:
+        client = make_client()
+        sent: List[Dict[str, Any]] = []
+
+        def send(message_data: Dict[str, Any]) -> Dict[str, Any]:
+            sent.append(message_data)
+            return {"result": "success", "msg": "", "id": len(sent)}
+
+        with patch.object(client, "send_message", side_effect=send):
+            self.start_daemon(client)
+            self.assertEqual(stat.S_IMODE(os.stat(self.socket_path).st_mode), 0o600)
+            self.assertEqual(
+                send_via_daemon(MESSAGE, self.socket_path),
+                {"result": "success", "msg": "", "id": 1},
+            )
+            response = send_message(MESSAGE, self.fail, self.socket_path)
+        self.assertEqual(response["id"], 2)
+        self.assertEqual(sent, [MESSAGE, MESSAGE])
+
+    def test_send_error(self) -> None:
+        client = make_client()
+        with patch.object(
+            client, "send_message", side_effect=zulip.UnrecoverableNetworkError("Down")
+        ), self.assertLogs(send_daemon.logger, "ERROR"):
+            self.start_daemon(client)
+            response = send_via_daemon(MESSAGE, self.socket_path)
+        self.assertEqual(response, {"result": "error", "msg": "UnrecoverableNetworkError: Down"})
+
+    def test_fallback(self) -> None:
+        self.assertIsNone(send_via_daemon(MESSAGE, self.socket_path))
+
+        client = make_client()
+        with patch.object(
+            client, "send_message", return_value={"result": "success", "id": 1}
+        ) as send:
+            self.assertEqual(
+                send_message(MESSAGE, lambda: client, self.socket_path),
+                {"result": "success", "id": 1},
+            )
+        send.assert_called_once_with(MESSAGE)
+
+    def test_bad_reply(self) -> None:
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(listener.close)
+        listener.bind(self.socket_path)
+        listener.listen()
+
+        # A daemon that takes each message, and answers with a
+        # truncated, and then an invalid, reply.
+        def serve() -> None:
+            for reply in [b'{"result": "succ', b"oops\n"]:
+                conn, _ = listener.accept()
+                with conn:
+                    conn.recv(4096)
+                    conn.sendall(reply)
+
+        threading.Thread(target=serve, daemon=True).start()
+        # The message may have been sent, so it isn't sent again.
+        for _ in range(2):
+            with self.assertRaises(zulip.UnrecoverableNetworkError):
+                send_message(MESSAGE, self.fail, self.socket_path)
+
+    def test_stale_socket(self) -> None:
+        # A socket file nothing listens on anymore.
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.socket_path)
+        stale.close()
+        self.assertIsNone(send_via_daemon(MESSAGE, self.socket_path))
+
+        self.start_daemon(make_client())
+        with self.assertRaises(zulip.ZulipError):
+            SendDaemon(make_client(), self.socket_path)
@@ -1,34 +1,52 @@
-import argparse
+import copy
+import functools
 import json
 import logging
-import optparse
 import os
-import platform
+import queue
 import random
+import re
 import sys
+import threading
 import time
 import traceback
 import types
 import urllib.parse
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from configparser import ConfigParser
 from typing import (
     IO,
+    TYPE_CHECKING,
     Any,
     Callable,
+    Deque,
     Dict,
+    Generator,
+    Hashable,
     Iterable,
+    Iterator,
     List,
     Mapping,
     Optional,
     Sequence,
     Tuple,
+    Type,
     Union,
 )
 
-import distro
-import requests
 from typing_extensions import Literal, override
 
+if TYPE_CHECKING:
+    # These, and the modules only needed to make requests, are
+    # imported when first used, so that short-lived scripts that
+    # import zulip (e.g. git hooks) start quickly.
+    import argparse
+    import optparse
+    import ssl
+
+    import requests
+
 __version__ = "0.9.0"
 
 # Ensure the Python version is supported
@@ -38,6 +56,17 @@ logger = logging.getLogger(__name__)
 
 API_VERSTRING = "v1/"
 
+# The defaults of requests' HTTPAdapter.
+DEFAULT_POOL_SIZE = 10
+DEFAULT_POOL_BLOCK = False
+
+# Request bodies smaller than this are not worth compressing.
+GZIP_MIN_SIZE = 1024
+
+# How many times a request is retried after server errors, connection
+# errors, or being rate-limited, before giving up.
+MAX_ERROR_RETRIES = 10
+
 # An optional parameter to `move_topic` and `update_message` actions
 # See eg. https://zulip.com/api/update-message#parameter-propagate_mode
 EditPropagateMode = Literal["change_one", "change_all", "change_later"]
@@ -124,17 +153,24 @@ class CountingBackoff:
 class RandomExponentialBackoff(CountingBackoff):
     @override
     def fail(self) -> None:
+        time.sleep(self.record_failure())
+
+    def record_failure(self) -> float:
+        """Like fail(), but returns the delay instead of sleeping, for
+        callers that must not block (e.g. in an asyncio event loop)."""
         super().fail()
         # Exponential growth with ratio sqrt(2); compute random delay
-        # between x and 2x where x is growing exponentially
+        # between x and 2x where x is growing exponentially.  The
+        # jitter is continuous, so that many clients failing at the
+        # same moment (e.g. a server restart) spread their retries out.
         delay_scale = int(2 ** (self.number_of_retries / 2.0 - 1)) + 1
-        delay = min(delay_scale + random.randint(1, delay_scale), self.delay_cap)  # noqa: S311
-        message = f"Sleeping for {delay}s [max {delay_scale * 2}] before retrying."
+        delay = min(random.uniform(delay_scale, 2 * delay_scale), self.delay_cap)  # noqa: S311
+        message = f"Sleeping for {delay:.1f}s [max {delay_scale * 2}] before retrying."
         try:
             logger.warning(message)
         except NameError:
             print(message)
-        time.sleep(delay)
+        return delay
 
 
 def _default_client() -> str:
@@ -142,13 +178,15 @@ def _default_client() -> str:
 
 
 def add_default_arguments(
-    parser: argparse.ArgumentParser,
+    parser: "argparse.ArgumentParser",
     patch_error_handling: bool = True,
     allow_provisioning: bool = False,
-) -> argparse.ArgumentParser:
+) -> "argparse.ArgumentParser":
+    import argparse
+
     if patch_error_handling:
 
-        def custom_error_handling(self: argparse.ArgumentParser, message: str) -> None:
+        def custom_error_handling(self: "argparse.ArgumentParser", message: str) -> None:
             self.print_help(sys.stderr)
             self.exit(2, f"{self.prog}: error: {message}\n")
 
@@ -218,12 +256,15 @@ def add_default_arguments(
 # except for the fact that is uses the deprecated `optparse` module.
 # We still keep it for legacy support of out-of-tree bots and integrations
 # depending on it.
-def generate_option_group(parser: optparse.OptionParser, prefix: str = "") -> optparse.OptionGroup:
+def generate_option_group(
+    parser: "optparse.OptionParser", prefix: str = ""
+) -> "optparse.OptionGroup":
     logging.warning(
         """zulip.generate_option_group is based on optparse, which
                     is now deprecated. We recommend migrating to argparse and
                     using zulip.add_default_arguments instead."""
     )
+    import optparse
 
     group = optparse.OptionGroup(parser, "Zulip API configuration")
     group.add_option(f"--{prefix}site", dest="zulip_site", help="Zulip server URI", default=None)
@@ -351,6 +392,17 @@ def validate_boolean_field(field: Optional[str]) -> Union[bool, None]:
         return None
 
 
+def read_positive_int_option(config: ConfigParser, option: str) -> int:
+    setting = config.get("api", option)
+    try:
+        value = int(setting)
+    except ValueError:
+        value = 0
+    if value <= 0:
+        raise ZulipError(f"{option} is set to '{setting}', it must be a positive integer")
+    return value
+
+
 class ZulipError(Exception):
     pass
 
@@ -367,6 +419,665 @@ class UnrecoverableNetworkError(ZulipError):
     pass
 
 
+class StopFetchingEventsError(BaseException):
+    # Raised from the callbacks of call_on_each_event to stop it; not
+    # an Exception, so that it isn't retried.
+    pass
+
+
+class EventWorkerPool:
+    """
+    Runs an event callback on `num_workers` threads, so that a slow
+    callback doesn't delay the next get_events long-poll.
+
+    Events are buffered in bounded queues; once `max_buffered_events`
+    are waiting, submit() blocks, which stops the fetching loop from
+    running further ahead of the workers.  If `ordering_key` is given,
+    events with equal keys are always handled by the same worker, in
+    the order they were received; otherwise any idle worker takes the
+    next event.
+
+    `progress_callback`, if given, is called with (queue_id,
+    last_event_id) once every event of a batch, and of all batches
+    submitted before it, has been handled.
+
+    close(), or leaving a `with` block, stops the workers once they
+    have handled the events submitted so far.
+
+    If the callback raises an exception that isn't an Exception, such
+    as SystemExit, the workers drop the events left, and submit() and
+    close() raise it again.
+    """
+
+    def __init__(
+        self,
+        callback: Callable[[Dict[str, Any]], None],
+        num_workers: int,
+        max_buffered_events: int = 1000,
+        ordering_key: Optional[Callable[[Dict[str, Any]], Hashable]] = None,
+        progress_callback: Optional[Callable[[str, int], None]] = None,
+    ) -> None:
+        self.callback = callback
+        self.ordering_key = ordering_key
+        self.progress_callback = progress_callback
+        num_queues = num_workers if ordering_key is not None else 1
+        queue_size = max(1, max_buffered_events // num_queues)
+        # None tells the worker taking it to stop.
+        self.queues: List["queue.Queue[Optional[Tuple[Dict[str, Any], List[Any]]]]"] = [
+            queue.Queue(maxsize=queue_size) for _ in range(num_queues)
+        ]
+        # Each batch is [queue_id, last_event_id, events not yet handled].
+        self.batches: Deque[List[Any]] = deque()
+        self.lock = threading.Lock()
+        self.failure: Optional[BaseException] = None
+        self.workers: List[threading.Thread] = []
+        for i in range(num_workers):
+            worker = threading.Thread(
+                target=self.run_worker,
+                args=(self.queues[i % num_queues],),
+                name=f"zulip-event-worker-{i}",
+                daemon=True,
+            )
+            worker.start()
+            self.workers.append(worker)
+
+    def __enter__(self) -> "EventWorkerPool":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        exc_traceback: Optional[types.TracebackType],
+    ) -> None:
+        self.close()
+
+    def close(self) -> None:
+        # Each worker stops at the None it takes from its queue, after
+        # the events queued before it.
+        for i in range(len(self.workers)):
+            self.queues[i % len(self.queues)].put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.raise_failure()
+
+    def raise_failure(self) -> None:
+        if self.failure is not None:
+            raise self.failure
+
+    def submit(self, queue_id: str, last_event_id: int, events: List[Dict[str, Any]]) -> None:
+        self.raise_failure()
+        batch = [queue_id, last_event_id, len(events)]
+        with self.lock:
+            self.batches.append(batch)
+        if not events:
+            self.finish_event(batch)
+        for event in events:
+            if self.ordering_key is None:
+                event_queue = self.queues[0]
+            else:
+                event_queue = self.queues[hash(self.ordering_key(event)) % len(self.queues)]
+            event_queue.put((event, batch))
+        self.raise_failure()
+
+    def run_worker(
+        self, event_queue: "queue.Queue[Optional[Tuple[Dict[str, Any], List[Any]]]]"
+    ) -> None:
+        while True:
+            item = event_queue.get()
+            if item is None:
+                return
+            event, batch = item
+            if self.failure is not None:
+                # Keep taking events, so that submit() doesn't block.
+                continue
+            try:
+                self.callback(event)
+            except Exception:
+                logger.exception("Error handling event %s", event.get("id"))
+            except BaseException as e:
+                self.failure = e
+                continue
+            self.finish_event(batch)
+
+    def finish_event(self, batch: List[Any]) -> None:
+        with self.lock:
+            batch[2] -= 1
+            progress = None
+            while self.batches and self.batches[0][2] <= 0:
+                queue_id, last_event_id, _ = self.batches.popleft()
+                progress = (queue_id, last_event_id)
+            # Report under the lock, so that progress is never reported
+            # out of order.
+            if progress is not None and self.progress_callback is not None:
+                self.progress_callback(*progress)
+
+
+# The read-mostly GET endpoints whose responses Client can cache, and
+# the kind of data each of them returns.
+CACHED_ENDPOINTS = [
+    (re.compile(r"get_stream_id\?"), "stream"),
+    (re.compile(r"users(/\d+)?$"), "realm_user"),
+    (re.compile(r"users/me/subscriptions$"), "subscription"),
+    (re.compile(r"realm/emoji$"), "realm_emoji"),
+    (re.compile(r"server_settings$"), "realm"),
+]
+
+# The kinds of cached data that each type of event may change.
+CACHE_INVALIDATING_EVENTS = {
+    "stream": ["stream", "subscription"],
+    "realm_user": ["realm_user"],
+    "subscription": ["subscription"],
+    "realm_emoji": ["realm_emoji"],
+    "realm": ["realm"],
+}
+
+# The kinds of cached data that other requests made by the client may
+# change, by URL prefix.
+CACHE_INVALIDATING_REQUESTS = [
+    (re.compile(r"(default_)?streams\b"), ["stream", "subscription"]),
+    (re.compile(r"users\b"), ["realm_user", "subscription"]),
+    (re.compile(r"realm\b"), ["realm_emoji", "realm"]),
+]
+
+
+class ResponseCache:
+    """
+    A thread-safe LRU cache of successful API responses, each of which
+    expires `ttl` seconds after being fetched.  Entries are tagged
+    with the kind of data they hold (see CACHED_ENDPOINTS), so that
+    events can invalidate them.
+    """
+
+    def __init__(self, ttl: float, maxsize: int) -> None:
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries: "OrderedDict[Tuple[str, str, str], Tuple[float, Dict[str, Any]]]" = (
+            OrderedDict()
+        )
+        self.lock = threading.Lock()
+
+    def get(self, key: Tuple[str, str, str]) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, response = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+        # Callers may modify the response they get, including the lists
+        # and dicts in it.
+        return copy.deepcopy(response)
+
+    def put(self, key: Tuple[str, str, str], response: Dict[str, Any]) -> None:
+        if response.get("result") != "success":
+            return
+        # The response is also returned to the caller that fetched it.
+        response = copy.deepcopy(response)
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, tags: Iterable[str]) -> None:
+        with self.lock:
+            for key in [key for key in self.entries if key[0] in tags]:
+                del self.entries[key]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+class RateLimiter:
+    """
+    A token bucket that paces a client's requests to stay within the
+    budget the server advertises in the X-RateLimit-* headers of its
+    responses: X-RateLimit-Remaining requests are left, and the budget
+    is fully restored at X-RateLimit-Reset (a Unix timestamp), so it
+    refills at (limit - remaining) / (reset - now) requests per second.
+
+    Each request first takes a token with reserve(), which returns how
+    long to wait before sending it; once the tokens are used up, the
+    waits line requests up behind the refill instead of them failing.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # None until the server has told us its limit.
+        self.limit: Optional[int] = None
+        self.tokens = 0.0
+        self.refill_rate = 0.0
+        self.reset_time = 0.0
+        self.updated_at = 0.0
+        self.blocked_until = 0.0
+
+        self.delayed_requests = 0
+        self.total_delay = 0.0
+        self.rate_limited_responses = 0
+
+    def refill(self, now: float) -> None:
+        if self.limit is not None:
+            elapsed = max(now - self.updated_at, 0.0)
+            self.tokens = min(self.limit, self.tokens + elapsed * self.refill_rate)
+        self.updated_at = now
+
+    def reserve(self) -> float:
+        with self.lock:
+            now = time.time()
+            delay = max(self.blocked_until - now, 0.0)
+            if self.limit is not None:
+                self.refill(now)
+                self.tokens -= 1
+                if self.tokens < 0:
+                    delay = max(delay, -self.tokens / self.refill_rate)
+            if delay > 0:
+                self.delayed_requests += 1
+                self.total_delay += delay
+            return delay
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        try:
+            limit = int(headers["X-RateLimit-Limit"])
+            remaining = int(headers["X-RateLimit-Remaining"])
+            reset_time = float(headers["X-RateLimit-Reset"])
+        except (KeyError, ValueError):
+            return
+        with self.lock:
+            now = time.time()
+            self.refill(now)
+            # Our own count may be lower, because of requests that
+            # have been reserved but not yet answered.
+            self.tokens = remaining if self.limit is None else min(self.tokens, remaining)
+            self.limit = limit
+            self.reset_time = reset_time
+            self.refill_rate = max(limit - remaining, 1) / max(reset_time - now, 1.0)
+
+    def record_rate_limited(self, retry_after: float) -> None:
+        with self.lock:
+            now = time.time()
+            self.refill(now)
+            self.tokens = min(self.tokens, 0.0)
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+            self.rate_limited_responses += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the remaining request budget, as last reported by the
+        server and adjusted for requests made and time passed since,
+        and how much pacing has happened so far.
+        """
+        with self.lock:
+            self.refill(time.time())
+            return {
+                "limit": self.limit,
+                "remaining": max(int(self.tokens), 0) if self.limit is not None else None,
+                "reset": self.reset_time if self.limit is not None else None,
+                "delayed_requests": self.delayed_requests,
+                "total_delay": self.total_delay,
+                "rate_limited_responses": self.rate_limited_responses,
+            }
+
+
+def get_retry_after(response_json: object, headers: Mapping[str, str]) -> float:
+    # Zulip sends the delay in the response body as well as in the
+    # standard header.
+    values = [headers.get("Retry-After")]
+    if isinstance(response_json, dict):
+        values.insert(0, response_json.get("retry-after"))
+    for value in values:
+        try:
+            return float(value)  # type: ignore[arg-type] # None is handled below.
+        except (TypeError, ValueError):
+            pass
+    return 1.0
+
+
+class RequestRecord:
+    """
+    What it took to make one API request, retries included, as passed
+    to each of a client's request hooks once the request is done.
+
+    `endpoint` is the URL path under /api/v1/, with ids and emails
+    replaced by placeholders so that requests can be grouped by it.
+    `status` is None, and `error` the name of the exception, if no
+    response was received.  `connect_time` is the time spent opening
+    connections, `ttfb` the time from sending the last attempt until
+    its response headers arrived, and `total_time` the time the whole
+    request took, including the `backoff_time` spent waiting between
+    `retries` and for the rate limit.  Times are in seconds.
+    """
+
+    def __init__(self, url: str, method: str) -> None:
+        self.endpoint = request_endpoint(url)
+        self.method = method
+        self.status: Optional[int] = None
+        self.error: Optional[str] = None
+        self.bytes_sent = 0
+        self.bytes_received: Optional[int] = None
+        self.connect_time = 0.0
+        self.ttfb: Optional[float] = None
+        self.total_time = 0.0
+        self.retries = 0
+        self.backoff_time = 0.0
+        self.started = time.monotonic()
+
+    def finish(self) -> None:
+        self.total_time = time.monotonic() - self.started
+
+    @override
+    def __repr__(self) -> str:
+        return (
+            f"<RequestRecord {self.method} {self.endpoint} status={self.status} "
+            f"total_time={self.total_time:.3f} retries={self.retries}>"
+        )
+
+
+ENDPOINT_PLACEHOLDERS = [
+    (re.compile(r"/\d+(?=/|$)"), "/{id}"),
+    (re.compile(r"/[^/]*@[^/]*(?=/|$)"), "/{email}"),
+]
+
+
+def request_endpoint(url: str) -> str:
+    endpoint = "/" + url.split(API_VERSTRING, 1)[-1].split("?", 1)[0].strip("/")
+    for regex, placeholder in ENDPOINT_PLACEHOLDERS:
+        endpoint = regex.sub(placeholder, endpoint)
+    return endpoint.lstrip("/")
+
+
+def request_body_size(body: object) -> int:
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode())
+    return len(body)  # type: ignore[arg-type] # bytes or MultipartEncoder.
+
+
+@functools.lru_cache(maxsize=None)
+def fast_json_loads() -> Callable[[Union[bytes, str]], Any]:
+    # orjson or ujson, if installed, decode responses much faster than
+    # the json module; we only use them in the streaming iterators.
+    # Looked up on first use, since importing them takes a while.
+    try:
+        import orjson
+    except ImportError:
+        pass
+    else:
+        return orjson.loads
+    try:
+        import ujson
+    except ImportError:
+        return json.loads
+    else:
+        return ujson.loads
+
+
+class StreamingArrayDecoder:
+    """
+    Decodes a JSON object that arrives in chunks, such as a streamed
+    response body, and returns the items of one of its top-level array
+    fields (e.g. `messages`) as soon as each of them is complete, so
+    that a large response never has to be decoded as a whole.
+
+    `feed()` returns the items completed by each chunk; `close()`
+    returns the rest of the object, with an empty array for that field.
+    """
+
+    STRUCTURE = re.compile(rb'["\[\]{},]')
+    STRING_SPECIAL = re.compile(rb'["\\]')
+
+    def __init__(
+        self, key: str, loads: Optional[Callable[[Union[bytes, str]], Any]] = None
+    ) -> None:
+        self.key = json.dumps(key).encode()
+        self.loads = loads if loads is not None else fast_json_loads()
+        self.buffer = b""
+        # Everything before `start` in the buffer has been decoded, or
+        # copied to `rest`; everything before `pos` has been scanned.
+        self.start = 0
+        self.pos = 0
+        self.rest = bytearray()
+        self.depth = 0
+        self.in_string = False
+        self.string_start = 0
+        self.last_key = b""
+        self.in_array = False
+
+    def feed(self, chunk: bytes) -> List[Any]:
+        items: List[Any] = []
+        buf = self.buffer + chunk
+        pos = self.pos
+        while True:
+            if self.in_string:
+                match = self.STRING_SPECIAL.search(buf, pos)
+                if match is None:
+                    pos = len(buf)
+                    break
+                if match.group() == b"\\":
+                    if match.end() == len(buf):
+                        # The escaped character is in the next chunk.
+                        pos = match.start()
+                        break
+                    pos = match.end() + 1
+                    continue
+                pos = match.end()
+                self.in_string = False
+                if self.depth == 1:
+                    self.last_key = buf[self.string_start : pos]
+                continue
+
+            match = self.STRUCTURE.search(buf, pos)
+            if match is None:
+                pos = len(buf)
+                break
+            char = match.group()
+            pos = match.end()
+            if char == b'"':
+                self.in_string = True
+                self.string_start = match.start()
+            elif char in (b"[", b"{"):
+                self.depth += 1
+                if self.depth == 2 and char == b"[" and self.last_key == self.key:
+                    self.rest += buf[self.start : pos]
+                    self.start = pos
+                    self.in_array = True
+            elif char in (b"]", b"}"):
+                self.depth -= 1
+                if self.in_array and self.depth == 1:
+                    self.add_item(buf[self.start : match.start()], items)
+                    self.start = match.start()
+                    self.in_array = False
+            elif self.in_array and self.depth == 2:
+                self.add_item(buf[self.start : match.start()], items)
+                self.start = pos
+
+        if self.in_array:
+            # Keep the partial item.
+            offset = self.start
+        else:
+            # Keep a partial key, since we need to compare it to ours.
+            offset = self.string_start if self.in_string and self.depth == 1 else pos
+            self.rest += buf[self.start : offset]
+            self.start = offset
+        self.buffer = buf[offset:]
+        self.start -= offset
+        self.pos = pos - offset
+        self.string_start -= offset
+        return items
+
+    def add_item(self, item: bytes, items: List[Any]) -> None:
+        item = item.strip()
+        if item:
+            items.append(self.loads(item))
+
+    def close(self) -> Dict[str, Any]:
+        if self.depth != 0 or self.in_string:
+            raise ValueError("Truncated JSON object")
+        self.rest += self.buffer[self.start :]
+        return self.loads(bytes(self.rest))
+
+
+class EncodedRequest:
+    """
+    The parameters of a request, with the values that aren't strings
+    encoded as JSON, and the form-encoded body (or query string) they
+    make, which is built only once, however often the request is
+    retried, and gzip-compressed only once too.
+    """
+
+    def __init__(self, request: Mapping[str, Any]) -> None:
+        self.fields = {
+            key: val if isinstance(val, str) else json.dumps(val) for key, val in request.items()
+        }
+        self._body: Optional[bytes] = None
+        self._gzipped_body: Optional[bytes] = None
+
+    def set(self, key: str, value: Any) -> None:
+        self.fields[key] = value if isinstance(value, str) else json.dumps(value)
+        self._body = self._gzipped_body = None
+
+    def body(self) -> bytes:
+        if self._body is None:
+            self._body = urllib.parse.urlencode(self.fields).encode()
+        return self._body
+
+    def gzipped_body(self) -> bytes:
+        if self._gzipped_body is None:
+            import gzip
+
+            # Quick to compress, and nearly as small as the default
+            # level for the JSON lists that make up large bodies.
+            self._gzipped_body = gzip.compress(self.body(), compresslevel=5, mtime=0)
+        return self._gzipped_body
+
+
+class Transport:
+    """
+    What a Client sends its requests through, in place of the requests
+    session it uses by default; see the `transport` argument of Client.
+
+    request() takes the arguments do_api_request passes to
+    requests.Session.request (method, url, params, data, headers,
+    timeout and stream), and must return a requests.Response and raise
+    requests' exceptions, so that errors are retried as they are with
+    the default transport.  It is called from many threads at once.
+    """
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        params: Optional[bytes] = None,
+        data: Union[None, bytes, "MultipartEncoder"] = None,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+        stream: bool = False,
+    ) -> "requests.Response":
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class MultipartEncoder:
+    """
+    A multipart/form-data request body holding `fields` and `files`,
+    which can be read like a file.  The files are only read as the
+    body is, so that sending it takes the same, small amount of memory
+    whatever their size.  `progress_callback`, if given, is called
+    with the number of bytes read so far and the total after each read.
+    """
+
+    def __init__(
+        self,
+        fields: Mapping[str, str],
+        files: Sequence[IO[Any]],
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+    ) -> None:
+        self.progress_callback = progress_callback
+        self.boundary = os.urandom(16).hex()
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+
+        # Each part is either bytes, or a file, its start offset and size.
+        self.parts: List[Union[bytes, Tuple[IO[Any], int, int]]] = []
+        for name, value in fields.items():
+            self.parts.append(
+                self.part_header(f'form-data; name="{quote_header_param(name)}"')
+                + value.encode()
+                + b"\r\n"
+            )
+        for f in files:
+            start = f.tell()
+            f.seek(0, os.SEEK_END)
+            size = f.tell() - start
+            f.seek(start)
+            self.parts.append(
+                self.part_header(
+                    f'form-data; name="{quote_header_param(f.name)}"; '
+                    f'filename="{quote_header_param(os.path.basename(f.name))}"'
+                )
+            )
+            if size > 0:
+                self.parts.append((f, start, size))
+            self.parts.append(b"\r\n")
+        self.parts.append(f"--{self.boundary}--\r\n".encode())
+
+        self.length = sum(len(part) if isinstance(part, bytes) else part[2] for part in self.parts)
+        self.rewind()
+
+    def part_header(self, content_disposition: str) -> bytes:
+        return f"--{self.boundary}\r\nContent-Disposition: {content_disposition}\r\n\r\n".encode()
+
+    def rewind(self) -> None:
+        self.part_index = 0
+        self.part_offset = 0
+        self.position = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def tell(self) -> int:
+        return self.position
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            size = self.length - self.position
+        chunks = []
+        while size > 0 and self.part_index < len(self.parts):
+            part = self.parts[self.part_index]
+            if isinstance(part, bytes):
+                chunk = part[self.part_offset : self.part_offset + size]
+                part_size = len(part)
+            else:
+                f, start, part_size = part
+                f.seek(start + self.part_offset)
+                chunk = f.read(min(size, part_size - self.part_offset))
+                if not chunk:
+                    raise ZulipError(f"{f.name} was truncated while being uploaded")
+            chunks.append(chunk)
+            size -= len(chunk)
+            self.part_offset += len(chunk)
+            if self.part_offset == part_size:
+                self.part_index += 1
+                self.part_offset = 0
+        data = b"".join(chunks)
+        self.position += len(data)
+        if self.progress_callback is not None and data:
+            self.progress_callback(self.position, self.length)
+        return data
+
+
+def quote_header_param(value: str) -> str:
+    # The escaping browsers use for multipart/form-data names.
+    return value.replace("\\", "\\\\").replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+
 class Client:
     def __init__(
         self,
@@ -381,7 +1092,56 @@ class Client:
         insecure: Optional[bool] = None,
         client_cert: Optional[str] = None,
         client_cert_key: Optional[str] = None,
+        pool_connections: Optional[int] = None,
+        pool_maxsize: Optional[int] = None,
+        pool_block: Optional[bool] = None,
+        cache_ttl: Optional[float] = None,
+        cache_maxsize: int = 1024,
+        compress_requests: Optional[bool] = None,
+        transport: Union[None, str, Callable[["Client"], Transport]] = None,
     ) -> None:
+        """
+        A Client may be shared between threads: the underlying
+        requests session is created exactly once, and its connection
+        pool is sized by pool_connections (number of per-host pools to
+        keep), pool_maxsize (connections kept per host) and pool_block
+        (whether to wait for a free connection instead of opening a
+        throwaway one once pool_maxsize are in use).  Set pool_maxsize
+        to at least the number of threads sharing the client.
+
+        If cache_ttl is set, the responses of a few read-mostly
+        endpoints (get_stream_id, get_members, get_user_by_id,
+        get_subscriptions, get_realm_emoji and get_server_settings) are
+        cached for up to cache_ttl seconds, keeping at most
+        cache_maxsize of them.  Requests made through this client, and
+        the events received by call_on_each_event, invalidate the
+        cached responses they may have changed.
+
+        Requests are paced to stay within the rate limit the server
+        reports (see RateLimiter), and requests that hit it anyway
+        are retried after the delay the server asks for, if
+        retry_on_errors is set.  client.rate_limiter.stats() returns
+        the remaining budget.
+
+        Once each request is done, the functions in client.request_hooks
+        are called with its RequestRecord, e.g. to collect metrics with
+        zulip.metrics.RequestMetrics.
+
+        Request bodies of GZIP_MIN_SIZE bytes or more are sent
+        gzip-compressed if compress_requests is set, or, if it is None,
+        once the server has advertised that it accepts them with an
+        Accept-Encoding response header (RFC 7694).  If the server
+        turns a compressed body down, with a 415 response, or with a 400
+        response that the uncompressed body doesn't get too, the request
+        is sent again uncompressed, and so are the later ones.
+
+        Requests go through a requests session, over HTTP/1.1, unless
+        `transport` says otherwise: "http2" sends them with
+        zulip.http2.HTTP2Transport (which needs httpx and h2), which
+        multiplexes concurrent requests, including a long-poll, over
+        one connection per server; a function taking the client and
+        returning a Transport plugs in any other.
+        """
         if client is None:
             client = _default_client()
 
@@ -436,6 +1196,30 @@ class Client:
                 client_cert_key = config.get("api", "client_cert_key")
             if cert_bundle is None and config.has_option("api", "cert_bundle"):
                 cert_bundle = config.get("api", "cert_bundle")
+            if pool_connections is None and config.has_option("api", "pool_connections"):
+                pool_connections = read_positive_int_option(config, "pool_connections")
+            if pool_maxsize is None and config.has_option("api", "pool_maxsize"):
+                pool_maxsize = read_positive_int_option(config, "pool_maxsize")
+            if pool_block is None and config.has_option("api", "pool_block"):
+                pool_block_setting = config.get("api", "pool_block")
+                pool_block = validate_boolean_field(pool_block_setting)
+
+                if pool_block is None:
+                    raise ZulipError(
+                        f"pool_block is set to '{pool_block_setting}', it must be "
+                        f"'true' or 'false' if it is used in {config_file}"
+                    )
+            if compress_requests is None and config.has_option("api", "compress_requests"):
+                compress_requests_setting = config.get("api", "compress_requests")
+                compress_requests = validate_boolean_field(compress_requests_setting)
+
+                if compress_requests is None:
+                    raise ZulipError(
+                        f"compress_requests is set to '{compress_requests_setting}', it must "
+                        f"be 'true' or 'false' if it is used in {config_file}"
+                    )
+            if transport is None and config.has_option("api", "transport"):
+                transport = config.get("api", "transport")
             if insecure is None and config.has_option("api", "insecure"):
                 # Be quite strict about what is accepted so that users don't
                 # disable security unintentionally.
@@ -503,13 +1287,41 @@ class Client:
         self.client_cert = client_cert
         self.client_cert_key = client_cert_key
 
-        self.session: Optional[requests.Session] = None
+        self.pool_connections = (
+            pool_connections if pool_connections is not None else DEFAULT_POOL_SIZE
+        )
+        self.pool_maxsize = pool_maxsize if pool_maxsize is not None else DEFAULT_POOL_SIZE
+        self.pool_block = pool_block if pool_block is not None else DEFAULT_POOL_BLOCK
+
+        if isinstance(transport, str) and transport not in ("requests", "http2"):
+            raise ZulipError(f"transport is set to '{transport}', it must be 'requests' or 'http2'")
+        self.transport = transport
+        self.session: Union[None, "requests.Session", Transport] = None
+        self.session_lock = threading.Lock()
 
         self.has_connected = False
 
-        server_settings = self.get_server_settings()
-        self.zulip_version: Optional[str] = server_settings.get("zulip_version")
-        self.feature_level: int = server_settings.get("zulip_feature_level", 0)
+        self.rate_limiter = RateLimiter()
+
+        self.compress_requests = compress_requests
+        self.server_accepts_gzip = False
+
+        self.request_hooks: List[Callable[[RequestRecord], None]] = []
+
+        self.response_cache: Optional[ResponseCache] = None
+        if cache_ttl is not None:
+            self.response_cache = ResponseCache(cache_ttl, cache_maxsize)
+
+        self.zulip_version: Optional[str] = None
+        self.feature_level: int = 0
+        self.load_server_settings()
+
+    def load_server_settings(self) -> None:
+        self.set_server_settings(self.get_server_settings())
+
+    def set_server_settings(self, server_settings: Dict[str, Any]) -> None:
+        self.zulip_version = server_settings.get("zulip_version")
+        self.feature_level = server_settings.get("zulip_feature_level", 0)
         assert self.zulip_version is not None
 
     def ensure_session(self) -> None:
@@ -518,6 +1330,25 @@ class Client:
         if self.session:
             return
 
+        with self.session_lock:
+            # Another thread may have created the session while we
+            # were waiting for the lock.
+            if self.session:
+                return
+            self.session = self.make_session()
+
+    def make_session(self) -> Union["requests.Session", Transport]:
+        if self.transport == "http2":
+            from zulip.http2 import HTTP2Transport
+
+            return HTTP2Transport(self)
+        if callable(self.transport):
+            return self.transport(self)
+
+        import requests
+
+        from zulip.connections import TimedHTTPAdapter
+
         # Build a client cert object for requests
         if self.client_cert_key is not None:
             assert self.client_cert is not None  # Otherwise ZulipError near end of __init__
@@ -534,9 +1365,38 @@ class Client:
         session.verify = self.tls_verification
         session.cert = client_cert
         session.headers.update({"User-agent": self.get_user_agent()})
-        self.session = session
+
+        # Keep-alive connections are pooled per host; share one
+        # adapter between both schemes.
+        adapter = TimedHTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block,
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def get_ssl_context(self) -> Union[bool, "ssl.SSLContext"]:
+        """
+        The TLS settings of the client, for the transports that take
+        them as an SSLContext rather than the way requests does.
+        """
+        import ssl
+
+        if self.tls_verification is False:
+            return False
+        if isinstance(self.tls_verification, str):
+            context = ssl.create_default_context(cafile=self.tls_verification)
+        else:
+            context = ssl.create_default_context()
+        if self.client_cert is not None:
+            context.load_cert_chain(self.client_cert, self.client_cert_key)
+        return context
 
     def get_user_agent(self) -> str:
+        import platform
+
         vendor = ""
         vendor_version = ""
         try:
@@ -548,6 +1408,8 @@ class Client:
             pass
 
         if vendor == "Linux":
+            import distro
+
             vendor, vendor_version, dummy = distro.linux_distribution()
         elif vendor == "Windows":
             vendor_version = platform.win32_ver()[1]
@@ -564,7 +1426,50 @@ class Client:
         longpolling: bool = False,
         files: Optional[List[IO[Any]]] = None,
         timeout: Optional[float] = None,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
     ) -> Dict[str, Any]:
+        res = self.do_api_request(
+            orig_request,
+            url,
+            method=method,
+            longpolling=longpolling,
+            files=files,
+            timeout=timeout,
+            progress_callback=progress_callback,
+        )
+        try:
+            return res.json()
+        except Exception:
+            return {
+                "msg": "Unexpected error from the server",
+                "result": "http-error",
+                "status_code": res.status_code,
+            }
+
+    def do_api_request(
+        self,
+        orig_request: Mapping[str, Any],
+        url: str,
+        method: str = "POST",
+        longpolling: bool = False,
+        files: Optional[List[IO[Any]]] = None,
+        timeout: Optional[float] = None,
+        stream: bool = False,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+    ) -> "requests.Response":
+        """
+        Makes the request, retrying as configured, and returns the
+        response without reading it; with stream=True, the body is
+        only downloaded as the caller reads it.
+
+        `files` are streamed from disk as they are uploaded, and
+        `progress_callback`, if given, is called with the number of
+        bytes of the request body sent so far and its total size.
+        """
+        import requests
+
+        from zulip.connections import thread_connect_time
+
         if files is None:
             files = []
 
@@ -574,24 +1479,26 @@ class Client:
         # Otherwise, 15s should be plenty of time.
         request_timeout = 90.0 if longpolling else timeout or 15.0
 
-        request = {
-            key: val if isinstance(val, str) else json.dumps(val)
-            for key, val in orig_request.items()
-        }
+        # Encoded once, to be sent as is by every attempt.
+        request = EncodedRequest(orig_request)
 
-        req_files = [(f.name, f) for f in files]
+        body = MultipartEncoder(request.fields, files, progress_callback) if files else None
 
         self.ensure_session()
         assert self.session is not None
 
         query_state: Dict[str, Any] = {
             "had_error_retry": False,
-            "request": request,
             "failures": 0,
+            "attempts": 0,
+            # Whether the compressed body was answered with a 400.
+            "retry_uncompressed": False,
         }
+        record = RequestRecord(url, method)
+        connect_time = thread_connect_time()
 
         def error_retry(error_string: str) -> bool:
-            if not self.retry_on_errors or query_state["failures"] >= 10:
+            if not self.retry_on_errors or query_state["failures"] >= MAX_ERROR_RETRIES:
                 return False
             if self.verbose:
                 if not query_state["had_error_retry"]:
@@ -605,8 +1512,9 @@ class Client:
                 else:
                     sys.stdout.write(".")
                 sys.stdout.flush()
-            query_state["request"]["dont_block"] = json.dumps(True)
+            request.set("dont_block", True)
             time.sleep(1)
+            record.backoff_time += 1
             query_state["failures"] += 1
             return True
 
@@ -617,77 +1525,174 @@ class Client:
                 else:
                     print("Failed!")
 
-        while True:
-            try:
-                kwarg = "params" if method == "GET" else "data"
-
-                kwargs = {kwarg: query_state["request"]}
-
-                if files:
-                    kwargs["files"] = req_files
-
-                # Actually make the request!
-                res = self.session.request(
-                    method,
-                    urllib.parse.urljoin(self.base_url, url),
-                    timeout=request_timeout,
-                    **kwargs,
-                )
+        try:
+            while True:
+                record.retries = query_state["attempts"]
+                query_state["attempts"] += 1
+                delay = self.rate_limiter.reserve()
+                if delay > 0:
+                    time.sleep(delay)
+                    record.backoff_time += delay
+
+                compressed = False
+                try:
+                    kwargs: Dict[str, Any] = {}
+                    if body is not None:
+                        # Retries must send the files from the start again.
+                        body.rewind()
+                        kwargs["data"] = body
+                        kwargs["headers"] = {"Content-Type": body.content_type}
+                    elif method == "GET":
+                        kwargs["params"] = request.body()
+                    else:
+                        compressed = (
+                            self.should_compress(len(request.body()))
+                            and not query_state["retry_uncompressed"]
+                        )
+                        kwargs["headers"] = {"Content-Type": "application/x-www-form-urlencoded"}
+                        if compressed:
+                            kwargs["data"] = request.gzipped_body()
+                            kwargs["headers"]["Content-Encoding"] = "gzip"
+                        else:
+                            kwargs["data"] = request.body()
+
+                    # Actually make the request!
+                    attempt_connect_time = thread_connect_time()
+                    res = self.session.request(
+                        method,
+                        urllib.parse.urljoin(self.base_url, url),
+                        timeout=request_timeout,
+                        stream=stream,
+                        **kwargs,
+                    )
 
-                self.has_connected = True
+                    self.has_connected = True
+                    self.rate_limiter.update(res.headers)
+                    self.update_accepted_encodings(res.headers)
+                    record.status = res.status_code
+                    # elapsed includes opening a connection, if the
+                    # request needed a new one.
+                    record.ttfb = max(
+                        0.0,
+                        res.elapsed.total_seconds()
+                        - (thread_connect_time() - attempt_connect_time),
+                    )
+                    if res.request is not None:
+                        record.bytes_sent = request_body_size(res.request.body)
+
+                    # When rate-limited, wait as long as the server asks,
+                    # and try again, as many times as after server errors.
+                    if (
+                        res.status_code == 429
+                        and self.retry_on_errors
+                        and query_state["failures"] < MAX_ERROR_RETRIES
+                    ):
+                        try:
+                            response_json = res.json()
+                        except ValueError:
+                            response_json = None
+                        retry_after = get_retry_after(response_json, res.headers)
+                        if self.verbose:
+                            print(f"zulip API: rate limited -- retrying in {retry_after}s.")
+                        self.rate_limiter.record_rate_limited(retry_after)
+                        query_state["failures"] += 1
+                        continue
+
+                    if res.status_code == 415 and compressed:
+                        self.refuse_compression()
+                        continue
+                    # Servers that don't decode compressed bodies may
+                    # reject them as bad requests; find out if it was the
+                    # compression by sending the body uncompressed once.
+                    if res.status_code == 400 and compressed:
+                        query_state["retry_uncompressed"] = True
+                        continue
+                    # The uncompressed body wasn't a bad request, unless
+                    # it got a 400 too.
+                    if (
+                        query_state["retry_uncompressed"]
+                        and res.status_code != 400
+                        and res.status_code < 500
+                    ):
+                        self.refuse_compression()
+                        query_state["retry_uncompressed"] = False
 
-                # On 50x errors, try again after a short sleep
-                if str(res.status_code).startswith("5") and error_retry(
-                    f" (server {res.status_code})"
-                ):
-                    continue
-                # Otherwise fall through and process the python-requests error normally
-            except (requests.exceptions.Timeout, requests.exceptions.SSLError) as e:
-                # Timeouts are either a Timeout or an SSLError; we
-                # want the later exception handlers to deal with any
-                # non-timeout other SSLErrors
-                if (
-                    isinstance(e, requests.exceptions.SSLError)
-                    and str(e) != "The read operation timed out"
-                ):
-                    raise UnrecoverableNetworkError("SSL Error") from e
-                if longpolling:
-                    # When longpolling, we expect the timeout to fire,
-                    # and the correct response is to just retry
-                    continue
-                else:
+                    # On 50x errors, try again after a short sleep
+                    if str(res.status_code).startswith("5") and error_retry(
+                        f" (server {res.status_code})"
+                    ):
+                        continue
+                    # Otherwise fall through and process the python-requests error normally
+                except (requests.exceptions.Timeout, requests.exceptions.SSLError) as e:
+                    # Timeouts are either a Timeout or an SSLError; we
+                    # want the later exception handlers to deal with any
+                    # non-timeout other SSLErrors
+                    if (
+                        isinstance(e, requests.exceptions.SSLError)
+                        and str(e) != "The read operation timed out"
+                    ):
+                        raise UnrecoverableNetworkError("SSL Error") from e
+                    if longpolling:
+                        # When longpolling, we expect the timeout to fire,
+                        # and the correct response is to just retry
+                        continue
+                    else:
+                        end_error_retry(False)
+                        raise
+                except requests.exceptions.ConnectionError as e:
+                    if not self.has_connected:
+                        # If we have never successfully connected to the server, don't
+                        # go into retry logic, because the most likely scenario here is
+                        # that somebody just hasn't started their server, or they passed
+                        # in an invalid site.
+                        raise UnrecoverableNetworkError(
+                            "cannot connect to server " + self.base_url
+                        ) from e
+
+                    if error_retry(""):
+                        continue
                     end_error_retry(False)
                     raise
-            except requests.exceptions.ConnectionError as e:
-                if not self.has_connected:
-                    # If we have never successfully connected to the server, don't
-                    # go into retry logic, because the most likely scenario here is
-                    # that somebody just hasn't started their server, or they passed
-                    # in an invalid site.
-                    raise UnrecoverableNetworkError(
-                        "cannot connect to server " + self.base_url
-                    ) from e
-
-                if error_retry(""):
-                    continue
-                end_error_retry(False)
-                raise
-            except Exception:
-                # We'll split this out into more cases as we encounter new bugs.
-                raise
+                except Exception:
+                    # We'll split this out into more cases as we encounter new bugs.
+                    raise
 
+                end_error_retry(True)
+                if not stream:
+                    record.bytes_received = len(res.content)
+                elif res.headers.get("Content-Length", "").isdigit():
+                    # The body is only read later, by the caller.
+                    record.bytes_received = int(res.headers["Content-Length"])
+                return res
+        except BaseException as e:
+            record.error = type(e).__name__
+            raise
+        finally:
+            record.connect_time = thread_connect_time() - connect_time
+            record.finish()
+            self.report_request(record)
+
+    def should_compress(self, size: int) -> bool:
+        if size < GZIP_MIN_SIZE or self.compress_requests is False:
+            return False
+        return self.compress_requests or self.server_accepts_gzip
+
+    def update_accepted_encodings(self, headers: Mapping[str, str]) -> None:
+        # Servers list the encodings they accept for request bodies in
+        # the Accept-Encoding header of their responses (RFC 7694).
+        if not self.server_accepts_gzip and "gzip" in headers.get("Accept-Encoding", "").lower():
+            self.server_accepts_gzip = True
+
+    def refuse_compression(self) -> None:
+        logger.warning("The server does not accept compressed requests; no longer compressing them")
+        self.compress_requests = False
+
+    def report_request(self, record: RequestRecord) -> None:
+        for hook in self.request_hooks:
             try:
-                json_result = res.json()
+                hook(record)
             except Exception:
-                end_error_retry(False)
-                return {
-                    "msg": "Unexpected error from the server",
-                    "result": "http-error",
-                    "status_code": res.status_code,
-                }
-
-            end_error_retry(True)
-            return json_result
+                logger.exception("Request hook %r failed", hook)
 
     def call_endpoint(
         self,
@@ -697,6 +1702,7 @@ class Client:
         longpolling: bool = False,
         files: Optional[List[IO[Any]]] = None,
         timeout: Optional[float] = None,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
     ) -> Dict[str, Any]:
         if request is None:
             request = dict()
@@ -705,25 +1711,109 @@ class Client:
             if v is not None:
                 marshalled_request[k] = v
         versioned_url = API_VERSTRING + (url if url is not None else "")
-        return self.do_api_query(
+        cache_key = self.get_cache_key(url, method, marshalled_request)
+        if cache_key is not None:
+            assert self.response_cache is not None
+            cached_response = self.response_cache.get(cache_key)
+            if cached_response is not None:
+                return cached_response
+        response = self.do_api_query(
             marshalled_request,
             versioned_url,
             method=method,
             longpolling=longpolling,
             files=files,
             timeout=timeout,
+            progress_callback=progress_callback,
         )
+        if cache_key is not None:
+            assert self.response_cache is not None
+            self.response_cache.put(cache_key, response)
+        return response
+
+    def get_cache_key(
+        self, url: Optional[str], method: str, request: Mapping[str, Any]
+    ) -> Optional[Tuple[str, str, str]]:
+        """
+        Returns the key to cache the response to this request under,
+        if it should be cached; otherwise, invalidates the cached
+        responses that the request may change.
+        """
+        if self.response_cache is None or url is None:
+            return None
+        if method != "GET":
+            for pattern, tags in CACHE_INVALIDATING_REQUESTS:
+                if pattern.match(url):
+                    self.response_cache.invalidate(tags)
+            return None
+        for pattern, tag in CACHED_ENDPOINTS:
+            if pattern.match(url):
+                return (tag, url, json.dumps(request, sort_keys=True))
+        return None
+
+    def invalidate_cache_for_event(self, event: Dict[str, Any]) -> None:
+        if self.response_cache is not None and event["type"] in CACHE_INVALIDATING_EVENTS:
+            self.response_cache.invalidate(CACHE_INVALIDATING_EVENTS[event["type"]])
 
     def call_on_each_event(
         self,
         callback: Callable[[Dict[str, Any]], None],
         event_types: Optional[List[str]] = None,
         narrow: Optional[List[List[str]]] = None,
+        queue_id: Optional[str] = None,
+        last_event_id: int = -1,
+        max_backoff: float = 90.0,
+        progress_callback: Optional[Callable[[str, int], None]] = None,
+        num_workers: int = 0,
+        max_buffered_events: int = 1000,
+        ordering_key: Optional[Callable[[Dict[str, Any]], Hashable]] = None,
+        register_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
         **kwargs: object,
     ) -> None:
+        """
+        Registers an event queue and calls `callback` on each event
+        received, forever.  Other keyword arguments are passed to
+        register(), and `register_callback`, if given, is called with
+        the response each time a queue is registered (e.g. to load the
+        initial state requested with fetch_event_types).
+
+        Pass the `queue_id` and `last_event_id` of an existing queue to
+        resume it instead of registering a new one; a new queue is
+        only registered if the server no longer has that one.  To
+        learn what to persist, pass a `progress_callback`; it is called
+        with the current queue_id and last_event_id after each batch of
+        events has been handed to `callback`.
+
+        Errors are retried with randomized exponential backoff of up
+        to `max_backoff` seconds, and after an error the queue is
+        polled with dont_block, so that events that arrived in the
+        meantime are fetched immediately.
+
+        By default, `callback` runs in the calling thread, between
+        long-polls.  With `num_workers` > 0, it runs on that many
+        worker threads instead (see EventWorkerPool), so a slow
+        callback doesn't hold up fetching; `max_buffered_events` and
+        `ordering_key` are passed on to the pool.  For example,
+        ordering_key=lambda event: event.get("message", {}).get("sender_id")
+        keeps each sender's messages in order (and handles all other
+        events in order too).  When this returns or raises, the events
+        already fetched are handled before the workers are stopped.
+        """
+        import requests
+
         if narrow is None:
             narrow = []
 
+        workers = None
+        if num_workers > 0:
+            workers = EventWorkerPool(
+                callback, num_workers, max_buffered_events, ordering_key, progress_callback
+            )
+
+        # The number of retries only matters for how far the delay can
+        # grow; we never give up, and delay_cap bounds the delay.
+        backoff = RandomExponentialBackoff(maximum_retries=40, delay_cap=max_backoff)
+
         def do_register() -> Tuple[str, int]:
             while True:
                 if event_types is None:
@@ -733,81 +1823,194 @@ class Client:
                 if "error" in res["result"]:
                     if self.verbose:
                         print("Server returned error:\n{}".format(res["msg"]))
-                    time.sleep(1)
+                    backoff.fail()
                 else:
+                    if register_callback is not None:
+                        register_callback(res)
                     return (res["queue_id"], res["last_event_id"])
 
-        queue_id = None
-        # Make long-polling requests with `get_events`. Once a request
-        # has received an answer, pass it to the callback and before
-        # making a new long-polling request.
-        while True:
-            if queue_id is None:
-                queue_id, last_event_id = do_register()
-
-            try:
-                res = self.get_events(queue_id=queue_id, last_event_id=last_event_id)
-            except (
-                requests.exceptions.Timeout,
-                requests.exceptions.SSLError,
-                requests.exceptions.ConnectionError,
-            ):
-                if self.verbose:
-                    print(f"Connection error fetching events:\n{traceback.format_exc()}")
-                # TODO: Make this use our backoff library
-                time.sleep(1)
-                continue
-            except Exception:
-                print(f"Unexpected error:\n{traceback.format_exc()}")
-                # TODO: Make this use our backoff library
-                time.sleep(1)
-                continue
-
-            if "error" in res["result"]:
-                if res["result"] == "http-error":
-                    if self.verbose:
-                        print("HTTP error fetching events -- probably a server restart")
-                else:
+        try:
+            dont_block = False
+            # Make long-polling requests with `get_events`. Once a request
+            # has received an answer, pass it to the callback and before
+            # making a new long-polling request.
+            while True:
+                if queue_id is None:
+                    queue_id, last_event_id = do_register()
+
+                request: Dict[str, Any] = dict(queue_id=queue_id, last_event_id=last_event_id)
+                if dont_block:
+                    request["dont_block"] = True
+                try:
+                    res = self.get_events(**request)
+                except (
+                    requests.exceptions.Timeout,
+                    requests.exceptions.SSLError,
+                    requests.exceptions.ConnectionError,
+                ):
                     if self.verbose:
-                        print("Server returned error:\n{}".format(res["msg"]))
-                    # Eventually, we'll only want the
-                    # BAD_EVENT_QUEUE_ID check, but we check for the
-                    # old string to support legacy Zulip servers.  We
-                    # should remove that legacy check in 2019.
-                    if res.get("code") == "BAD_EVENT_QUEUE_ID" or res["msg"].startswith(
-                        "Bad event queue id:"
-                    ):
-                        # Our event queue went away, probably because
-                        # we were asleep or the server restarted
-                        # abnormally.  We may have missed some
-                        # events while the network was down or
-                        # something, but there's not really anything
-                        # we can do about it other than resuming
-                        # getting new ones.
-                        #
-                        # Reset queue_id to register a new event queue.
-                        queue_id = None
-                # Add a pause here to cover against potential bugs in this library
-                # causing a DoS attack against a server when getting errors.
-                # TODO: Make this back off exponentially.
-                time.sleep(1)
-                continue
+                        print(f"Connection error fetching events:\n{traceback.format_exc()}")
+                    backoff.fail()
+                    dont_block = True
+                    continue
+                except Exception:
+                    print(f"Unexpected error:\n{traceback.format_exc()}")
+                    backoff.fail()
+                    dont_block = True
+                    continue
 
-            for event in res["events"]:
-                last_event_id = max(last_event_id, int(event["id"]))
+                if "error" in res["result"]:
+                    if res["result"] == "http-error":
+                        if self.verbose:
+                            print("HTTP error fetching events -- probably a server restart")
+                    else:
+                        if self.verbose:
+                            print("Server returned error:\n{}".format(res["msg"]))
+                        # Eventually, we'll only want the
+                        # BAD_EVENT_QUEUE_ID check, but we check for the
+                        # old string to support legacy Zulip servers.  We
+                        # should remove that legacy check in 2019.
+                        if res.get("code") == "BAD_EVENT_QUEUE_ID" or res["msg"].startswith(
+                            "Bad event queue id:"
+                        ):
+                            # Our event queue went away, probably because
+                            # we were asleep or the server restarted
+                            # abnormally.  We may have missed some
+                            # events while the network was down or
+                            # something, but there's not really anything
+                            # we can do about it other than resuming
+                            # getting new ones.
+                            #
+                            # Reset queue_id to register a new event queue.
+                            queue_id = None
+                    # Back off here to cover against potential bugs in this
+                    # library causing a DoS attack against a server when
+                    # getting errors, and to spread out reconnects after a
+                    # server restart.
+                    backoff.fail()
+                    dont_block = True
+                    continue
+
+                backoff.succeed()
+                dont_block = False
+
+                events = []
+                for event in res["events"]:
+                    last_event_id = max(last_event_id, int(event["id"]))
+
+                    if event["type"] == "heartbeat":
+                        # Heartbeat events are sent to clients regardless
+                        # of the client's requested event types, and are
+                        # intended to be an internal part of the Zulip
+                        # longpolling protocol, not something that clients
+                        # need to handle.
+                        continue
+
+                    self.invalidate_cache_for_event(event)
+                    if workers is None:
+                        callback(event)
+                    else:
+                        events.append(event)
+
+                if workers is not None:
+                    workers.submit(queue_id, last_event_id, events)
+                elif progress_callback is not None:
+                    progress_callback(queue_id, last_event_id)
+        finally:
+            # Once the consumer stops, e.g. because the callback raised.
+            if workers is not None:
+                workers.close()
+
+    def call_on_each_event_batch(
+        self,
+        callback: Callable[[List[Dict[str, Any]]], None],
+        max_batch: int = 100,
+        max_wait: float = 1.0,
+        event_types: Optional[List[str]] = None,
+        narrow: Optional[List[List[str]]] = None,
+        progress_callback: Optional[Callable[[str, int], None]] = None,
+        **kwargs: Any,
+    ) -> None:
+        """
+        Like call_on_each_event, whose other arguments it takes, but
+        calls `callback` with lists of events, in order, rather than
+        with each of them; e.g. to write them to a database in one
+        transaction.  A batch is delivered once it has `max_batch`
+        events, or `max_wait` seconds after its first event arrived,
+        whichever comes first, so it can gather the events of several
+        long-polling responses.  Heartbeat events are left out.
+
+        The events are fetched in a background thread, while
+        `callback` runs in the calling thread.  `progress_callback` is
+        only called once the events it covers have all been delivered.
+        """
+        # Either an event, the (queue_id, last_event_id) of the
+        # response it was part of, or an exception to raise.
+        items: "queue.Queue[Union[Dict[str, Any], Tuple[str, int], BaseException]]" = queue.Queue(
+            2 * max_batch
+        )
+        stop = threading.Event()
 
-                if event["type"] == "heartbeat":
-                    # Heartbeat events are sent to clients regardless
-                    # of the client's requested event types, and are
-                    # intended to be an internal part of the Zulip
-                    # longpolling protocol, not something that clients
-                    # need to handle.
+        def put(item: Union[Dict[str, Any], Tuple[str, int], BaseException]) -> None:
+            while True:
+                if stop.is_set():
+                    raise StopFetchingEventsError
+                try:
+                    items.put(item, timeout=0.1)
+                except queue.Full:
                     continue
+                return
+
+        def fetch_events() -> None:
+            try:
+                self.call_on_each_event(
+                    put,
+                    event_types,
+                    narrow,
+                    progress_callback=lambda queue_id, last_event_id: put(
+                        (queue_id, last_event_id)
+                    ),
+                    **kwargs,
+                )
+            except StopFetchingEventsError:
+                pass
+            except BaseException as e:
+                put(e)
 
-                callback(event)
+        thread = threading.Thread(target=fetch_events, name="zulip-event-batches", daemon=True)
+        thread.start()
+
+        batch: List[Dict[str, Any]] = []
+        progress: Optional[Tuple[str, int]] = None
+        deadline = 0.0
+        try:
+            while True:
+                try:
+                    item = items.get(timeout=max(deadline - time.monotonic(), 0) if batch else None)
+                except queue.Empty:
+                    item = None
+                if isinstance(item, BaseException):
+                    raise item
+                if isinstance(item, dict):
+                    if not batch:
+                        deadline = time.monotonic() + max_wait
+                    batch.append(item)
+                elif item is not None:
+                    progress = item
+
+                if batch and (item is None or len(batch) >= max_batch):
+                    callback(batch)
+                    batch = []
+                if not batch and progress is not None:
+                    # Every event before this point has been delivered.
+                    if progress_callback is not None:
+                        progress_callback(*progress)
+                    progress = None
+        finally:
+            stop.set()
 
     def call_on_each_message(
-        self, callback: Callable[[Dict[str, Any]], None], **kwargs: object
+        self, callback: Callable[[Dict[str, Any]], None], **kwargs: Any
     ) -> None:
         def event_callback(event: Dict[str, Any]) -> None:
             if event["type"] == "message":
@@ -821,6 +2024,142 @@ class Client:
         """
         return self.call_endpoint(url="messages", method="GET", request=message_filters)
 
+    def iter_messages(
+        self,
+        narrow: Optional[List[Dict[str, Any]]] = None,
+        batch_size: int = 1000,
+        anchor: Union[int, str] = "newest",
+        **request: Any,
+    ) -> Generator[Dict[str, Any], None, Dict[str, Any]]:
+        """
+        Fetches up to `batch_size` messages matching `narrow`, up to
+        `anchor` (see get_messages; other parameters are passed through),
+        and yields them one at a time while the response is still
+        being downloaded, instead of decoding it whole first.
+
+        The generator's return value is the rest of the response
+        (`found_oldest`, `found_anchor`, ...); an error response
+        raises ZulipError.
+        """
+        request = {
+            "anchor": anchor,
+            "num_before": batch_size,
+            "num_after": 0,
+            "narrow": narrow,
+            **request,
+        }
+        res = self.do_api_request(
+            {key: val for key, val in request.items() if val is not None},
+            API_VERSTRING + "messages",
+            method="GET",
+            stream=True,
+        )
+        decoder = StreamingArrayDecoder("messages")
+        with res:
+            for chunk in res.iter_content(chunk_size=64 * 1024):
+                yield from decoder.feed(chunk)
+        try:
+            result = decoder.close()
+        except ValueError:
+            result = {
+                "msg": "Unexpected error from the server",
+                "result": "http-error",
+                "status_code": res.status_code,
+            }
+        if result["result"] != "success":
+            raise ZulipError(result["msg"])
+        return result
+
+    def iter_history(
+        self,
+        narrow: Optional[List[Dict[str, Any]]] = None,
+        direction: Literal["older", "newer"] = "older",
+        page_size: int = 1000,
+        start_anchor: Optional[Union[int, str]] = None,
+        **request: Any,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Yields every message matching `narrow`, starting at
+        `start_anchor` (by default, the newest message when going
+        "older", and the oldest when going "newer") and moving in
+        `direction`, one page of `page_size` messages at a time.
+
+        The next page is fetched in a background thread while the
+        current one is being consumed, and at most one page is
+        buffered ahead, so memory use stays bounded however long the
+        history is.
+
+        >>> for message in client.iter_history(narrow, direction="newer"):
+        ...     index(message)
+        """
+        if start_anchor is None:
+            start_anchor = "newest" if direction == "older" else "oldest"
+
+        pages: "queue.Queue[Union[List[Dict[str, Any]], Exception, None]]" = queue.Queue(1)
+        stop = threading.Event()
+
+        def put_page(page: Union[List[Dict[str, Any]], Exception, None]) -> None:
+            # Give up once the consumer has gone away.
+            while not stop.is_set():
+                try:
+                    pages.put(page, timeout=0.1)
+                except queue.Full:
+                    continue
+                return
+
+        def fetch_pages() -> None:
+            anchor = start_anchor
+            include_anchor = True
+            try:
+                while not stop.is_set():
+                    messages, found_end = self._get_history_page(
+                        narrow, direction, page_size, anchor, include_anchor, request
+                    )
+                    if not messages:
+                        break
+                    anchor = messages[-1]["id"]
+                    include_anchor = False
+                    put_page(messages)
+                    if found_end:
+                        break
+            except Exception as e:
+                put_page(e)
+            put_page(None)
+
+        threading.Thread(target=fetch_pages, name="zulip-history-prefetch", daemon=True).start()
+        try:
+            while True:
+                page = pages.get()
+                if page is None:
+                    return
+                if isinstance(page, Exception):
+                    raise page
+                yield from page
+        finally:
+            stop.set()
+
+    def _get_history_page(
+        self,
+        narrow: Optional[List[Dict[str, Any]]],
+        direction: str,
+        page_size: int,
+        anchor: Union[int, str],
+        include_anchor: bool,
+        request: Dict[str, Any],
+    ) -> Tuple[List[Dict[str, Any]], bool]:
+        page_request = dict(request, **history_page_request(direction, page_size))
+        if not include_anchor and self.feature_level >= 155:
+            page_request["include_anchor"] = False
+        result_messages = self.iter_messages(narrow, page_size, anchor, **page_request)
+        messages = []
+        while True:
+            try:
+                messages.append(next(result_messages))
+            except StopIteration as e:
+                result = e.value
+                break
+        return history_page_messages(messages, result, direction, anchor, include_anchor)
+
     def check_messages_match_narrow(self, **request: Dict[str, Any]) -> Dict[str, Any]:
         """
         Example usage:
@@ -847,11 +2186,116 @@ class Client:
             request=message_data,
         )
 
-    def upload_file(self, file: IO[Any]) -> Dict[str, Any]:
+    def send_messages(
+        self, messages: Iterable[Dict[str, Any]], max_in_flight: int = 8
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Sends many messages concurrently, using up to max_in_flight
+        pooled connections, and yields one response per message, in
+        the order of `messages`.  Messages to the same recipient (the
+        same stream and topic, or the same set of users) are still
+        sent one after another, so they appear in order.
+
+        A message that could not be sent because of a network error
+        yields an error response instead of stopping the batch.
+
+        Example usage:
+
+        >>> for response in client.send_messages(messages, max_in_flight=16):
+        ...     if response["result"] != "success":
+        ...         print(response["msg"])
+        """
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            pending: Deque[Tuple[Hashable, "Future[Dict[str, Any]]"]] = deque()
+            # The last message sent to each recipient, while it's pending.
+            last_send_to: Dict[Hashable, "Future[Dict[str, Any]]"] = {}
+
+            def next_response() -> Dict[str, Any]:
+                recipient, future = pending.popleft()
+                if last_send_to.get(recipient) is future:
+                    del last_send_to[recipient]
+                return future.result()
+
+            for message in messages:
+                recipient = message_recipient_key(message)
+                previous = last_send_to.get(recipient)
+                future = executor.submit(self._send_message_after, previous, message)
+                last_send_to[recipient] = future
+                pending.append((recipient, future))
+                # Don't read ahead of the caller by more than a couple of
+                # windows, so that arbitrarily long iterables stream.
+                while len(pending) > 2 * max_in_flight:
+                    yield next_response()
+            while pending:
+                yield next_response()
+
+    def _send_message_after(
+        self, previous: Optional["Future[Dict[str, Any]]"], message: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        if previous is not None:
+            # The executor starts tasks in submission order, so `previous`
+            # is already running or done; this never deadlocks.
+            previous.result()
+        import requests
+
+        try:
+            return self.send_message(message)
+        except (ZulipError, requests.exceptions.RequestException) as e:
+            return {"result": "error", "msg": f"Error sending message: {e}"}
+
+    def upload_file(
+        self, file: IO[Any], progress_callback: Optional[Callable[[int, int], None]] = None
+    ) -> Dict[str, Any]:
         """
         See examples/upload-file for example usage.
+
+        The file is streamed as it is uploaded, so it never has to fit
+        in memory; `progress_callback`, if given, is called with the
+        number of bytes sent so far and the total.
         """
-        return self.call_endpoint(url="user_uploads", files=[file])
+        return self.call_endpoint(
+            url="user_uploads", files=[file], progress_callback=progress_callback
+        )
+
+    def upload_files(
+        self,
+        paths: Iterable[str],
+        max_parallel: int = 4,
+        progress_callback: Optional[Callable[[str, int, int], None]] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Uploads the files at `paths`, up to `max_parallel` at a time,
+        and returns the upload_file response for each of them, in
+        order.  Errors are returned as error responses rather than
+        raised.  `progress_callback`, if given, is called with the
+        path, the number of bytes sent so far and the total.
+
+        Set the client's pool_maxsize to at least max_parallel, so
+        that each upload keeps its connection alive.
+        """
+        with ThreadPoolExecutor(
+            max_workers=max_parallel, thread_name_prefix="zulip-upload"
+        ) as executor:
+            futures = [
+                executor.submit(self._upload_path, path, progress_callback) for path in paths
+            ]
+            return [future.result() for future in futures]
+
+    def _upload_path(
+        self, path: str, progress_callback: Optional[Callable[[str, int, int], None]]
+    ) -> Dict[str, Any]:
+        file_progress_callback = None
+        if progress_callback is not None:
+
+            def file_progress_callback(sent: int, total: int) -> None:
+                progress_callback(path, sent, total)
+
+        try:
+            with open(path, "rb") as f:
+                return self.upload_file(f, file_progress_callback)
+        except (ZulipError, OSError) as e:
+            # OSError includes the requests exceptions.
+            return {"result": "error", "msg": f"Error uploading {path}: {e}"}
 
     def get_attachments(self) -> Dict[str, Any]:
         """
@@ -884,6 +2328,70 @@ class Client:
         """
         return self.call_endpoint(url="messages/flags", method="POST", request=update_data)
 
+    def update_message_flags_in_bulk(
+        self,
+        message_ids: Iterable[int],
+        op: str,
+        flag: str,
+        max_in_flight: int = 4,
+        target_latency: float = 2.0,
+        max_attempts: int = 3,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Adds (op="add") or removes (op="remove") `flag` on any number of
+        messages, in chunks sized to take about target_latency seconds
+        each, up to max_in_flight of them at a time; see BulkFlagUpdate.
+        `progress_callback`, if given, is called with the number of
+        messages done so far and the total.
+
+        Example usage:
+
+        >>> client.update_message_flags_in_bulk(range(1, 100001), "add", "starred")
+        {'result': 'success', 'msg': '', 'messages': [...], 'requests': 23}
+        """
+        import requests
+
+        update = BulkFlagUpdate(
+            message_ids, op, flag, target_latency, max_attempts, progress_callback
+        )
+        with ThreadPoolExecutor(
+            max_workers=max_in_flight, thread_name_prefix="zulip-flags"
+        ) as executor:
+            in_flight: Dict["Future[Tuple[Dict[str, Any], float]]", Tuple[List[int], int]] = {}
+            while update.has_chunks() or in_flight:
+                while update.has_chunks() and len(in_flight) < max_in_flight:
+                    chunk, attempts = update.next_chunk()
+                    future = executor.submit(self._timed_flags_request, update.request(chunk))
+                    in_flight[future] = (chunk, attempts)
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    chunk, attempts = in_flight.pop(future)
+                    try:
+                        response, latency = future.result()
+                    except (ZulipError, requests.exceptions.RequestException) as e:
+                        update.record_error(chunk, attempts, f"Error updating flags: {e}")
+                    else:
+                        update.record_response(chunk, attempts, response, latency)
+        return update.result()
+
+    def _timed_flags_request(self, request: Dict[str, Any]) -> Tuple[Dict[str, Any], float]:
+        start = time.monotonic()
+        response = self.update_message_flags(request)
+        return response, time.monotonic() - start
+
+    def mark_messages_as_read(self, message_ids: Iterable[int], **kwargs: Any) -> Dict[str, Any]:
+        """
+        Marks any number of messages as read; takes the same keyword
+        arguments as update_message_flags_in_bulk.
+
+        Example usage:
+
+        >>> client.mark_messages_as_read(unread_message_ids)
+        {'result': 'success', 'msg': '', 'messages': [...], 'requests': 4}
+        """
+        return self.update_message_flags_in_bulk(message_ids, "add", "read", **kwargs)
+
     def mark_all_as_read(self) -> Dict[str, Any]:
         """
         Example usage:
@@ -1631,6 +3139,19 @@ class Client:
             request=request,
         )
 
+    def remove_storage(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Example usage:
+
+        >>> client.remove_storage({'keys': ["entry 1"]})
+        {'result': 'success', 'msg': ''}
+        """
+        return self.call_endpoint(
+            url="bot_storage",
+            method="DELETE",
+            request=request,
+        )
+
     def set_typing_status(self, request: Dict[str, Any]) -> Dict[str, Any]:
         """
         Example usage:
@@ -1740,6 +3261,173 @@ class ZulipStream:
         pass
 
 
+def message_recipient_key(message: Mapping[str, Any]) -> Hashable:
+    """
+    Returns a key that is equal for two messages exactly when they go
+    to the same conversation: the same stream and topic, or the same
+    set of direct message recipients.
+    """
+    to = message.get("to")
+    if isinstance(to, str):
+        try:
+            to = json.loads(to)
+        except ValueError:
+            to = to.split(",")
+    if message.get("type") == "stream":
+        if isinstance(to, list) and len(to) == 1:
+            to = to[0]
+        return ("stream", str(to), message.get("topic", message.get("subject")))
+    if isinstance(to, (list, tuple)):
+        return ("private", frozenset(str(recipient).strip() for recipient in to))
+    return ("private", frozenset([str(to)]))
+
+
+def history_page_request(direction: str, page_size: int) -> Dict[str, Any]:
+    if direction == "older":
+        return {"num_before": page_size, "num_after": 0}
+    if direction == "newer":
+        return {"num_before": 0, "num_after": page_size}
+    raise ValueError(f"Invalid direction: {direction!r}")
+
+
+def history_page_messages(
+    messages: List[Dict[str, Any]],
+    result: Mapping[str, Any],
+    direction: str,
+    anchor: Union[int, str],
+    include_anchor: bool,
+) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Puts one page of a get_messages walk in `direction` order, and
+    returns it along with whether it reached the end of the history.
+    """
+    if not include_anchor:
+        # Servers older than feature level 155 ignore include_anchor.
+        messages = [message for message in messages if message["id"] != anchor]
+    if direction == "older":
+        messages.reverse()
+        return messages, result.get("found_oldest", False)
+    return messages, result.get("found_newest", False)
+
+
+class BulkFlagUpdate:
+    """
+    The progress of adding or removing a flag on any number of
+    messages, which are sent to the server in chunks, shared by
+    Client.update_message_flags_in_bulk and its AsyncClient version.
+
+    Chunks are sized to take about `target_latency` seconds each,
+    going by how long the previous ones took.  Adding or removing a
+    flag is idempotent, so a chunk whose request failed or timed out
+    is simply sent again, split into smaller chunks, up to
+    `max_attempts` times.
+    """
+
+    initial_chunk_size = 1000
+    min_chunk_size = 50
+    max_chunk_size = 25000
+
+    def __init__(
+        self,
+        message_ids: Iterable[int],
+        op: str,
+        flag: str,
+        target_latency: float,
+        max_attempts: int,
+        progress_callback: Optional[Callable[[int, int], None]],
+    ) -> None:
+        self.op = op
+        self.flag = flag
+        self.target_latency = target_latency
+        self.max_attempts = max_attempts
+        self.progress_callback = progress_callback
+        # Without duplicates, in order.
+        self.remaining: Deque[int] = deque(dict.fromkeys(message_ids))
+        self.total = len(self.remaining)
+        # Chunks to send again, with how many times they were sent.
+        self.retries: Deque[Tuple[List[int], int]] = deque()
+        self.chunk_size = self.initial_chunk_size
+        self.done = 0
+        self.requests = 0
+        self.changed: List[int] = []
+        self.failed: List[int] = []
+        self.errors: List[str] = []
+
+    def has_chunks(self) -> bool:
+        return bool(self.remaining or self.retries)
+
+    def next_chunk(self) -> Tuple[List[int], int]:
+        if self.retries:
+            return self.retries.popleft()
+        size = min(self.chunk_size, len(self.remaining))
+        return [self.remaining.popleft() for _ in range(size)], 0
+
+    def request(self, chunk: List[int]) -> Dict[str, Any]:
+        return {"messages": chunk, "op": self.op, "flag": self.flag}
+
+    def record_response(
+        self, chunk: List[int], attempts: int, response: Dict[str, Any], latency: float
+    ) -> None:
+        self.requests += 1
+        if response["result"] == "http-error":
+            self.retry(chunk, attempts, response["msg"])
+            return
+        if response["result"] == "success":
+            # Aim for target_latency, moving halfway there from the
+            # current size, and at most doubling it at once; smaller
+            # chunks (the last one, and retries) may only shrink it.
+            estimate = len(chunk) * self.target_latency / max(latency, 0.001)
+            if len(chunk) == self.chunk_size or estimate < self.chunk_size:
+                size = min((self.chunk_size + estimate) / 2, 2 * self.chunk_size)
+                self.chunk_size = int(max(self.min_chunk_size, min(size, self.max_chunk_size)))
+            self.changed.extend(response.get("messages", []))
+        else:
+            # The server refused the request, e.g. because of an invalid
+            # flag; sending it again would not help.
+            self.errors.append(response["msg"])
+            self.failed.extend(chunk)
+        self.finish(chunk)
+
+    def record_error(self, chunk: List[int], attempts: int, error: str) -> None:
+        self.requests += 1
+        self.retry(chunk, attempts, error)
+
+    def retry(self, chunk: List[int], attempts: int, error: str) -> None:
+        # The request was probably too large to finish in time.
+        self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+        attempts += 1
+        if attempts >= self.max_attempts:
+            self.errors.append(error)
+            self.failed.extend(chunk)
+            self.finish(chunk)
+            return
+        for start in range(0, len(chunk), self.chunk_size):
+            self.retries.append((chunk[start : start + self.chunk_size], attempts))
+
+    def finish(self, chunk: List[int]) -> None:
+        self.done += len(chunk)
+        if self.progress_callback is not None:
+            self.progress_callback(self.done, self.total)
+
+    def result(self) -> Dict[str, Any]:
+        """
+        The aggregated response: `messages` holds the ids of the
+        messages whose flag changed, and, if some requests failed,
+        `failed_messages` the ids of those whose flag may not have.
+        """
+        result: Dict[str, Any] = {
+            "result": "success",
+            "msg": "",
+            "messages": sorted(self.changed),
+            "requests": self.requests,
+        }
+        if self.failed:
+            result["result"] = "error"
+            result["msg"] = "; ".join(dict.fromkeys(self.errors))
+            result["failed_messages"] = sorted(self.failed)
+        return result
+
+
 def hash_util_decode(string: str) -> str:
     """
     Returns a decoded string given a hash_util_encode() [present in zulip/zulip's zerver/lib/url_encoding.py] encoded string.
@@ -0,0 +1,943 @@
+import asyncio
+import base64
+import inspect
+import json
+import logging
+import sys
+import time
+import urllib.parse
+from collections import deque
+from types import SimpleNamespace, TracebackType
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    Type,
+    Union,
+)
+
+try:
+    import aiohttp
+except ImportError:  # nocoverage
+    raise ImportError(
+        "zulip.async_client requires aiohttp; install it with `pip install zulip[async]`."
+    ) from None
+from typing_extensions import Literal, override
+
+from zulip import (
+    API_VERSTRING,
+    MAX_ERROR_RETRIES,
+    BulkFlagUpdate,
+    Client,
+    EditPropagateMode,
+    EncodedRequest,
+    MultipartEncoder,
+    RandomExponentialBackoff,
+    RequestRecord,
+    StreamingArrayDecoder,
+    UnrecoverableNetworkError,
+    ZulipError,
+    get_retry_after,
+    history_page_messages,
+    history_page_request,
+    message_recipient_key,
+)
+
+logger = logging.getLogger(__name__)
+
+EventCallback = Callable[[Dict[str, Any]], Union[None, Awaitable[None]]]
+
+
+def make_connect_trace_config() -> aiohttp.TraceConfig:
+    # Adds the time spent opening connections to the RequestRecord
+    # passed as the trace_request_ctx of a request.
+    async def on_connection_create_start(
+        session: aiohttp.ClientSession,
+        context: SimpleNamespace,
+        params: aiohttp.TraceConnectionCreateStartParams,
+    ) -> None:
+        context.connect_started = time.monotonic()
+
+    async def on_connection_create_end(
+        session: aiohttp.ClientSession,
+        context: SimpleNamespace,
+        params: aiohttp.TraceConnectionCreateEndParams,
+    ) -> None:
+        if isinstance(context.trace_request_ctx, RequestRecord):
+            context.trace_request_ctx.connect_time += time.monotonic() - context.connect_started
+
+    trace_config = aiohttp.TraceConfig()
+    # aiohttp types its signals as taking any arguments.
+    trace_config.on_connection_create_start.append(on_connection_create_start)  # type: ignore[arg-type]
+    trace_config.on_connection_create_end.append(on_connection_create_end)  # type: ignore[arg-type]
+    return trace_config
+
+
+class AsyncClient(Client):
+    """
+    An asyncio variant of Client.
+
+    It takes the same configuration as Client and exposes the same
+    endpoint methods, but each of them returns a coroutine, and all
+    requests share one pooled aiohttp connector.  Use it as an async
+    context manager, so that the server settings are fetched and the
+    connection pool is closed cleanly:
+
+    >>> async with AsyncClient(config_file="~/zuliprc") as client:
+    ...     await client.send_message({"type": "stream", "to": "devel", ...})
+
+    Unlike Client, nothing is fetched from the server in the
+    constructor; `connect()` (or entering the context manager) loads
+    the server settings.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        connection_limit: int = 100,
+        connection_limit_per_host: int = 0,
+        connector: Optional[aiohttp.BaseConnector] = None,
+        **kwargs: Any,
+    ) -> None:
+        self.connection_limit = connection_limit
+        self.connection_limit_per_host = connection_limit_per_host
+        # A connector passed in may be shared by many clients (e.g. one
+        # per bot), and is not closed along with this client.
+        self.connector = connector
+        self.aio_session: Optional[aiohttp.ClientSession] = None
+        super().__init__(*args, **kwargs)
+
+    @override
+    def load_server_settings(self) -> None:
+        # Deferred until connect(), since we cannot block on the
+        # network from the constructor.
+        pass
+
+    async def connect(self) -> None:
+        self.ensure_session()
+        if self.zulip_version is None:
+            self.set_server_settings(await self.call_endpoint(url="server_settings", method="GET"))
+
+    async def close(self) -> None:
+        if self.aio_session is not None:
+            await self.aio_session.close()
+            self.aio_session = None
+
+    async def __aenter__(self) -> "AsyncClient":
+        await self.connect()
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        await self.close()
+
+    if TYPE_CHECKING:
+        # Every endpoint method inherited from Client returns a
+        # coroutine here, since they all go through do_api_query.
+        # Spell out the most commonly used ones for type checkers.
+        @override
+        async def send_message(self, message_data: Dict[str, Any]) -> Dict[str, Any]:  # type: ignore[override]
+            ...
+
+        @override
+        async def update_message(self, message_data: Dict[str, Any]) -> Dict[str, Any]:  # type: ignore[override]
+            ...
+
+        @override
+        async def get_messages(self, message_filters: Dict[str, Any]) -> Dict[str, Any]:  # type: ignore[override]
+            ...
+
+        @override
+        async def update_message_flags(self, update_data: Dict[str, Any]) -> Dict[str, Any]:  # type: ignore[override]
+            ...
+
+        @override
+        async def mark_messages_as_read(  # type: ignore[override]
+            self, message_ids: Iterable[int], **kwargs: Any
+        ) -> Dict[str, Any]:
+            ...
+
+        @override
+        async def add_reaction(self, reaction_data: Dict[str, Any]) -> Dict[str, Any]:  # type: ignore[override]
+            ...
+
+        @override
+        async def upload_file(  # type: ignore[override]
+            self, file: IO[Any], progress_callback: Optional[Callable[[int, int], None]] = None
+        ) -> Dict[str, Any]:
+            ...
+
+        @override
+        async def get_server_settings(self) -> Dict[str, Any]:  # type: ignore[override]
+            ...
+
+        @override
+        async def get_profile(  # type: ignore[override]
+            self, request: Optional[Dict[str, Any]] = None
+        ) -> Dict[str, Any]:
+            ...
+
+        @override
+        async def get_events(self, **request: Any) -> Dict[str, Any]:  # type: ignore[override]
+            ...
+
+        @override
+        async def register(  # type: ignore[override]
+            self,
+            event_types: Optional[Iterable[str]] = None,
+            narrow: Optional[List[List[str]]] = None,
+            **kwargs: object,
+        ) -> Dict[str, Any]:
+            ...
+
+        @override
+        async def deregister(  # type: ignore[override]
+            self, queue_id: str, timeout: Optional[float] = None
+        ) -> Dict[str, Any]:
+            ...
+
+    @override
+    def ensure_session(self) -> None:
+        if self.aio_session is not None and not self.aio_session.closed:
+            return
+
+        if self.connector is not None:
+            connector = self.connector
+        else:
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                limit_per_host=self.connection_limit_per_host,
+                ssl=self.get_ssl_context(),
+            )
+        self.aio_session = aiohttp.ClientSession(
+            connector=connector,
+            connector_owner=self.connector is None,
+            trace_configs=[make_connect_trace_config()],
+            headers={
+                "Authorization": "Basic "
+                + base64.b64encode(f"{self.email}:{self.api_key}".encode()).decode(),
+                "User-agent": self.get_user_agent(),
+            },
+        )
+
+    @override
+    async def do_api_query(  # type: ignore[override] # Returns a coroutine; see class docstring.
+        self,
+        orig_request: Mapping[str, Any],
+        url: str,
+        method: str = "POST",
+        longpolling: bool = False,
+        files: Optional[List[IO[Any]]] = None,
+        timeout: Optional[float] = None,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+    ) -> Dict[str, Any]:
+        res = await self.do_api_request(
+            orig_request,
+            url,
+            method=method,
+            longpolling=longpolling,
+            files=files,
+            timeout=timeout,
+            progress_callback=progress_callback,
+        )
+        try:
+            json_result = json.loads(await res.read())
+        except ValueError:
+            json_result = None
+        if not isinstance(json_result, dict):
+            return {
+                "msg": "Unexpected error from the server",
+                "result": "http-error",
+                "status_code": res.status,
+            }
+        return json_result
+
+    @override
+    async def do_api_request(  # type: ignore[override] # Returns a coroutine.
+        self,
+        orig_request: Mapping[str, Any],
+        url: str,
+        method: str = "POST",
+        longpolling: bool = False,
+        files: Optional[List[IO[Any]]] = None,
+        timeout: Optional[float] = None,
+        stream: bool = False,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+    ) -> aiohttp.ClientResponse:
+        if files is None:
+            files = []
+
+        # Same timeouts as Client.do_api_query.
+        request_timeout = 90.0 if longpolling else timeout or 15.0
+
+        # Encoded once, to be sent as is by every attempt.
+        request = EncodedRequest(orig_request)
+
+        # As with requests, the timeout of an upload applies to each
+        # read and write rather than to the whole request.
+        client_timeout = aiohttp.ClientTimeout(total=request_timeout)
+        body = None
+        if files and method != "GET":
+            body = MultipartEncoder(request.fields, files, progress_callback)
+        if body is not None or stream:
+            client_timeout = aiohttp.ClientTimeout(
+                sock_connect=request_timeout, sock_read=request_timeout
+            )
+
+        self.ensure_session()
+        assert self.aio_session is not None
+
+        had_error_retry = False
+        failures = 0
+        attempts = 0
+        # Whether the compressed body was answered with a 400.
+        retry_uncompressed = False
+        record = RequestRecord(url, method)
+
+        async def error_retry(error_string: str) -> bool:
+            nonlocal had_error_retry, failures
+            if not self.retry_on_errors or failures >= MAX_ERROR_RETRIES:
+                return False
+            if self.verbose:
+                if not had_error_retry:
+                    sys.stdout.write(
+                        "zulip API({}): connection error{} -- retrying.".format(
+                            url.split(API_VERSTRING, 2)[0],
+                            error_string,
+                        )
+                    )
+                    had_error_retry = True
+                else:
+                    sys.stdout.write(".")
+                sys.stdout.flush()
+            request.set("dont_block", True)
+            await asyncio.sleep(1)
+            record.backoff_time += 1
+            failures += 1
+            return True
+
+        def end_error_retry(succeeded: bool) -> None:
+            if had_error_retry and self.verbose:
+                if succeeded:
+                    print("Success!")
+                else:
+                    print("Failed!")
+
+        try:
+            while True:
+                record.retries = attempts
+                attempts += 1
+                delay = self.rate_limiter.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    record.backoff_time += delay
+
+                kwargs: Dict[str, Any] = {}
+                compressed = False
+                if method == "GET":
+                    kwargs["params"] = request.body().decode()
+                    record.bytes_sent = 0
+                elif body is not None:
+                    # Retries must send the files from the start again.
+                    body.rewind()
+                    kwargs["data"] = self.read_body(body)
+                    kwargs["headers"] = {
+                        "Content-Type": body.content_type,
+                        "Content-Length": str(len(body)),
+                    }
+                    record.bytes_sent = len(body)
+                else:
+                    compressed = (
+                        self.should_compress(len(request.body())) and not retry_uncompressed
+                    )
+                    kwargs["headers"] = {"Content-Type": "application/x-www-form-urlencoded"}
+                    if compressed:
+                        kwargs["data"] = request.gzipped_body()
+                        kwargs["headers"]["Content-Encoding"] = "gzip"
+                    else:
+                        kwargs["data"] = request.body()
+                    record.bytes_sent = len(kwargs["data"])
+
+                sent_at = time.monotonic()
+                attempt_connect_time = record.connect_time
+                try:
+                    # Actually make the request!
+                    res = await self.aio_session.request(
+                        method,
+                        urllib.parse.urljoin(self.base_url, url),
+                        timeout=client_timeout,
+                        trace_request_ctx=record,
+                        **kwargs,
+                    )
+                    self.has_connected = True
+                    self.rate_limiter.update(res.headers)
+                    self.update_accepted_encodings(res.headers)
+                    record.status = res.status
+                    # Without the time opening a connection, if the
+                    # request needed a new one.
+                    record.ttfb = max(
+                        0.0,
+                        time.monotonic() - sent_at - (record.connect_time - attempt_connect_time),
+                    )
+
+                    # When rate-limited, wait as long as the server
+                    # asks, and try again, as many times as after
+                    # server errors.
+                    if res.status == 429 and self.retry_on_errors and failures < MAX_ERROR_RETRIES:
+                        try:
+                            json_result = json.loads(await res.read())
+                        except ValueError:
+                            json_result = None
+                        retry_after = get_retry_after(json_result, res.headers)
+                        if self.verbose:
+                            print(f"zulip API: rate limited -- retrying in {retry_after}s.")
+                        self.rate_limiter.record_rate_limited(retry_after)
+                        failures += 1
+                        continue
+
+                    if res.status == 415 and compressed:
+                        res.release()
+                        self.refuse_compression()
+                        continue
+                    # See Client.do_api_request.
+                    if res.status == 400 and compressed:
+                        res.release()
+                        retry_uncompressed = True
+                        continue
+                    if retry_uncompressed and res.status != 400 and res.status < 500:
+                        self.refuse_compression()
+                        retry_uncompressed = False
+
+                    # On 50x errors, try again after a short sleep
+                    if 500 <= res.status < 600 and await error_retry(f" (server {res.status})"):
+                        res.release()
+                        continue
+
+                    if not stream:
+                        record.bytes_received = len(await res.read())
+                    elif res.content_length is not None:
+                        # The body is only read later, by the caller.
+                        record.bytes_received = res.content_length
+                except asyncio.TimeoutError:
+                    if longpolling:
+                        # When longpolling, we expect the timeout to fire,
+                        # and the correct response is to just retry
+                        continue
+                    end_error_retry(False)
+                    raise
+                except aiohttp.ClientSSLError as e:
+                    raise UnrecoverableNetworkError("SSL Error") from e
+                except aiohttp.ClientConnectionError as e:
+                    if not self.has_connected:
+                        # See Client.do_api_query: a server we have never
+                        # reached is most likely misconfigured or down.
+                        raise UnrecoverableNetworkError(
+                            "cannot connect to server " + self.base_url
+                        ) from e
+
+                    if await error_retry(""):
+                        continue
+                    end_error_retry(False)
+                    raise
+
+                end_error_retry(True)
+                return res
+        except BaseException as e:
+            record.error = type(e).__name__
+            raise
+        finally:
+            record.finish()
+            self.report_request(record)
+
+    async def read_body(self, body: MultipartEncoder) -> AsyncIterator[bytes]:
+        # Read the files in a thread, to not block the event loop.
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = await loop.run_in_executor(None, body.read, 64 * 1024)
+            if not chunk:
+                return
+            yield chunk
+
+    @override
+    async def call_endpoint(  # type: ignore[override] # Returns a coroutine.
+        self,
+        url: Optional[str] = None,
+        method: str = "POST",
+        request: Optional[Dict[str, Any]] = None,
+        longpolling: bool = False,
+        files: Optional[List[IO[Any]]] = None,
+        timeout: Optional[float] = None,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+    ) -> Dict[str, Any]:
+        if request is None:
+            request = dict()
+        marshalled_request = {k: v for k, v in request.items() if v is not None}
+        versioned_url = API_VERSTRING + (url if url is not None else "")
+        cache_key = self.get_cache_key(url, method, marshalled_request)
+        if cache_key is not None:
+            assert self.response_cache is not None
+            cached_response = self.response_cache.get(cache_key)
+            if cached_response is not None:
+                return cached_response
+        response = await self.do_api_query(
+            marshalled_request,
+            versioned_url,
+            method=method,
+            longpolling=longpolling,
+            files=files,
+            timeout=timeout,
+            progress_callback=progress_callback,
+        )
+        if cache_key is not None:
+            assert self.response_cache is not None
+            self.response_cache.put(cache_key, response)
+        return response
+
+    async def _get_stream_id(self, stream: str) -> Dict[str, Any]:
+        stream_encoded = urllib.parse.quote(stream, safe="")
+        return await self.call_endpoint(url=f"get_stream_id?stream={stream_encoded}", method="GET")
+
+    @override
+    async def call_on_each_event(  # type: ignore[override] # Returns a coroutine.
+        self,
+        callback: EventCallback,
+        event_types: Optional[List[str]] = None,
+        narrow: Optional[List[List[str]]] = None,
+        queue_id: Optional[str] = None,
+        last_event_id: int = -1,
+        max_backoff: float = 90.0,
+        progress_callback: Optional[Callable[[str, int], Union[None, Awaitable[None]]]] = None,
+        register_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+        **kwargs: Any,
+    ) -> None:
+        """
+        Like Client.call_on_each_event; `callback` and
+        `progress_callback` may be plain functions or coroutine
+        functions.
+        """
+        if narrow is None:
+            narrow = []
+
+        backoff = RandomExponentialBackoff(maximum_retries=40, delay_cap=max_backoff)
+        dont_block = False
+        while True:
+            if queue_id is None:
+                request = dict(event_types=event_types, narrow=narrow, **kwargs)
+                res = await self.call_endpoint(url="register", request=request)
+                if "error" in res["result"]:
+                    if self.verbose:
+                        print("Server returned error:\n{}".format(res["msg"]))
+                    await asyncio.sleep(backoff.record_failure())
+                    continue
+                if register_callback is not None:
+                    register_callback(res)
+                queue_id, last_event_id = res["queue_id"], res["last_event_id"]
+
+            request = dict(queue_id=queue_id, last_event_id=last_event_id)
+            if dont_block:
+                request["dont_block"] = True
+            try:
+                res = await self.call_endpoint(
+                    url="events", method="GET", longpolling=True, request=request
+                )
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                if self.verbose:
+                    logger.exception("Connection error fetching events")
+                await asyncio.sleep(backoff.record_failure())
+                dont_block = True
+                continue
+
+            if "error" in res["result"]:
+                if res["result"] == "http-error":
+                    if self.verbose:
+                        print("HTTP error fetching events -- probably a server restart")
+                else:
+                    if self.verbose:
+                        print("Server returned error:\n{}".format(res["msg"]))
+                    if res.get("code") == "BAD_EVENT_QUEUE_ID":
+                        # Our event queue went away; register a new one.
+                        queue_id = None
+                await asyncio.sleep(backoff.record_failure())
+                dont_block = True
+                continue
+
+            backoff.succeed()
+            dont_block = False
+
+            for event in res["events"]:
+                last_event_id = max(last_event_id, int(event["id"]))
+                if event["type"] == "heartbeat":
+                    continue
+                self.invalidate_cache_for_event(event)
+                result = callback(event)
+                if inspect.isawaitable(result):
+                    await result
+
+            if progress_callback is not None:
+                result = progress_callback(queue_id, last_event_id)
+                if inspect.isawaitable(result):
+                    await result
+
+    @override
+    async def call_on_each_event_batch(  # type: ignore[override] # Returns a coroutine.
+        self,
+        callback: Callable[[List[Dict[str, Any]]], Union[None, Awaitable[None]]],
+        max_batch: int = 100,
+        max_wait: float = 1.0,
+        event_types: Optional[List[str]] = None,
+        narrow: Optional[List[List[str]]] = None,
+        progress_callback: Optional[Callable[[str, int], None]] = None,
+        **kwargs: Any,
+    ) -> None:
+        """
+        Like Client.call_on_each_event_batch; `callback` may be a plain
+        function or a coroutine function.  The events are fetched in a
+        separate task.
+        """
+        # Either an event, or the (queue_id, last_event_id) of the
+        # response it was part of.
+        items: "asyncio.Queue[Union[Dict[str, Any], Tuple[str, int]]]" = asyncio.Queue(
+            2 * max_batch
+        )
+
+        async def put_progress(queue_id: str, last_event_id: int) -> None:
+            await items.put((queue_id, last_event_id))
+
+        loop = asyncio.get_running_loop()
+        fetcher = asyncio.ensure_future(
+            self.call_on_each_event(
+                items.put, event_types, narrow, progress_callback=put_progress, **kwargs
+            )
+        )
+        getter: "Optional[asyncio.Future[Union[Dict[str, Any], Tuple[str, int]]]]" = None
+        batch: List[Dict[str, Any]] = []
+        progress: Optional[Tuple[str, int]] = None
+        deadline = 0.0
+        try:
+            while True:
+                if getter is None:
+                    getter = asyncio.ensure_future(items.get())
+                waiting: List["asyncio.Future[Any]"] = [getter, fetcher]
+                await asyncio.wait(
+                    waiting,
+                    timeout=max(deadline - loop.time(), 0) if batch else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                item = None
+                if getter.done():
+                    item = getter.result()
+                    getter = None
+                elif fetcher.done():
+                    # Raises the error that stopped fetching events.
+                    fetcher.result()
+                    return
+
+                if isinstance(item, dict):
+                    if not batch:
+                        deadline = loop.time() + max_wait
+                    batch.append(item)
+                elif item is not None:
+                    progress = item
+
+                if batch and (item is None or len(batch) >= max_batch):
+                    result = callback(batch)
+                    if inspect.isawaitable(result):
+                        await result
+                    batch = []
+                if not batch and progress is not None:
+                    # Every event before this point has been delivered.
+                    if progress_callback is not None:
+                        progress_callback(*progress)
+                    progress = None
+        finally:
+            fetcher.cancel()
+            if getter is not None:
+                getter.cancel()
+
+    @override
+    async def call_on_each_message(  # type: ignore[override] # Returns a coroutine.
+        self, callback: EventCallback, **kwargs: Any
+    ) -> None:
+        async def event_callback(event: Dict[str, Any]) -> None:
+            if event["type"] == "message":
+                result = callback(event["message"])
+                if inspect.isawaitable(result):
+                    await result
+
+        await self.call_on_each_event(event_callback, ["message"], None, **kwargs)
+
+    @override
+    async def iter_messages(  # type: ignore[override] # Returns an async iterator.
+        self,
+        narrow: Optional[List[Dict[str, Any]]] = None,
+        batch_size: int = 1000,
+        anchor: Union[int, str] = "newest",
+        **request: Any,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Like Client.iter_messages, but an async iterator; since those
+        cannot return a value, the rest of the response is dropped.
+        """
+        request = {
+            "anchor": anchor,
+            "num_before": batch_size,
+            "num_after": 0,
+            "narrow": narrow,
+            **request,
+        }
+        res = await self.do_api_request(
+            {key: val for key, val in request.items() if val is not None},
+            API_VERSTRING + "messages",
+            method="GET",
+            stream=True,
+        )
+        decoder = StreamingArrayDecoder("messages")
+        async with res:
+            async for chunk in res.content.iter_chunked(64 * 1024):
+                for message in decoder.feed(chunk):
+                    yield message
+        try:
+            result = decoder.close()
+        except ValueError:
+            result = {"msg": "Unexpected error from the server", "result": "http-error"}
+        if result["result"] != "success":
+            raise ZulipError(result["msg"])
+
+    @override
+    async def iter_history(  # type: ignore[override] # Returns an async iterator.
+        self,
+        narrow: Optional[List[Dict[str, Any]]] = None,
+        direction: Literal["older", "newer"] = "older",
+        page_size: int = 1000,
+        start_anchor: Optional[Union[int, str]] = None,
+        **request: Any,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Like Client.iter_history, but an async iterator; the next page
+        is fetched by a task while the current one is being consumed.
+        """
+        if start_anchor is None:
+            start_anchor = "newest" if direction == "older" else "oldest"
+
+        async def get_page(
+            anchor: Union[int, str], include_anchor: bool
+        ) -> Tuple[List[Dict[str, Any]], bool]:
+            page_request = dict(
+                request,
+                narrow=narrow,
+                anchor=anchor,
+                **history_page_request(direction, page_size),
+            )
+            if not include_anchor and self.feature_level >= 155:
+                page_request["include_anchor"] = False
+            result = await self.get_messages(
+                {key: val for key, val in page_request.items() if val is not None}
+            )
+            if result["result"] != "success":
+                raise ZulipError(result["msg"])
+            return history_page_messages(
+                result["messages"], result, direction, anchor, include_anchor
+            )
+
+        next_page = asyncio.ensure_future(get_page(start_anchor, True))
+        try:
+            while True:
+                messages, found_end = await next_page
+                if not messages:
+                    return
+                if not found_end:
+                    next_page = asyncio.ensure_future(get_page(messages[-1]["id"], False))
+                for message in messages:
+                    yield message
+                if found_end:
+                    return
+        finally:
+            next_page.cancel()
+
+    @override
+    async def send_messages(  # type: ignore[override] # Returns an async iterator.
+        self, messages: Iterable[Dict[str, Any]], max_in_flight: int = 8
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Like Client.send_messages, but an async iterator:
+
+        >>> async for response in client.send_messages(messages, max_in_flight=16):
+        ...     print(response["result"])
+        """
+        semaphore = asyncio.Semaphore(max_in_flight)
+
+        async def send_after(
+            previous: Optional["asyncio.Task[Dict[str, Any]]"], message: Dict[str, Any]
+        ) -> Dict[str, Any]:
+            if previous is not None:
+                await asyncio.wait([previous])
+            async with semaphore:
+                try:
+                    return await self.send_message(message)
+                except (ZulipError, asyncio.TimeoutError, aiohttp.ClientError) as e:
+                    return {"result": "error", "msg": f"Error sending message: {e}"}
+
+        pending: Deque[Tuple[Hashable, "asyncio.Task[Dict[str, Any]]"]] = deque()
+        # The last message sent to each recipient, while it's pending.
+        last_send_to: Dict[Hashable, "asyncio.Task[Dict[str, Any]]"] = {}
+
+        async def next_response() -> Dict[str, Any]:
+            recipient, task = pending.popleft()
+            if last_send_to.get(recipient) is task:
+                del last_send_to[recipient]
+            return await task
+
+        for message in messages:
+            recipient = message_recipient_key(message)
+            task = asyncio.ensure_future(send_after(last_send_to.get(recipient), message))
+            last_send_to[recipient] = task
+            pending.append((recipient, task))
+            while len(pending) > 2 * max_in_flight:
+                yield await next_response()
+        while pending:
+            yield await next_response()
+
+    @override
+    async def upload_files(  # type: ignore[override] # Returns a coroutine.
+        self,
+        paths: Iterable[str],
+        max_parallel: int = 4,
+        progress_callback: Optional[Callable[[str, int, int], None]] = None,
+    ) -> List[Dict[str, Any]]:
+        semaphore = asyncio.Semaphore(max_parallel)
+
+        async def upload_path(path: str) -> Dict[str, Any]:
+            file_progress_callback = None
+            if progress_callback is not None:
+
+                def file_progress_callback(sent: int, total: int) -> None:
+                    progress_callback(path, sent, total)
+
+            async with semaphore:
+                try:
+                    with open(path, "rb") as f:
+                        return await self.upload_file(f, file_progress_callback)
+                except (ZulipError, OSError, asyncio.TimeoutError, aiohttp.ClientError) as e:
+                    return {"result": "error", "msg": f"Error uploading {path}: {e}"}
+
+        return list(await asyncio.gather(*(upload_path(path) for path in paths)))
+
+    @override
+    async def update_message_flags_in_bulk(  # type: ignore[override] # Returns a coroutine.
+        self,
+        message_ids: Iterable[int],
+        op: str,
+        flag: str,
+        max_in_flight: int = 4,
+        target_latency: float = 2.0,
+        max_attempts: int = 3,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+    ) -> Dict[str, Any]:
+        update = BulkFlagUpdate(
+            message_ids, op, flag, target_latency, max_attempts, progress_callback
+        )
+        in_flight: Dict["asyncio.Task[Dict[str, Any]]", Tuple[List[int], int, float]] = {}
+        while update.has_chunks() or in_flight:
+            while update.has_chunks() and len(in_flight) < max_in_flight:
+                chunk, attempts = update.next_chunk()
+                task = asyncio.ensure_future(self.update_message_flags(update.request(chunk)))
+                in_flight[task] = (chunk, attempts, time.monotonic())
+            finished, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                chunk, attempts, started = in_flight.pop(task)
+                try:
+                    response = task.result()
+                except (ZulipError, asyncio.TimeoutError, aiohttp.ClientError) as e:
+                    update.record_error(chunk, attempts, f"Error updating flags: {e}")
+                else:
+                    update.record_response(chunk, attempts, response, time.monotonic() - started)
+        return update.result()
+
+    @override
+    async def get_subscribers(self, **request: Any) -> Dict[str, Any]:  # type: ignore[override] # Returns a coroutine.
+        response = await self._get_stream_id(request["stream"])
+        if response["result"] == "error":
+            return response
+
+        stream_id = response["stream_id"]
+        url = "streams/%d/members" % (stream_id,)
+        return await self.call_endpoint(
+            url=url,
+            method="GET",
+            request=request,
+        )
+
+    @override
+    async def move_topic(  # type: ignore[override] # Returns a coroutine.
+        self,
+        stream: str,
+        new_stream: str,
+        topic: str,
+        new_topic: Optional[str] = None,
+        message_id: Optional[int] = None,
+        propagate_mode: EditPropagateMode = "change_all",
+        notify_old_topic: bool = True,
+        notify_new_topic: bool = True,
+    ) -> Dict[str, Any]:
+        result = await self._get_stream_id(stream)
+        if result["result"] != "success":
+            return result
+        stream_id = result["stream_id"]
+
+        result = await self._get_stream_id(new_stream)
+        if result["result"] != "success":
+            return result
+        new_stream_id = result["stream_id"]
+
+        if message_id is None:
+            if propagate_mode != "change_all":
+                raise AttributeError(
+                    'A message_id must be provided if propagate_mode isn\'t "change_all"'
+                )
+
+            result = await self.call_endpoint(
+                url="messages",
+                method="GET",
+                request={
+                    "anchor": "newest",
+                    "narrow": [
+                        {"operator": "stream", "operand": stream_id},
+                        {"operator": "topic", "operand": topic},
+                    ],
+                    "num_before": 1,
+                    "num_after": 0,
+                },
+            )
+            if result["result"] != "success":
+                return result
+            if len(result["messages"]) <= 0:
+                return {"result": "error", "msg": f'No messages found in topic: "{topic}"'}
+            message_id = result["messages"][0]["id"]
+
+        request = {
+            "stream_id": new_stream_id,
+            "propagate_mode": propagate_mode,
+            "topic": new_topic,
+            "send_notification_to_old_thread": notify_old_topic,
+            "send_notification_to_new_thread": notify_new_topic,
+        }
+        return await self.call_endpoint(
+            url=f"messages/{message_id}",
+            method="PATCH",
+            request=request,
+        )
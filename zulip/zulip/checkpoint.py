@@ -0,0 +1,257 @@
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from typing_extensions import override
+
+from zulip import Client
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointStore:
+    """
+    Where an event consumer's progress is saved: a dict with the
+    `queue_id` and `last_event_id` of its event queue, and the
+    `last_message_id` it has handled.  save() must replace the
+    previous checkpoint atomically.
+    """
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def save(self, checkpoint: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+
+class FileCheckpointStore(CheckpointStore):
+    """
+    Keeps the checkpoint in a JSON file, which is replaced atomically.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    @override
+    def load(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    @override
+    def save(self, checkpoint: Dict[str, Any]) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, prefix=".zulip-checkpoint-", delete=False
+        ) as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f.name, self.path)
+
+
+class SQLiteCheckpointStore(CheckpointStore):
+    """
+    Keeps the checkpoints of any number of consumers, by `name`, in an
+    SQLite database.
+    """
+
+    def __init__(self, path: str, name: str = "default") -> None:
+        self.name = name
+        self.lock = threading.Lock()
+        # Progress may be saved from the event worker threads.
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS zulip_event_checkpoints ("
+                "name TEXT PRIMARY KEY, queue_id TEXT, last_event_id INTEGER, "
+                "last_message_id INTEGER)"
+            )
+
+    @override
+    def load(self) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT queue_id, last_event_id, last_message_id "
+                "FROM zulip_event_checkpoints WHERE name = ?",
+                (self.name,),
+            ).fetchone()
+        if row is None:
+            return None
+        return {"queue_id": row[0], "last_event_id": row[1], "last_message_id": row[2]}
+
+    @override
+    def save(self, checkpoint: Dict[str, Any]) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO zulip_event_checkpoints "
+                "(name, queue_id, last_event_id, last_message_id) VALUES (?, ?, ?, ?)",
+                (
+                    self.name,
+                    checkpoint["queue_id"],
+                    checkpoint["last_event_id"],
+                    checkpoint["last_message_id"],
+                ),
+            )
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class CheckpointedEventConsumer:
+    """
+    Runs Client.call_on_each_event, saving its progress to `store`
+    after each batch of events has been handled, so that a consumer
+    which is restarted carries on where it left off:
+
+    >>> consumer = CheckpointedEventConsumer(client, FileCheckpointStore("bot.checkpoint"))
+    >>> consumer.call_on_each_message(handle_message)
+
+    The saved event queue is resumed if the server still has it.
+    Otherwise, as when the queue is garbage-collected while the
+    consumer is running, a new one is registered, and the messages
+    matching `narrow` that arrived after the last one handled are
+    fetched with get_messages and passed to `callback` first, as
+    message events.  Other kinds of events are not recovered.
+
+    Events are handled at least once: those of the last batch before
+    a crash may be handled again.  If fetching the missed messages
+    fails, the error is raised, so that they are fetched again after
+    a restart rather than skipped.
+    """
+
+    def __init__(self, client: Client, store: CheckpointStore) -> None:
+        self.client = client
+        self.store = store
+        self.lock = threading.Lock()
+        self.queue_id: Optional[str] = None
+        self.last_event_id = -1
+        self.last_message_id: Optional[int] = None
+        # The message id of each message event handled but not yet
+        # saved, by event id.
+        self.pending_message_ids: Dict[int, int] = {}
+        # Messages up to this id were fetched with get_messages, and
+        # are skipped if the new queue has them too.
+        self.backfilled_message_id = -1
+
+    def call_on_each_event(
+        self,
+        callback: Callable[[Dict[str, Any]], None],
+        event_types: Optional[List[str]] = None,
+        narrow: Optional[List[List[str]]] = None,
+        progress_callback: Optional[Callable[[str, int], None]] = None,
+        register_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+        **kwargs: Any,
+    ) -> None:
+        """
+        Like Client.call_on_each_event, whose other arguments it takes.
+        """
+        checkpoint = self.store.load()
+        if checkpoint is not None:
+            self.queue_id = checkpoint["queue_id"]
+            self.last_event_id = checkpoint["last_event_id"]
+            self.last_message_id = checkpoint["last_message_id"]
+        wants_messages = event_types is None or "message" in event_types
+
+        def handle_event(event: Dict[str, Any]) -> None:
+            if event["type"] == "message":
+                if event["message"]["id"] <= self.backfilled_message_id:
+                    return
+                callback(event)
+                with self.lock:
+                    self.pending_message_ids[event["id"]] = event["message"]["id"]
+            else:
+                callback(event)
+
+        def save_progress(queue_id: str, last_event_id: int) -> None:
+            with self.lock:
+                # Events are reported done in order, so every event up
+                # to last_event_id has been handled.
+                handled = [
+                    event_id for event_id in self.pending_message_ids if event_id <= last_event_id
+                ]
+                for event_id in handled:
+                    message_id = self.pending_message_ids.pop(event_id)
+                    self.last_message_id = max(self.last_message_id or -1, message_id)
+                self.queue_id = queue_id
+                self.last_event_id = last_event_id
+                self.save()
+            if progress_callback is not None:
+                progress_callback(queue_id, last_event_id)
+
+        def handle_register(res: Dict[str, Any]) -> None:
+            if register_callback is not None:
+                register_callback(res)
+            with self.lock:
+                # Events of the old queue can't be reported done anymore.
+                self.pending_message_ids.clear()
+                self.queue_id = res["queue_id"]
+                self.last_event_id = res["last_event_id"]
+            if wants_messages:
+                self.backfill(callback, narrow or [])
+            with self.lock:
+                self.save()
+
+        self.client.call_on_each_event(
+            handle_event,
+            event_types,
+            narrow,
+            queue_id=self.queue_id,
+            last_event_id=self.last_event_id,
+            progress_callback=save_progress,
+            register_callback=handle_register,
+            **kwargs,
+        )
+
+    def call_on_each_message(
+        self, callback: Callable[[Dict[str, Any]], None], **kwargs: Any
+    ) -> None:
+        def event_callback(event: Dict[str, Any]) -> None:
+            if event["type"] == "message":
+                callback(event["message"])
+
+        self.call_on_each_event(event_callback, ["message"], None, **kwargs)
+
+    def backfill(self, callback: Callable[[Dict[str, Any]], None], narrow: List[List[str]]) -> None:
+        message_narrow = [
+            {"operator": operator, "operand": operand} for operator, operand in narrow
+        ]
+        if self.last_message_id is None:
+            # Nothing was handled yet; only note where we start, so
+            # that nothing is missed if this queue is lost too.
+            result = self.client.get_messages(
+                {"anchor": "newest", "num_before": 1, "num_after": 0, "narrow": message_narrow}
+            )
+            if result["result"] == "success":
+                self.last_message_id = max(
+                    [message["id"] for message in result["messages"]], default=-1
+                )
+            return
+
+        count = 0
+        for message in self.client.iter_history(
+            message_narrow, direction="newer", start_anchor=self.last_message_id
+        ):
+            if message["id"] <= self.last_message_id:
+                continue
+            callback({"type": "message", "message": message, "flags": message.get("flags", [])})
+            count += 1
+            self.last_message_id = self.backfilled_message_id = message["id"]
+        if count:
+            logger.info("Fetched %d messages missed while the event queue was gone", count)
+
+    def save(self) -> None:
+        self.store.save(
+            {
+                "queue_id": self.queue_id,
+                "last_event_id": self.last_event_id,
+                "last_message_id": self.last_message_id,
+            }
+        )
@@ -0,0 +1,60 @@
+import threading
+import time
+from typing import Any
+
+import requests
+import urllib3
+from typing_extensions import override
+
+# The time each thread has spent opening connections, so that
+# do_api_request can tell how much of it each request took.
+connection_timing = threading.local()
+
+
+def thread_connect_time() -> float:
+    return getattr(connection_timing, "total", 0.0)
+
+
+class TimedHTTPConnection(urllib3.connection.HTTPConnection):
+    @override
+    def connect(self) -> None:
+        start = time.monotonic()
+        try:
+            super().connect()
+        finally:
+            connection_timing.total = thread_connect_time() + time.monotonic() - start
+
+
+class TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+    @override
+    def connect(self) -> None:
+        # Includes the TLS handshake.
+        start = time.monotonic()
+        try:
+            super().connect()
+        finally:
+            connection_timing.total = thread_connect_time() + time.monotonic() - start
+
+
+class TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    @override
+    def init_poolmanager(
+        self,
+        connections: int,
+        maxsize: int,
+        block: bool = requests.adapters.DEFAULT_POOLBLOCK,
+        **pool_kwargs: Any,
+    ) -> None:
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
@@ -0,0 +1,147 @@
+import datetime
+import ssl
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional, Union
+
+try:
+    import httpx
+except ImportError:  # nocoverage
+    raise ImportError(
+        "zulip.http2 requires httpx and h2; install them with `pip install zulip[http2]`."
+    ) from None
+import requests
+from typing_extensions import override
+
+from zulip import Client, MultipartEncoder, Transport
+from zulip.connections import connection_timing, thread_connect_time
+
+
+def requests_error(e: httpx.HTTPError) -> requests.exceptions.RequestException:
+    """
+    The requests exception do_api_request handles like `e`.
+    """
+    if isinstance(e, httpx.ConnectTimeout):
+        return requests.exceptions.ConnectTimeout(str(e))
+    if isinstance(e, httpx.TimeoutException):
+        return requests.exceptions.ReadTimeout(str(e))
+    if isinstance(e, httpx.ConnectError) and isinstance(e.__context__, ssl.SSLError):
+        return requests.exceptions.SSLError(str(e))
+    if isinstance(e, httpx.TransportError):
+        return requests.exceptions.ConnectionError(str(e))
+    return requests.exceptions.RequestException(str(e))
+
+
+class ResponseBody:
+    """
+    The body of an httpx response, decoded, read like the raw urllib3
+    response that requests.Response reads its content from.
+    """
+
+    def __init__(self, response: httpx.Response) -> None:
+        self.response = response
+        self.chunks = response.iter_bytes()
+        self.buffer = b""
+
+    def read(self, size: Optional[int] = -1, **kwargs: Any) -> bytes:
+        try:
+            while size is None or size < 0 or len(self.buffer) < size:
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    break
+                self.buffer += chunk
+        except httpx.HTTPError as e:
+            raise requests_error(e) from e
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self) -> None:
+        self.response.close()
+
+
+class HTTP2Transport(Transport):
+    """
+    Sends the requests of `client` with httpx over HTTP/2 (for https
+    sites; plain http ones get HTTP/1.1), so that concurrent requests,
+    including a long-poll for events, share one connection per server
+    instead of each taking one from the pool.  Used by
+    Client(transport="http2").
+    """
+
+    def __init__(self, client: Client) -> None:
+        self.timing = threading.local()
+        self.httpx_client = httpx.Client(
+            http2=True,
+            auth=(client.email or "", client.api_key or ""),
+            verify=client.get_ssl_context(),
+            headers={"User-agent": client.get_user_agent()},
+            limits=httpx.Limits(max_keepalive_connections=client.pool_maxsize),
+        )
+
+    def trace(self, event_name: str, info: Dict[str, Any]) -> None:
+        # Count the TCP connect and TLS handshake of new connections in
+        # the connect time of the request's RequestRecord.
+        if event_name == "connection.connect_tcp.started":
+            self.timing.started = time.monotonic()
+        elif event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            now = time.monotonic()
+            connection_timing.total = thread_connect_time() + now - self.timing.started
+            self.timing.started = now
+
+    @override
+    def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        params: Optional[bytes] = None,
+        data: Union[None, bytes, MultipartEncoder] = None,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+        stream: bool = False,
+    ) -> requests.Response:
+        headers = dict(headers or {})
+        content: Union[None, bytes, Iterator[bytes]] = None
+        if isinstance(data, MultipartEncoder):
+            body = data
+            headers["Content-Length"] = str(len(body))
+            content = iter(lambda: body.read(64 * 1024), b"")
+        else:
+            content = data
+
+        start = time.monotonic()
+        request = self.httpx_client.build_request(
+            method,
+            url,
+            params=params.decode() if params is not None else None,
+            content=content,
+            headers=headers,
+            timeout=httpx.Timeout(timeout),
+            extensions={"trace": self.trace},
+        )
+        try:
+            response = self.httpx_client.send(request, stream=True)
+        except httpx.HTTPError as e:
+            raise requests_error(e) from e
+
+        res = requests.Response()
+        res.status_code = response.status_code
+        res.headers = requests.structures.CaseInsensitiveDict(response.headers.items())
+        res.encoding = requests.utils.get_encoding_from_headers(res.headers)
+        res.reason = response.reason_phrase
+        res.url = str(response.url)
+        res.elapsed = datetime.timedelta(seconds=time.monotonic() - start)
+        res.request = requests.Request(method, url, headers=headers).prepare()
+        res.request.body = data  # type: ignore[assignment] # For request_body_size.
+        res.raw = ResponseBody(response)
+        if not stream:
+            # Read it now, so that errors are raised here.
+            res.content  # noqa: B018
+            response.close()
+        return res
+
+    @override
+    def close(self) -> None:
+        self.httpx_client.close()
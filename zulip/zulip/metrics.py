@@ -0,0 +1,200 @@
+import bisect
+import os
+import tempfile
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+from zulip import RequestRecord
+
+# In seconds; the last ones catch long-polling requests.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 90)
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = list(buckets)
+        # The last count is for values above the largest bucket.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> List[Tuple[float, int]]:
+        result = []
+        total = 0
+        for bound, count in zip([*self.buckets, float("inf")], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates the q-quantile by interpolating within the bucket it
+        falls in, like Prometheus' histogram_quantile().
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        lower_bound, lower_count = 0.0, 0
+        for bound, count in self.cumulative_counts():
+            if count >= rank:
+                if bound == float("inf"):
+                    return lower_bound
+                if count == lower_count:
+                    return bound
+                return lower_bound + (bound - lower_bound) * (rank - lower_count) / (
+                    count - lower_count
+                )
+            lower_bound, lower_count = bound, count
+        return lower_bound
+
+
+class EndpointMetrics:
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.total_time = Histogram(buckets)
+        self.ttfb = Histogram(buckets)
+        self.connect_time = Histogram(buckets)
+        # By status code, or exception name for requests which failed.
+        self.requests: Dict[str, int] = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+        self.backoff_time = 0.0
+
+
+class RequestMetrics:
+    """
+    Collects the RequestRecords of a client's requests into latency
+    histograms and counters per endpoint and method:
+
+    >>> metrics = RequestMetrics()
+    >>> client.request_hooks.append(metrics)
+    >>> ...
+    >>> metrics.slowest_endpoints()
+    [('GET', 'messages', 1.8), ('POST', 'messages', 0.21), ...]
+    >>> metrics.write_prometheus("/var/lib/node_exporter/zulip_bot.prom")
+
+    Note that long-polling requests for events (GET events) take up
+    to 90 seconds by design.
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets = sorted(buckets)
+        self.lock = threading.Lock()
+        self.endpoints: Dict[Tuple[str, str], EndpointMetrics] = {}
+
+    def __call__(self, record: RequestRecord) -> None:
+        self.add(record)
+
+    def add(self, record: RequestRecord) -> None:
+        with self.lock:
+            metrics = self.endpoints.get((record.method, record.endpoint))
+            if metrics is None:
+                metrics = self.endpoints[(record.method, record.endpoint)] = EndpointMetrics(
+                    self.buckets
+                )
+            metrics.total_time.observe(record.total_time)
+            if record.ttfb is not None:
+                metrics.ttfb.observe(record.ttfb)
+            metrics.connect_time.observe(record.connect_time)
+            outcome = str(record.status) if record.error is None else record.error
+            metrics.requests[outcome] = metrics.requests.get(outcome, 0) + 1
+            metrics.bytes_sent += record.bytes_sent
+            metrics.bytes_received += record.bytes_received or 0
+            metrics.retries += record.retries
+            metrics.backoff_time += record.backoff_time
+
+    def clear(self) -> None:
+        with self.lock:
+            self.endpoints.clear()
+
+    def slowest_endpoints(
+        self, quantile: float = 0.99, limit: int = 10
+    ) -> List[Tuple[str, str, float]]:
+        """
+        Returns the method, endpoint and estimated quantile of the
+        total request time of the `limit` slowest endpoints.
+        """
+        with self.lock:
+            latencies = [
+                (method, endpoint, metrics.total_time.quantile(quantile))
+                for (method, endpoint), metrics in self.endpoints.items()
+            ]
+        latencies.sort(key=lambda latency: latency[2], reverse=True)
+        return latencies[:limit]
+
+    def to_prometheus(self, prefix: str = "zulip_api") -> str:
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        lines: List[str] = []
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+
+            for name, help_text in [
+                ("request_duration_seconds", "Time taken by requests, retries included."),
+                ("request_ttfb_seconds", "Time until the response headers arrived."),
+                ("request_connect_seconds", "Time spent opening connections."),
+            ]:
+                metric = f"{prefix}_{name}"
+                lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} histogram"]
+                for (method, endpoint), metrics in endpoints:
+                    histogram = {
+                        "request_duration_seconds": metrics.total_time,
+                        "request_ttfb_seconds": metrics.ttfb,
+                        "request_connect_seconds": metrics.connect_time,
+                    }[name]
+                    labels = prometheus_labels(method=method, endpoint=endpoint)
+                    for bound, count in histogram.cumulative_counts():
+                        le = "+Inf" if bound == float("inf") else repr(float(bound))
+                        bucket_labels = prometheus_labels(method=method, endpoint=endpoint, le=le)
+                        lines.append(f"{metric}_bucket{bucket_labels} {count}")
+                    lines.append(f"{metric}_sum{labels} {histogram.sum!r}")
+                    lines.append(f"{metric}_count{labels} {histogram.count}")
+
+            metric = f"{prefix}_requests_total"
+            lines += [
+                f"# HELP {metric} Requests, by status code or exception.",
+                f"# TYPE {metric} counter",
+            ]
+            for (method, endpoint), metrics in endpoints:
+                for status, count in sorted(metrics.requests.items()):
+                    labels = prometheus_labels(method=method, endpoint=endpoint, status=status)
+                    lines.append(f"{metric}{labels} {count}")
+
+            for name, attribute, help_text in [
+                ("request_bytes_sent_total", "bytes_sent", "Bytes of request bodies sent."),
+                ("response_bytes_received_total", "bytes_received", "Bytes of responses received."),
+                ("request_retries_total", "retries", "Requests retried."),
+                ("request_backoff_seconds_total", "backoff_time", "Time spent waiting to retry."),
+            ]:
+                metric = f"{prefix}_{name}"
+                lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+                for (method, endpoint), metrics in endpoints:
+                    labels = prometheus_labels(method=method, endpoint=endpoint)
+                    lines.append(f"{metric}{labels} {getattr(metrics, attribute)!r}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str, prefix: str = "zulip_api") -> None:
+        """
+        Writes the metrics to `path` atomically, e.g. for the textfile
+        collector of the Prometheus node exporter.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, prefix=".zulip-metrics-", delete=False
+        ) as f:
+            f.write(self.to_prometheus(prefix))
+        os.replace(f.name, path)
+
+
+def prometheus_labels(**labels: str) -> str:
+    escaped = (
+        value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in labels.values()
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
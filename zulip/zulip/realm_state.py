@@ -0,0 +1,297 @@
+import threading
+from typing import Any, ClassVar, Dict, Iterable, List, Optional, Set
+
+from zulip import Client
+
+
+class RealmStateMirror:
+    """
+    An in-memory copy of a realm's users, streams, subscriptions and
+    user groups, kept up to date by events, so that looking them up
+    doesn't take a round trip to the server:
+
+    >>> mirror = RealmStateMirror(client)
+    >>> mirror.start()
+    >>> mirror.wait_until_loaded()
+    >>> mirror.get_user_by_email("hamlet@example.com")["full_name"]
+    'King Hamlet'
+
+    start() runs its own event queue in a background thread.  Instead,
+    to use an event queue you also use for other events, pass
+    MIRRORED_EVENT_TYPES as fetch_event_types to register(), and feed
+    the response to load() and every event to apply_event().
+
+    Updates are made under a lock, and lookups that return sets or
+    lists build them under it; the dictionaries returned are the
+    mirror's own, so don't modify them.
+    """
+
+    MIRRORED_EVENT_TYPES: ClassVar[List[str]] = [
+        "realm_user",
+        "stream",
+        "subscription",
+        "user_group",
+    ]
+
+    def __init__(self, client: Client, include_subscribers: bool = True) -> None:
+        self.client = client
+        self.include_subscribers = include_subscribers
+        self.lock = threading.RLock()
+        self.loaded = threading.Event()
+
+        self.users: Dict[int, Dict[str, Any]] = {}
+        self.user_ids_by_email: Dict[str, int] = {}
+        self.user_ids_by_name: Dict[str, Set[int]] = {}
+        self.streams: Dict[int, Dict[str, Any]] = {}
+        self.stream_ids_by_name: Dict[str, int] = {}
+        self.subscriptions: Dict[int, Dict[str, Any]] = {}
+        self.subscribers: Dict[int, Set[int]] = {}
+        self.user_groups: Dict[int, Dict[str, Any]] = {}
+        self.user_group_ids_by_name: Dict[str, int] = {}
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.run, name="zulip-realm-state", daemon=True)
+        thread.start()
+        return thread
+
+    def run(self) -> None:
+        # call_on_each_event reloads the state whenever it has to
+        # register a new queue, since events may have been missed.
+        self.client.call_on_each_event(
+            self.apply_event,
+            self.MIRRORED_EVENT_TYPES,
+            fetch_event_types=self.MIRRORED_EVENT_TYPES,
+            include_subscribers=self.include_subscribers,
+            register_callback=self.load,
+        )
+
+    def wait_until_loaded(self, timeout: Optional[float] = None) -> bool:
+        return self.loaded.wait(timeout)
+
+    # Lookups
+
+    def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return self.users.get(user_id)
+
+    def get_user_by_email(self, email: str) -> Optional[Dict[str, Any]]:
+        user_id = self.user_ids_by_email.get(email.lower())
+        return None if user_id is None else self.users.get(user_id)
+
+    def get_users_by_name(self, full_name: str) -> List[Dict[str, Any]]:
+        # Unlike emails, names need not be unique.
+        with self.lock:
+            user_ids = self.user_ids_by_name.get(full_name.lower(), set())
+            return [self.users[user_id] for user_id in user_ids if user_id in self.users]
+
+    def get_stream(self, stream_id: int) -> Optional[Dict[str, Any]]:
+        return self.streams.get(stream_id)
+
+    def get_stream_by_name(self, name: str) -> Optional[Dict[str, Any]]:
+        stream_id = self.stream_ids_by_name.get(name.lower())
+        return None if stream_id is None else self.streams.get(stream_id)
+
+    def get_subscription(self, stream_id: int) -> Optional[Dict[str, Any]]:
+        return self.subscriptions.get(stream_id)
+
+    def is_subscribed(self, stream_id: int) -> bool:
+        return stream_id in self.subscriptions
+
+    def get_subscribers(self, stream_id: int) -> Set[int]:
+        # A copy, since events change the mirror's sets in place.
+        with self.lock:
+            return set(self.subscribers.get(stream_id, set()))
+
+    def get_user_group(self, group_id: int) -> Optional[Dict[str, Any]]:
+        return self.user_groups.get(group_id)
+
+    def get_user_group_by_name(self, name: str) -> Optional[Dict[str, Any]]:
+        group_id = self.user_group_ids_by_name.get(name.lower())
+        return None if group_id is None else self.user_groups.get(group_id)
+
+    # Updates
+
+    def load(self, state: Dict[str, Any]) -> None:
+        """
+        Replaces the mirrored state with the state in a register()
+        response.
+        """
+        with self.lock:
+            self.users.clear()
+            self.user_ids_by_email.clear()
+            self.user_ids_by_name.clear()
+            for user in state.get("realm_users", []) + state.get("realm_non_active_users", []):
+                self.add_user(user)
+
+            self.streams.clear()
+            self.stream_ids_by_name.clear()
+            for stream in state.get("streams", []):
+                self.add_stream(stream)
+
+            self.subscriptions.clear()
+            self.subscribers.clear()
+            for subscription in state.get("subscriptions", []):
+                self.subscriptions[subscription["stream_id"]] = subscription
+            for subscription in (
+                state.get("subscriptions", [])
+                + state.get("unsubscribed", [])
+                + state.get("never_subscribed", [])
+            ):
+                if "subscribers" in subscription:
+                    self.subscribers[subscription["stream_id"]] = set(subscription["subscribers"])
+
+            self.user_groups.clear()
+            self.user_group_ids_by_name.clear()
+            for group in state.get("realm_user_groups", []):
+                self.add_user_group(group)
+        self.loaded.set()
+
+    def apply_event(self, event: Dict[str, Any]) -> None:
+        handler = {
+            "realm_user": self.apply_realm_user_event,
+            "stream": self.apply_stream_event,
+            "subscription": self.apply_subscription_event,
+            "user_group": self.apply_user_group_event,
+        }.get(event["type"])
+        if handler is not None:
+            with self.lock:
+                handler(event)
+
+    def add_user(self, user: Dict[str, Any]) -> None:
+        self.users[user["user_id"]] = user
+        self.user_ids_by_email[user["email"].lower()] = user["user_id"]
+        self.user_ids_by_name.setdefault(user["full_name"].lower(), set()).add(user["user_id"])
+
+    def remove_user(self, user_id: int) -> None:
+        user = self.users.pop(user_id, None)
+        if user is None:
+            return
+        self.user_ids_by_email.pop(user["email"].lower(), None)
+        self.user_ids_by_name.get(user["full_name"].lower(), set()).discard(user_id)
+
+    def apply_realm_user_event(self, event: Dict[str, Any]) -> None:
+        person = event["person"]
+        if event["op"] == "add":
+            self.add_user(person)
+        elif event["op"] == "remove":
+            self.remove_user(person["user_id"])
+        elif event["op"] == "update":
+            user = self.users.get(person["user_id"])
+            if user is None:
+                return
+            # Re-index the user after the update.
+            self.remove_user(user["user_id"])
+            for key, value in person.items():
+                if key == "new_email":
+                    user["email"] = value
+                elif key == "custom_profile_field":
+                    user.setdefault("profile_data", {})[str(value["id"])] = {
+                        field: value[field]
+                        for field in ["value", "rendered_value"]
+                        if field in value
+                    }
+                else:
+                    user[key] = value
+            self.add_user(user)
+
+    def add_stream(self, stream: Dict[str, Any]) -> None:
+        self.streams[stream["stream_id"]] = stream
+        self.stream_ids_by_name[stream["name"].lower()] = stream["stream_id"]
+
+    def remove_stream(self, stream_id: int) -> None:
+        stream = self.streams.pop(stream_id, None)
+        if stream is not None:
+            self.stream_ids_by_name.pop(stream["name"].lower(), None)
+        self.subscriptions.pop(stream_id, None)
+        self.subscribers.pop(stream_id, None)
+
+    def apply_stream_event(self, event: Dict[str, Any]) -> None:
+        if event["op"] == "create":
+            for stream in event["streams"]:
+                self.add_stream(stream)
+        elif event["op"] == "delete":
+            stream_ids = event.get("stream_ids") or [
+                stream["stream_id"] for stream in event["streams"]
+            ]
+            for stream_id in stream_ids:
+                self.remove_stream(stream_id)
+        elif event["op"] == "update":
+            # Some properties come with derived ones, like the rendered
+            # description; update those too.
+            update = {
+                key: value
+                for key, value in event.items()
+                if key not in ["id", "type", "op", "property", "value", "stream_id", "name"]
+            }
+            update[event["property"]] = event["value"]
+            for record in [
+                self.streams.get(event["stream_id"]),
+                self.subscriptions.get(event["stream_id"]),
+            ]:
+                if record is not None:
+                    record.update(update)
+            stream = self.streams.get(event["stream_id"])
+            if stream is not None and event["property"] == "name":
+                self.stream_ids_by_name.pop(event["name"].lower(), None)
+                self.stream_ids_by_name[stream["name"].lower()] = stream["stream_id"]
+
+    def apply_subscription_event(self, event: Dict[str, Any]) -> None:
+        if event["op"] == "add":
+            for subscription in event["subscriptions"]:
+                self.subscriptions[subscription["stream_id"]] = subscription
+                if "subscribers" in subscription:
+                    self.subscribers[subscription["stream_id"]] = set(subscription["subscribers"])
+        elif event["op"] == "remove":
+            for subscription in event["subscriptions"]:
+                self.subscriptions.pop(subscription["stream_id"], None)
+        elif event["op"] == "update":
+            subscription = self.subscriptions.get(event["stream_id"])
+            if subscription is not None:
+                subscription[event["property"]] = event["value"]
+        elif event["op"] in ["peer_add", "peer_remove"]:
+            # Servers before feature level 35 send one stream and user.
+            stream_ids = event.get("stream_ids", [event.get("stream_id")])
+            user_ids = event.get("user_ids", [event.get("user_id")])
+            for stream_id in stream_ids:
+                subscribers = self.subscribers.setdefault(stream_id, set())
+                if event["op"] == "peer_add":
+                    subscribers.update(user_ids)
+                else:
+                    subscribers.difference_update(user_ids)
+                subscription = self.subscriptions.get(stream_id)
+                if subscription is not None and "subscribers" in subscription:
+                    subscription["subscribers"] = sorted(subscribers)
+
+    def add_user_group(self, group: Dict[str, Any]) -> None:
+        self.user_groups[group["id"]] = group
+        self.user_group_ids_by_name[group["name"].lower()] = group["id"]
+
+    def apply_user_group_event(self, event: Dict[str, Any]) -> None:
+        if event["op"] == "add":
+            self.add_user_group(event["group"])
+            return
+        group = self.user_groups.get(event["group_id"])
+        if group is None:
+            return
+        if event["op"] == "remove":
+            del self.user_groups[group["id"]]
+            self.user_group_ids_by_name.pop(group["name"].lower(), None)
+        elif event["op"] == "update":
+            self.user_group_ids_by_name.pop(group["name"].lower(), None)
+            group.update(event["data"])
+            self.add_user_group(group)
+        elif event["op"] in ["add_members", "remove_members"]:
+            group["members"] = update_id_list(
+                group.get("members", []), event["user_ids"], event["op"] == "add_members"
+            )
+        elif event["op"] in ["add_subgroups", "remove_subgroups"]:
+            group["direct_subgroup_ids"] = update_id_list(
+                group.get("direct_subgroup_ids", []),
+                event["direct_subgroup_ids"],
+                event["op"] == "add_subgroups",
+            )
+
+
+def update_id_list(ids: List[int], changed_ids: Iterable[int], add: bool) -> List[int]:
+    if add:
+        return sorted(set(ids).union(changed_ids))
+    return sorted(set(ids).difference(changed_ids))
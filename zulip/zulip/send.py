@@ -4,18 +4,17 @@
 import argparse
 import logging
 import sys
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 import zulip
+from zulip import send_daemon
 
 logging.basicConfig()
 
 log = logging.getLogger("zulip-send")
 
 
-def do_send_message(client: zulip.Client, message_data: Dict[str, Any]) -> bool:
-    """Sends a message and optionally prints status about the same."""
-
+def log_sending(message_data: Dict[str, Any]) -> None:
     if message_data["type"] == "stream":
         log.info(
             "Sending message to stream %r, subject %r... ",
@@ -24,7 +23,9 @@ def do_send_message(client: zulip.Client, message_data: Dict[str, Any]) -> bool:
         )
     else:
         log.info("Sending message to %s... ", message_data["to"])
-    response = client.send_message(message_data)
+
+
+def log_response(response: Dict[str, Any]) -> bool:
     if response["result"] == "success":
         log.info("Message sent.")
         return True
@@ -33,6 +34,29 @@ def do_send_message(client: zulip.Client, message_data: Dict[str, Any]) -> bool:
         return False
 
 
+def do_send_message(client: zulip.Client, message_data: Dict[str, Any]) -> bool:
+    """Sends a message and optionally prints status about the same."""
+
+    log_sending(message_data)
+    return log_response(client.send_message(message_data))
+
+
+def do_send_message_via_daemon(
+    options: Any, message_data: Dict[str, Any], socket_path: Optional[str]
+) -> bool:
+    """
+    Hands a message to zulip-send-daemon, or, if it isn't running,
+    sends it directly, and optionally prints status about the same.
+    """
+
+    log_sending(message_data)
+    return log_response(
+        send_daemon.send_message(
+            message_data, lambda: zulip.init_from_options(options), socket_path
+        )
+    )
+
+
 def main() -> int:
     usage = """zulip-send [options] [recipient...]
 
@@ -70,6 +94,21 @@ def main() -> int:
         help="Allows the user to specify a subject for the message.",
     )
 
+    group = parser.add_argument_group("Send daemon")
+    group.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Hand the message to zulip-send-daemon, which sends it as its own user, "
+        "rather than connecting to the server; if the daemon isn't running, "
+        "send the message directly.",
+    )
+    group.add_argument(
+        "--daemon-socket",
+        metavar="PATH",
+        help="The socket zulip-send-daemon listens on; implies --daemon. "
+        "Defaults to $ZULIP_SEND_SOCKET, or a socket in the user's runtime directory.",
+    )
+
     options = parser.parse_args()
 
     if options.verbose:
@@ -82,8 +121,6 @@ def main() -> int:
     if len(options.recipients) == 0 and not (options.stream and options.subject):
         parser.error("You must specify a stream/subject or at least one recipient.")
 
-    client = zulip.init_from_options(options)
-
     if not options.message:
         options.message = sys.stdin.read()
 
@@ -101,7 +138,11 @@ def main() -> int:
             "to": options.recipients,
         }
 
-    if not do_send_message(client, message_data):
+    if options.daemon or options.daemon_socket:
+        sent = do_send_message_via_daemon(options, message_data, options.daemon_socket)
+    else:
+        sent = do_send_message(zulip.init_from_options(options), message_data)
+    if not sent:
         return 1
     return 0
 
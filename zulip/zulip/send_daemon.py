@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# zulip-send-daemon -- Keeps a warm Zulip client, which sends the
+# messages handed to it on a Unix socket.
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+from typing import Any, Callable, Dict, Optional
+
+from typing_extensions import override
+
+import zulip
+
+logger = logging.getLogger(__name__)
+
+
+def default_socket_path() -> str:
+    """
+    The socket the daemon listens on and zulip-send hands messages to,
+    unless told otherwise: $ZULIP_SEND_SOCKET, or a socket in the
+    user's runtime directory.
+    """
+    if "ZULIP_SEND_SOCKET" in os.environ:
+        return os.environ["ZULIP_SEND_SOCKET"]
+    if "XDG_RUNTIME_DIR" in os.environ:
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "zulip-send.sock")
+    return os.path.join(tempfile.gettempdir(), f"zulip-send-{os.getuid()}.sock")
+
+
+def send_via_daemon(
+    message_data: Dict[str, Any], socket_path: Optional[str] = None, timeout: float = 60
+) -> Optional[Dict[str, Any]]:
+    """
+    Hands a message to the send daemon listening on `socket_path`, and
+    returns the server's response, or None if the message couldn't be
+    handed to it: no daemon is listening, or it went away before taking
+    the message.
+
+    Once the daemon has taken the message, it may or may not have been
+    sent, so UnrecoverableNetworkError is raised rather than None
+    returned if no whole, valid reply comes back, to not send it twice.
+    """
+    if socket_path is None:
+        socket_path = default_socket_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(socket_path)
+            sock.sendall(json.dumps({"message": message_data}).encode() + b"\n")
+        except OSError as e:
+            logger.debug("Couldn't hand the message to the send daemon at %s: %s", socket_path, e)
+            return None
+        try:
+            with sock.makefile("rb") as f:
+                reply = f.readline()
+        except OSError as e:
+            raise zulip.UnrecoverableNetworkError(f"Lost the send daemon: {e}") from e
+        # A reply cut short has no final newline.
+        if not reply.endswith(b"\n"):
+            raise zulip.UnrecoverableNetworkError("The send daemon closed the connection")
+        try:
+            response = json.loads(reply)
+        except ValueError:
+            response = None
+        if not isinstance(response, dict):
+            raise zulip.UnrecoverableNetworkError(f"Invalid reply from the send daemon: {reply!r}")
+        return response
+    finally:
+        sock.close()
+
+
+def send_message(
+    message_data: Dict[str, Any],
+    get_client: Callable[[], zulip.Client],
+    socket_path: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Sends a message through the send daemon if one is listening on
+    `socket_path`, and otherwise with the client returned by
+    get_client(), which is only called in that case.
+    """
+    response = send_via_daemon(message_data, socket_path)
+    if response is None:
+        logger.debug("No send daemon at %s; sending directly", socket_path)
+        response = get_client().send_message(message_data)
+    return response
+
+
+class SendRequestHandler(socketserver.StreamRequestHandler):
+    server: "SendDaemon"
+
+    @override
+    def handle(self) -> None:
+        # Each line is one JSON request, answered by one JSON line.
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                response = self.server.client.send_message(request["message"])
+            except Exception as e:
+                logger.exception("Error sending message")
+                response = {"result": "error", "msg": f"{type(e).__name__}: {e}"}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class SendDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Listens on the Unix socket at `socket_path`, and sends the messages
+    handed to it with `client`, whose pooled connections to the server
+    are kept alive between messages.  Messages are sent concurrently,
+    so the client's pool_maxsize bounds how many are in flight at once.
+
+    The socket is only accessible to the daemon's user, since anyone
+    who can connect to it can send messages as the client's user.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, client: zulip.Client, socket_path: str) -> None:
+        self.client = client
+        self.socket_path = socket_path
+        self.remove_stale_socket()
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, SendRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def remove_stale_socket(self) -> None:
+        if not os.path.exists(self.socket_path):
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except ConnectionRefusedError:
+            # Left behind by a daemon that didn't exit cleanly.
+            os.unlink(self.socket_path)
+        else:
+            raise zulip.ZulipError(f"A send daemon is already listening on {self.socket_path}")
+        finally:
+            sock.close()
+
+    @override
+    def server_close(self) -> None:
+        super().server_close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.socket_path)
+
+
+def main() -> int:
+    usage = """zulip-send-daemon [options]
+
+    Keeps a connection to the Zulip server open, and sends the messages
+    handed to it by `zulip-send --daemon` and the integrations' hooks,
+    which then don't each have to connect to the server.
+
+    Specify your Zulip API credentials and server in a ~/.zuliprc file or using the options.
+    """
+    parser = zulip.add_default_arguments(argparse.ArgumentParser(usage=usage))
+    parser.add_argument(
+        "--socket",
+        default=default_socket_path(),
+        help="the Unix socket to listen on (default: %(default)s)",
+    )
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if options.verbose else logging.WARNING)
+
+    client = zulip.init_from_options(options, client="ZulipSendDaemon/" + zulip.__version__)
+    server = SendDaemon(client, options.socket)
+
+    def handle_sigterm(signum: int, frame: object) -> None:
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    logger.info("Listening on %s", options.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -47,6 +47,7 @@ setup(
         "console_scripts": [
             "zulip-run-bot=zulip_bots.run:main",
             "zulip-bot-shell=zulip_bots.bot_shell:main",
+            "zulip-run-bots=zulip_bots.multiplex:main",
         ],
     },
     install_requires=[
@@ -58,6 +59,7 @@ setup(
         "typing_extensions>=4.5.0",
         'importlib-metadata >= 3.6; python_version  < "3.10"',
     ],
+    extras_require={"multiplex": ["zulip[async]"], "lmdb": ["lmdb"]},
     packages=find_packages(),
     package_data=package_data,
 )
@@ -1,12 +1,45 @@
-from typing import Any, Dict, Sequence
+import json
+from typing import Any, Dict, List, Optional, Sequence, Tuple, cast
 from unittest.mock import patch
 
 from typing_extensions import override
 
-from zulip_bots.game_handler import GameInstance
+from zulip import Client
+from zulip_bots.game_handler import GameInstance, Leaderboard
+from zulip_bots.lib import StateHandler
 from zulip_bots.test_lib import BotTestCase, DefaultTests
 
 
+class FakeStorageServer:
+    """
+    The bot storage of a Zulip server, shared by the StateHandlers of
+    several processes running the bot.
+    """
+
+    def __init__(self) -> None:
+        self.storage: Dict[str, str] = {}
+        self.get_storage_calls = 0
+
+    def get_storage(self, request: Optional[Dict[str, List[str]]] = None) -> Dict[str, Any]:
+        self.get_storage_calls += 1
+        keys = request["keys"] if request is not None else list(self.storage)
+        if any(key not in self.storage for key in keys):
+            return {"result": "error", "msg": "Key does not exist."}
+        return {"result": "success", "storage": {key: self.storage[key] for key in keys}}
+
+    def update_storage(self, request: Dict[str, Dict[str, str]]) -> Dict[str, Any]:
+        self.storage.update(request["storage"])
+        return {"result": "success"}
+
+    def remove_storage(self, request: Dict[str, List[str]]) -> Dict[str, Any]:
+        for key in request["keys"]:
+            del self.storage[key]
+        return {"result": "success"}
+
+    def get(self, key: str) -> Any:
+        return StateHandler(cast(Client, self)).get(key)
+
+
 class TestGameHandlerBot(BotTestCase, DefaultTests):
     bot_name = "game_handler_bot"
 
@@ -572,6 +605,223 @@ Player | Games Won | Games Drawn | Games Lost | Total Games\n\
         bot.add_user_statistics("foo@example.com", {"foo": 3})
         self.assertEqual(bot.user_cache["foo@example.com"]["stats"]["foo"], 3)
 
+    def test_user_cache_storage(self) -> None:
+        bot = self.add_user_to_cache("foo")
+        self.add_user_to_cache("baz", bot)
+        storage = bot.bot_handler.storage
+        self.assertEqual(storage.get("user_emails"), ["foo@example.com", "baz@example.com"])
+        self.assertEqual(storage.get("user:baz@example.com")["full_name"], "baz")
+
+        with patch.object(storage, "put", wraps=storage.put) as put:
+            bot.add_user_statistics("baz@example.com", {"games_won": 1, "total_games": 1})
+        put.assert_called_once_with("user:baz@example.com", bot.user_cache["baz@example.com"])
+
+        bot, bot_handler = self._get_handlers()
+        bot_handler.storage = storage
+        bot.initialize(bot_handler)
+        self.assertEqual(bot.user_cache["baz@example.com"]["stats"]["games_won"], 1)
+        self.assertEqual(bot.leaderboard.top(), ["baz@example.com", "foo@example.com"])
+
+    def test_user_cache_shared_storage(self) -> None:
+        # Two processes running the bot.
+        bot, bot_handler = self._get_handlers()
+        other_bot, other_bot_handler = self._get_handlers()
+        other_bot_handler.storage = bot_handler.storage
+        other_bot.initialize(other_bot_handler)
+
+        self.add_user_to_cache("foo", bot)
+        other_bot.handle_message(
+            self.make_request_message("help", "baz@example.com", "baz"), other_bot_handler
+        )
+        other_bot.add_user_statistics("foo@example.com", {"games_won": 1, "total_games": 1})
+        bot.handle_message(self.make_request_message("help", "baz@example.com", "baz"), bot_handler)
+        bot.add_user_statistics("baz@example.com", {"games_lost": 1, "total_games": 1})
+
+        storage = bot_handler.storage
+        self.assertEqual(
+            storage.get("user_emails"),
+            ["foo@example.com", "test-bot@example.com", "baz@example.com"],
+        )
+        self.assertEqual(storage.get("user:foo@example.com")["stats"]["games_won"], 1)
+        self.assertEqual(storage.get("user:baz@example.com")["stats"]["games_lost"], 1)
+
+    def get_handlers_on_server(self, server: FakeStorageServer) -> Tuple[Any, Any]:
+        # A process running the bot, with its own StateHandler.
+        bot, bot_handler = self._get_handlers()
+        storage_handler: Any = bot_handler
+        storage_handler.storage = StateHandler(cast(Client, server))
+        bot.initialize(storage_handler)
+        return bot, storage_handler
+
+    def test_user_cache_state_handler(self) -> None:
+        server = FakeStorageServer()
+        bot, bot_handler = self.get_handlers_on_server(server)
+        other_bot, other_bot_handler = self.get_handlers_on_server(server)
+        bot.handle_message(self.make_request_message("help", "foo@example.com", "foo"), bot_handler)
+        other_bot.handle_message(
+            self.make_request_message("help", "baz@example.com", "baz"), other_bot_handler
+        )
+        bot.handle_message(self.make_request_message("help", "qux@example.com", "qux"), bot_handler)
+        self.assertEqual(
+            server.get("user_emails"),
+            ["test-bot@example.com", "foo@example.com", "baz@example.com", "qux@example.com"],
+        )
+
+        # Without playing against the computer, the bot itself is never
+        # a user, and isn't looked for in storage.
+        server = FakeStorageServer()
+        bot, bot_handler = self.get_handlers_on_server(server)
+        bot.supports_computer = False
+        bot.handle_message(self.make_request_message("help", "foo@example.com", "foo"), bot_handler)
+        server.get_storage_calls = 0
+        bot.handle_message(self.make_request_message("help", "foo@example.com", "foo"), bot_handler)
+        self.assertEqual(server.get_storage_calls, 0)
+        self.assertEqual(server.get("user_emails"), ["foo@example.com"])
+
+    def test_legacy_user_cache(self) -> None:
+        bot, bot_handler = self._get_handlers()
+        user_cache = {
+            f"{name}@example.com": {
+                "email": f"{name}@example.com",
+                "full_name": name,
+                "stats": {"total_games": 2, "games_won": wins, "games_lost": 0, "games_drawn": 0},
+            }
+            for name, wins in [("foo", 0), ("baz", 2)]
+        }
+        bot_handler.storage.put("users", json.dumps(user_cache))
+        bot.initialize(bot_handler)
+        self.assertEqual(bot.user_cache, user_cache)
+        self.assertEqual(
+            bot_handler.storage.get("user:foo@example.com"), user_cache["foo@example.com"]
+        )
+        self.assertEqual(
+            bot.get_sorted_player_statistics(),
+            [
+                (email, user_cache[email]["stats"])
+                for email in ["baz@example.com", "foo@example.com"]
+            ],
+        )
+
+    def test_game_storage(self) -> None:
+        bot = self.setup_game()
+        bot_handler = bot.bot_handler
+        invite = {"subject": "###private###", "host": "foo@example.com", "baz@example.com": "p"}
+        bot.invites = {"def456": invite}
+        bot.handle_message(
+            self.make_request_message(
+                "move 3", "foo@example.com", "foo", "stream", "test", "test game"
+            ),
+            bot_handler,
+        )
+        self.assertEqual(bot_handler.storage.get("invites"), {"def456": invite})
+        self.assertEqual(bot_handler.storage.get("game:abc123")["turn"], 1)
+
+        # Restarted, the bot restores the game on its next message.
+        bot, new_bot_handler = self._get_handlers()
+        new_bot_handler.storage = bot_handler.storage
+        bot.initialize(new_bot_handler)
+        self.assertEqual(bot.invites, {"def456": invite})
+        self.assertIn("abc123", bot.instances)
+        self.assertEqual(len(bot.instances.live), 0)
+        bot.handle_message(
+            self.make_request_message(
+                "move 4", "baz@example.com", "baz", "stream", "test", "test game"
+            ),
+            new_bot_handler,
+        )
+        self.assertEqual(
+            new_bot_handler.transcript[0][1]["content"],
+            "**baz** moved in column 4\n\nfoo\n\nIt's **foo**'s (:blue_circle:) turn.",
+        )
+
+        bot.cancel_game("abc123")
+        self.assertNotIn("abc123", bot.instances)
+        self.assertFalse(new_bot_handler.storage.contains("game:abc123"))
+        self.assertEqual(new_bot_handler.storage.get("games"), {})
+
+    def test_game_storage_state_handler(self) -> None:
+        # Two processes running the bot, keeping no game in memory.
+        server = FakeStorageServer()
+        bot, bot_handler = self.get_handlers_on_server(server)
+        other_bot, other_bot_handler = self.get_handlers_on_server(server)
+        bot.instances.max_live = other_bot.instances.max_live = 0
+        self.setup_game(bot=bot)
+        bot.put_games()
+        self.setup_game("def456", other_bot, ["bar", "qux"], "other game")
+        other_bot.put_games()
+        self.assertEqual(sorted(server.get("games")), ["abc123", "def456"])
+
+        # Each sees the moves the other has made.
+        other_bot.handle_message(
+            self.make_request_message(
+                "move 3", "foo@example.com", "foo", "stream", "test", "test game"
+            ),
+            other_bot_handler,
+        )
+        bot_handler.reset_transcript()
+        bot.handle_message(
+            self.make_request_message(
+                "move 4", "baz@example.com", "baz", "stream", "test", "test game"
+            ),
+            bot_handler,
+        )
+        self.assertEqual(
+            bot_handler.transcript[0][1]["content"],
+            "**baz** moved in column 4\n\nfoo\n\nIt's **foo**'s (:blue_circle:) turn.",
+        )
+
+        # Invites sent at the same time are all kept.
+        invite = {"subject": "###private###", "host": "foo@example.com", "baz@example.com": "p"}
+        bot.get_games()
+        other_bot.get_games()
+        bot.invites["ghi789"] = invite
+        bot.put_games()
+        other_bot.invites["jkl012"] = invite
+        other_bot.put_games()
+        self.assertEqual(sorted(server.get("invites")), ["ghi789", "jkl012"])
+
+        # A game ended by one is gone for the other.
+        other_bot.cancel_game("abc123")
+        other_bot.put_games()
+        bot.handle_message(self.make_request_message("help"), bot_handler)
+        self.assertEqual(list(bot.instances), ["def456"])
+        self.assertNotIn("game:abc123", server.storage)
+
+    def test_live_games_limit(self) -> None:
+        bot = self.setup_game()
+        bot.instances.max_live = 1
+        self.setup_game("def456", bot, ["bar", "qux"], "other game")
+        bot.put_games()
+        self.assertEqual(list(bot.instances.live), ["def456"])
+        self.assertEqual(len(bot.instances), 2)
+        self.assertEqual(bot.get_game_id_by_email("baz@example.com"), "abc123")
+        self.assertEqual(bot.get_players("abc123"), ["foo@example.com", "baz@example.com"])
+        bot.put_games()
+        self.assertEqual(list(bot.instances.live), ["abc123"])
+
+        # A subject change that was asked for is kept when the game is restored.
+        bot.pending_subject_changes.append("abc123")
+        bot.get_game_info("abc123")
+        bot.put_games()
+        bot.pending_subject_changes.clear()
+        bot.instances.load()
+        self.assertEqual(bot.instances["abc123"].subject, "test game")
+        self.assertEqual(bot.pending_subject_changes, ["abc123"])
+
+    def test_leaderboard(self) -> None:
+        leaderboard = Leaderboard()
+        for player, won, drawn, total in [("a", 1, 0, 2), ("b", 1, 0, 2), ("c", 1, 1, 2)]:
+            leaderboard.update(
+                player, {"games_won": won, "games_drawn": drawn, "total_games": total}
+            )
+        leaderboard.update("d", None)
+        # Ties are broken by when players were added.
+        self.assertEqual(leaderboard.top(), ["c", "a", "b"])
+        leaderboard.update("b", {"games_won": 2, "games_drawn": 0, "total_games": 3})
+        self.assertEqual(leaderboard.top(2), ["b", "c"])
+        leaderboard.update("c", None)
+        self.assertEqual(leaderboard.top(), ["b", "a"])
+
     def test_get_players(self) -> None:
         bot = self.setup_game()
         players = bot.get_players("abc123")
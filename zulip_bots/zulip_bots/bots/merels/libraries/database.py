@@ -46,7 +46,7 @@ class MerelsStorage:
 
         parameters = (turn, x_taken, o_taken, board, hill_uid, take_mode)
 
-        self.storage.put(topic_name, json.dumps(parameters))
+        self.storage.put(topic_name, list(parameters))
 
     def remove_game(self, topic_name):
         """Removes the game from the database by setting it to an empty
@@ -66,7 +66,10 @@ class MerelsStorage:
         """
 
         try:
-            select = json.loads(self.storage.get(topic_name))
+            select = self.storage.get(topic_name)
+            if isinstance(select, str) and select != "":
+                # Put JSON-encoded, by earlier versions.
+                select = json.loads(select)
         except (json.decoder.JSONDecodeError, KeyError):
             select = ""
 
@@ -1,4 +1,4 @@
-from typing import Any, Final, List
+from typing import Any, Dict, Final, List
 
 from typing_extensions import override
 
@@ -26,6 +26,13 @@ class MerelsModel:
         self.current_board = mechanics.display_game(self.topic, self.storage)
         self.token = ["O", "X"]
 
+    def get_state(self) -> Dict[str, Any]:
+        return {"board": self.current_board, "storage": self.storage.data}
+
+    def set_state(self, state: Dict[str, Any]) -> None:
+        self.current_board = state["board"]
+        self.storage.data = state["storage"]
+
     def determine_game_over(self, players: List[str]) -> str:
         if self.contains_winning_move(self.current_board):
             return "current turn"
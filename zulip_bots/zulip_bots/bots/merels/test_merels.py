@@ -76,6 +76,15 @@ class TestMerelsBot(BotTestCase, DefaultTests):
         instance.start()
         return bot
 
+    def test_game_state(self) -> None:
+        bot = self.setup_game()
+        instance = bot.instances["abc123"]
+        instance.model.make_move("put 0,0", 0)
+        restored = GameInstance.from_state(bot, "abc123", instance.get_state())
+        self.assertEqual(restored.model.current_board, instance.model.current_board)
+        self.assertEqual(restored.model.storage.data, instance.model.storage.data)
+        self.assertEqual(restored.turn, instance.turn)
+
     def _get_game_handlers(self) -> Tuple[Any, Any]:
         bot, bot_handler = self._get_handlers()
         return bot.model, bot.game_message_handler
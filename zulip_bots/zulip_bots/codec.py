@@ -0,0 +1,193 @@
+import base64
+import json
+from typing import Any, Dict, Optional, Type
+
+from typing_extensions import override
+
+# Marks stored values written by a ValueMarshaller in a binary format;
+# no JSON text starts with it.
+ENCODED_PREFIX = "~"
+
+
+class Codec:
+    """
+    Serializes the values bots put in their storage.  `tag`
+    identifies the codec in the values it wrote.
+    """
+
+    tag = ""
+
+    def dumps(self, value: Any) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data: bytes) -> Any:
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    tag = "j"
+
+    @override
+    def dumps(self, value: Any) -> bytes:
+        return json.dumps(value).encode()
+
+    @override
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data)
+
+
+class MsgpackCodec(Codec):
+    """
+    Needs the `msgpack` package.  Unlike JSON, it keeps the type of
+    non-string dict keys, and writes floats and bytes exactly.
+    """
+
+    tag = "m"
+
+    def __init__(self) -> None:
+        try:
+            import msgpack
+        except ImportError:  # nocoverage
+            raise ImportError(
+                "The msgpack codec requires msgpack; install it with `pip install msgpack`."
+            ) from None
+        self.msgpack = msgpack
+
+    @override
+    def dumps(self, value: Any) -> bytes:
+        return self.msgpack.packb(value)
+
+    @override
+    def loads(self, data: bytes) -> Any:
+        return self.msgpack.unpackb(data, strict_map_key=False)
+
+
+class CBORCodec(Codec):
+    """
+    Needs the `cbor2` package.
+    """
+
+    tag = "c"
+
+    def __init__(self) -> None:
+        try:
+            import cbor2
+        except ImportError:  # nocoverage
+            raise ImportError(
+                "The CBOR codec requires cbor2; install it with `pip install cbor2`."
+            ) from None
+        self.cbor2 = cbor2
+
+    @override
+    def dumps(self, value: Any) -> bytes:
+        return self.cbor2.dumps(value)
+
+    @override
+    def loads(self, data: bytes) -> Any:
+        return self.cbor2.loads(data)
+
+
+CODECS: Dict[str, Type[Codec]] = {
+    "json": JSONCodec,
+    "msgpack": MsgpackCodec,
+    "cbor": CBORCodec,
+}
+
+
+def import_zstandard() -> Any:
+    try:
+        import zstandard
+    except ImportError:  # nocoverage
+        raise ImportError(
+            "Compressing bot storage requires zstandard; install it with `pip install zstandard`."
+        ) from None
+    return zstandard
+
+
+class ValueMarshaller:
+    """
+    Turns the values bots put in their storage into the strings it
+    keeps, and back.
+
+    Values are serialized with `codec` (JSON by default), compressed
+    with zstd if `compress_min_size` is set and they are at least that
+    many bytes long, and encoded with URL-safe base64, which requests
+    don't need to escape, after "~", the codec's tag, "z" if
+    compressed, and ":".  Uncompressed JSON is kept as is, which is how
+    StateHandler always stored values.  Values written by any codec, or
+    before there were codecs, can be read.
+    """
+
+    def __init__(
+        self,
+        codec: Optional[Codec] = None,
+        compress_min_size: Optional[int] = None,
+        compression_level: int = 3,
+    ) -> None:
+        self.codec = codec if codec is not None else JSONCodec()
+        self.compress_min_size = compress_min_size
+        self.codecs: Dict[str, Codec] = {self.codec.tag: self.codec}
+        self.compressor: Any = None
+        self.decompressor: Any = None
+        if compress_min_size is not None:
+            zstandard = import_zstandard()
+            self.compressor = zstandard.ZstdCompressor(level=compression_level)
+            self.decompressor = zstandard.ZstdDecompressor()
+
+    def marshal(self, value: Any) -> str:
+        data = self.codec.dumps(value)
+        header = self.codec.tag
+        if self.compress_min_size is not None and len(data) >= self.compress_min_size:
+            data = self.compressor.compress(data)
+            header += "z"
+        elif isinstance(self.codec, JSONCodec):
+            return data.decode()
+        return ENCODED_PREFIX + header + ":" + base64.urlsafe_b64encode(data).decode()
+
+    def demarshal(self, marshalled_value: str) -> Any:
+        if not marshalled_value.startswith(ENCODED_PREFIX):
+            return json.loads(marshalled_value)
+        header, _, encoded = marshalled_value[len(ENCODED_PREFIX) :].partition(":")
+        codec = self.codec_for_tag(header.rstrip("z"))
+        data = base64.urlsafe_b64decode(encoded)
+        if header.endswith("z"):
+            if self.decompressor is None:
+                # Written with compression, which has since been turned off.
+                self.decompressor = import_zstandard().ZstdDecompressor()
+            data = self.decompressor.decompress(data)
+        return codec.loads(data)
+
+    def codec_for_tag(self, tag: str) -> Codec:
+        codec = self.codecs.get(tag)
+        if codec is None:
+            for codec_class in CODECS.values():
+                if codec_class.tag == tag:
+                    codec = self.codecs[tag] = codec_class()
+                    break
+            else:
+                raise ValueError(f"Unknown codec tag in stored value: {tag!r}")
+        return codec
+
+    def is_current(self, marshalled_value: str) -> bool:
+        """
+        Whether `marshalled_value` is in the format marshal() writes now,
+        or should be migrated.
+        """
+        return self.marshal(self.demarshal(marshalled_value)) == marshalled_value
+
+
+def make_marshaller(spec: str, compress_min_size: int = 1024) -> ValueMarshaller:
+    """
+    The ValueMarshaller for `spec`: the name of a codec in CODECS,
+    optionally followed by "+zstd" to compress values of at least
+    `compress_min_size` bytes.
+    """
+    name, _, compression = spec.partition("+")
+    if name not in CODECS or compression not in ("", "zstd"):
+        raise ValueError(
+            f"Unknown bot storage codec {spec!r}; use one of {', '.join(CODECS)}, "
+            'optionally followed by "+zstd"'
+        )
+    return ValueMarshaller(
+        CODECS[name](), compress_min_size=compress_min_size if compression else None
+    )
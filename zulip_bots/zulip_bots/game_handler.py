@@ -1,10 +1,23 @@
+import bisect
 import json
 import logging
 import random
 import re
 import secrets
+from collections import OrderedDict
 from copy import deepcopy
-from typing import Any, Dict, Iterable, List, Sequence, Tuple
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
 from typing_extensions import override
 
@@ -29,6 +42,210 @@ class SamePlayerMoveError(Exception):
         return self.message
 
 
+# Each user is stored under USER_KEY_PREFIX + their email, and the
+# list of all of their emails under USER_EMAILS_KEY.
+USER_KEY_PREFIX = "user:"
+USER_EMAILS_KEY = "user_emails"
+# Where all users were stored, as one dict, by earlier versions.
+LEGACY_USERS_KEY = "users"
+# Each game being played is stored under GAME_KEY_PREFIX + its id, the
+# players, stream and subject of all of them under GAMES_KEY, and the
+# pending invites under INVITES_KEY.
+GAME_KEY_PREFIX = "game:"
+GAMES_KEY = "games"
+INVITES_KEY = "invites"
+
+
+def get_fresh(storage: Any, key: str) -> Any:
+    # Other processes running the bot may have changed the key since
+    # the storage last fetched it; storages that keep no local copy of
+    # their values (LocalStorage) are always fresh.
+    if hasattr(storage, "get_fresh"):
+        return storage.get_fresh(key)
+    return storage.get(key)
+
+
+def merge_changes(
+    stored: Dict[str, Any], old: Dict[str, Any], new: Dict[str, Any]
+) -> Dict[str, Any]:
+    """
+    Applies the changes from `old` to `new` to `stored`, leaving the
+    keys changed by other processes running the bot alone.
+    """
+    for key in old.keys() - new.keys():
+        stored.pop(key, None)
+    for key, value in new.items():
+        if old.get(key) != value:
+            stored[key] = value
+    return stored
+
+
+class Leaderboard:
+    """
+    The players with statistics, kept sorted by games won, then drawn,
+    then played, and then by when they were added, as their statistics
+    change, so that the top players can be listed without sorting all
+    of them.
+    """
+
+    def __init__(self) -> None:
+        self.entries: List[Tuple[int, int, int, int, str]] = []
+        self.entry_by_player: Dict[str, Tuple[int, int, int, int, str]] = {}
+        self.order: Dict[str, int] = {}
+
+    def update(self, player: str, stats: Optional[Dict[str, int]]) -> None:
+        old_entry = self.entry_by_player.pop(player, None)
+        if old_entry is not None:
+            del self.entries[bisect.bisect_left(self.entries, old_entry)]
+        if stats is None:
+            return
+        order = self.order.setdefault(player, len(self.order))
+        entry = (
+            -stats.get("games_won", 0),
+            -stats.get("games_drawn", 0),
+            -stats.get("total_games", 0),
+            order,
+            player,
+        )
+        bisect.insort(self.entries, entry)
+        self.entry_by_player[player] = entry
+
+    def top(self, num: Optional[int] = None) -> List[str]:
+        return [entry[-1] for entry in self.entries[:num]]
+
+
+class GameInstances(MutableMapping[str, "GameInstance"]):
+    """
+    The games being played, by game id.  Each game is put in the bot's
+    storage when it is added, and again at the end of every message
+    that looked it up if its state changed (see save_touched), so that
+    only the `max_live` most recently used games are kept in memory:
+    the others, and those of an earlier run of the bot, are restored
+    from storage when they are next looked up.  The players, stream and
+    subject of every game are kept in `summaries`, so that games can be
+    found without restoring them.
+    """
+
+    def __init__(self, game_adapter: "GameAdapter", max_live: int = 100) -> None:
+        self.game_adapter = game_adapter
+        self.max_live = max_live
+        self.live: "OrderedDict[str, GameInstance]" = OrderedDict()
+        self.summaries: Dict[str, Dict[str, Any]] = {}
+        # The state of each live game when it was last put in storage.
+        self.saved_states: Dict[str, Dict[str, Any]] = {}
+        # The games looked up since the last save_touched.
+        self.touched: Set[str] = set()
+
+    @property
+    def storage(self) -> Any:
+        return self.game_adapter.bot_handler.storage
+
+    def load(self) -> None:
+        try:
+            self.summaries = get_fresh(self.storage, GAMES_KEY)
+        except KeyError:
+            self.summaries = {}
+        self.live.clear()
+        self.saved_states.clear()
+        self.touched.clear()
+
+    @override
+    def __getitem__(self, game_id: str) -> "GameInstance":
+        instance = self.live.get(game_id)
+        if instance is not None:
+            self.live.move_to_end(game_id)
+        elif game_id in self.summaries:
+            try:
+                state = get_fresh(self.storage, GAME_KEY_PREFIX + game_id)
+            except KeyError:
+                state = None
+            if state is None:
+                # Ended by another process running the bot.
+                del self.summaries[game_id]
+                raise KeyError(game_id)
+            instance = GameInstance.from_state(self.game_adapter, game_id, state)
+            self.live[game_id] = instance
+            self.saved_states[game_id] = state
+        else:
+            raise KeyError(game_id)
+        self.touched.add(game_id)
+        return instance
+
+    @override
+    def __setitem__(self, game_id: str, instance: "GameInstance") -> None:
+        self.live[game_id] = instance
+        self.live.move_to_end(game_id)
+        self.saved_states.pop(game_id, None)
+        self.touched.add(game_id)
+        self.save(game_id)
+
+    @override
+    def __delitem__(self, game_id: str) -> None:
+        if game_id not in self.summaries:
+            raise KeyError(game_id)
+        self.live.pop(game_id, None)
+        self.saved_states.pop(game_id, None)
+        self.touched.discard(game_id)
+        if hasattr(self.storage, "remove"):
+            self.storage.remove(GAME_KEY_PREFIX + game_id)
+        else:
+            self.storage.put(GAME_KEY_PREFIX + game_id, None)
+        self.put_summary(game_id, None)
+
+    @override
+    def __contains__(self, game_id: object) -> bool:
+        return game_id in self.summaries
+
+    @override
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.summaries)
+
+    @override
+    def __len__(self) -> int:
+        return len(self.summaries)
+
+    def save(self, game_id: str) -> None:
+        instance = self.live[game_id]
+        state = instance.get_state()
+        if state != self.saved_states.get(game_id):
+            self.storage.put(GAME_KEY_PREFIX + game_id, state)
+            self.saved_states[game_id] = state
+        summary = {
+            "players": list(instance.players),
+            "stream": instance.stream,
+            "subject": instance.subject,
+        }
+        if summary != self.summaries.get(game_id):
+            self.put_summary(game_id, summary)
+
+    def put_summary(self, game_id: str, summary: Optional[Dict[str, Any]]) -> None:
+        # Only change this game's summary, leaving the games other
+        # processes running the bot have added or ended since we last
+        # read them, which we then see too.
+        old = {game_id: self.summaries[game_id]} if game_id in self.summaries else {}
+        new = {game_id: summary} if summary is not None else {}
+        try:
+            summaries = get_fresh(self.storage, GAMES_KEY)
+        except KeyError:
+            summaries = {}
+        self.summaries = merge_changes(summaries, old, new)
+        self.storage.put(GAMES_KEY, self.summaries)
+
+    def save_touched(self) -> None:
+        """
+        Puts the games looked up since the last call that have changed
+        in storage, and then drops the least recently used games from
+        memory until at most `max_live` are left.
+        """
+        for game_id in self.touched:
+            if game_id in self.live:
+                self.save(game_id)
+        self.touched.clear()
+        while len(self.live) > self.max_live:
+            game_id, _instance = self.live.popitem(last=False)
+            self.saved_states.pop(game_id, None)
+
+
 class GameAdapter:
     """
     Class that serves as a template to easily
@@ -49,6 +266,7 @@ class GameAdapter:
         max_players: int = 2,
         min_players: int = 2,
         supports_computer: bool = False,
+        max_live_games: int = 100,
     ) -> None:
         self.game_name = game_name
         self.bot_name = bot_name
@@ -61,15 +279,25 @@ class GameAdapter:
         self.supports_computer = supports_computer
         self.game_message_handler = game_message_handler()
         self.invites: Dict[str, Dict[str, str]] = {}
-        self.instances: Dict[str, Any] = {}
+        # The invites when they were last put in storage.
+        self.saved_invites: Dict[str, Dict[str, str]] = {}
+        # With max_live_games set to 0, no game is kept in memory between
+        # messages, so that several processes can run the bot: games
+        # and invites are read from storage again for every message,
+        # and only the ones that changed are put back.
+        self.instances = GameInstances(self, max_live_games)
         self.user_cache: Dict[str, Dict[str, Any]] = {}
+        # Users changed since the user cache was last put in storage.
+        self.dirty_users: Set[str] = set()
+        self.user_emails_dirty = False
+        self.leaderboard = Leaderboard()
         self.pending_subject_changes: List[str] = []
         self.stream = "games"
         self.rules = rules
 
     # Values are [won, lost, drawn, total] new values can be added, but MUST be added to the end of the list.
     def add_user_statistics(self, user: str, values: Dict[str, int]) -> None:
-        self.get_user_cache()
+        self.refresh_user(user)
         current_values: Dict[str, int] = {}
         if "stats" in self.get_user_by_email(user):
             current_values = self.user_cache[user]["stats"]
@@ -78,6 +306,7 @@ class GameAdapter:
                 current_values.update({key: 0})
             current_values[key] += value
         self.user_cache[user].update({"stats": current_values})
+        self.mark_user_dirty(user)
         self.put_user_cache()
 
     def help_message(self) -> str:
@@ -207,24 +436,34 @@ class GameAdapter:
     def initialize(self, bot_handler: BotHandler) -> None:
         self.bot_handler = bot_handler
         self.get_user_cache()
+        self.get_games()
         self.email = self.bot_handler.email
         self.full_name = self.bot_handler.full_name
 
     def handle_message(self, message: Dict[str, Any], bot_handler: BotHandler) -> None:
         try:
             self.bot_handler = bot_handler
+            if self.instances.max_live == 0:
+                # Games may have been changed by other processes.
+                self.get_games()
             content = message["content"].strip()
             sender = message["sender_email"].lower()
             message["sender_email"] = message["sender_email"].lower()
 
-            if self.email not in self.user_cache and self.supports_computer:
-                self.add_user_to_cache(
-                    {"sender_email": self.email, "sender_full_name": self.full_name}
-                )
+            if self.supports_computer and self.email not in self.user_cache:
+                # Maybe added by another process running the bot.
+                self.refresh_user(self.email)
+                if self.email not in self.user_cache:
+                    self.add_user_to_cache(
+                        {"sender_email": self.email, "sender_full_name": self.full_name}
+                    )
 
             if sender == self.email:
                 return
 
+            if sender not in self.user_cache:
+                # Maybe added by another process running the bot.
+                self.refresh_user(sender)
             if sender not in self.user_cache:
                 self.add_user_to_cache(message)
                 logging.info("Added %s to user cache", sender)
@@ -298,11 +537,13 @@ class GameAdapter:
         except Exception as e:
             logging.exception("Error handling game message")
             self.bot_handler.send_reply(message, f"Error {e}.")
+        finally:
+            self.put_games()
 
     def is_user_in_game(self, user_email: str) -> str:
-        for instance in self.instances.values():
-            if user_email in instance.players:
-                return instance.game_id
+        for game_id, game in self.instances.summaries.items():
+            if user_email in game["players"]:
+                return game_id
         return ""
 
     def command_start_game_with(self, message: Dict[str, Any], sender: str, content: str) -> None:
@@ -471,9 +712,7 @@ class GameAdapter:
             )
 
     def command_leaderboard(self, message: Dict[str, Any], sender: str, content: str) -> None:
-        stats = self.get_sorted_player_statistics()
-        num = 5 if len(stats) > 5 else len(stats)
-        top_stats = stats[0:num]
+        top_stats = self.get_sorted_player_statistics(5)
         response = "**Most wins**\n\n"
         raw_headers = ["games_won", "games_drawn", "games_lost", "total_games"]
         headers = ["Player"] + [key.replace("_", " ").title() for key in raw_headers]
@@ -485,20 +724,10 @@ class GameAdapter:
             response += " | ".join(values)
         self.send_reply(message, response)
 
-    def get_sorted_player_statistics(self) -> List[Tuple[str, Dict[str, int]]]:
-        players = []
-        for user_name, u in self.user_cache.items():
-            if "stats" in u:
-                players.append((user_name, u["stats"]))
-        return sorted(
-            players,
-            key=lambda player: (
-                player[1]["games_won"],
-                player[1]["games_drawn"],
-                player[1]["total_games"],
-            ),
-            reverse=True,
-        )
+    def get_sorted_player_statistics(
+        self, num: Optional[int] = None
+    ) -> List[Tuple[str, Dict[str, int]]]:
+        return [(player, self.user_cache[player]["stats"]) for player in self.leaderboard.top(num)]
 
     def send_invite(self, game_id: str, user_email: str, message: Dict[str, Any]) -> None:
         self.invites[game_id].update({user_email.lower(): "p"})
@@ -675,21 +904,102 @@ To move subjects, send your message again, otherwise join the game using the lin
             "stats": {"total_games": 0, "games_won": 0, "games_lost": 0, "games_drawn": 0},
         }
         self.user_cache.update({message["sender_email"].lower(): user})
+        self.user_emails_dirty = True
+        self.mark_user_dirty(message["sender_email"].lower())
         self.put_user_cache()
 
+    def mark_user_dirty(self, user: str) -> None:
+        """
+        Must be called after changing a user in the user cache, so that
+        the next put_user_cache puts them.
+        """
+        self.dirty_users.add(user)
+        self.leaderboard.update(user, self.user_cache[user].get("stats"))
+
     def put_user_cache(self) -> Dict[str, Any]:
-        user_cache_str = json.dumps(self.user_cache)
-        self.bot_handler.storage.put("users", user_cache_str)
+        """
+        Puts the users changed since the last call in storage, each
+        under their own key.
+        """
+        storage = self.bot_handler.storage
+        if self.user_emails_dirty:
+            # Keep the users other processes running the bot have added.
+            try:
+                user_emails = get_fresh(storage, USER_EMAILS_KEY)
+            except KeyError:
+                user_emails = []
+            stored_emails = set(user_emails)
+            user_emails += [email for email in self.user_cache if email not in stored_emails]
+            storage.put(USER_EMAILS_KEY, user_emails)
+            self.user_emails_dirty = False
+        for user in self.dirty_users:
+            storage.put(USER_KEY_PREFIX + user, self.user_cache[user])
+        self.dirty_users.clear()
         return self.user_cache
 
     def get_user_cache(self) -> Dict[str, Any]:
+        storage = self.bot_handler.storage
         try:
-            user_cache_str = self.bot_handler.storage.get("users")
+            if storage.contains(USER_EMAILS_KEY):
+                user_cache = {
+                    email: storage.get(USER_KEY_PREFIX + email)
+                    for email in storage.get(USER_EMAILS_KEY)
+                }
+                migrated = False
+            else:
+                stored_users = storage.get(LEGACY_USERS_KEY)
+                if isinstance(stored_users, str):
+                    # Put JSON-encoded, by earlier versions.
+                    stored_users = json.loads(stored_users)
+                user_cache = stored_users
+                migrated = True
         except KeyError:
             return {}
-        self.user_cache = json.loads(user_cache_str)
+        self.user_cache = user_cache
+        self.leaderboard = Leaderboard()
+        for user, user_data in user_cache.items():
+            self.leaderboard.update(user, user_data.get("stats"))
+        if migrated:
+            self.dirty_users = set(user_cache)
+            self.user_emails_dirty = True
+            self.put_user_cache()
         return self.user_cache
 
+    def put_games(self) -> None:
+        """
+        Puts the games and invites changed while handling a message in
+        storage.
+        """
+        self.instances.save_touched()
+        if self.invites != self.saved_invites:
+            # Only put the invites changed, keeping the changes other
+            # processes running the bot have made.
+            try:
+                stored_invites = get_fresh(self.bot_handler.storage, INVITES_KEY)
+            except KeyError:
+                stored_invites = {}
+            self.invites = merge_changes(stored_invites, self.saved_invites, self.invites)
+            self.bot_handler.storage.put(INVITES_KEY, self.invites)
+            self.saved_invites = deepcopy(self.invites)
+
+    def get_games(self) -> None:
+        self.instances.load()
+        try:
+            self.invites = get_fresh(self.bot_handler.storage, INVITES_KEY)
+        except KeyError:
+            self.invites = {}
+        self.saved_invites = deepcopy(self.invites)
+
+    def refresh_user(self, user: str) -> None:
+        # In case another process running the bot has added or changed them.
+        try:
+            user_data = get_fresh(self.bot_handler.storage, USER_KEY_PREFIX + user)
+        except KeyError:
+            return
+        if user not in self.dirty_users:
+            self.user_cache[user] = user_data
+            self.leaderboard.update(user, user_data.get("stats"))
+
     def verify_users(self, users: Iterable[str], message: Dict[str, Any]) -> List[str]:
         verified_users = []
         failed = False
@@ -725,9 +1035,9 @@ To move subjects, send your message again, otherwise join the game using the lin
             return verified_users
 
     def get_game_instance_by_subject(self, subject_name: str, stream_name: str) -> Any:
-        for instance in self.instances.values():
-            if instance.subject == subject_name and instance.stream == stream_name:
-                return instance
+        for game_id, game in self.instances.summaries.items():
+            if game["subject"] == subject_name and game["stream"] == stream_name:
+                return self.instances[game_id]
         return None
 
     def get_invite_in_subject(self, subject_name: str, stream_name: str) -> str:
@@ -753,8 +1063,8 @@ To move subjects, send your message again, otherwise join the game using the lin
                     ),
                 )
             return False
-        for instance in self.instances.values():
-            if user_email in instance.players:
+        for game in self.instances.summaries.values():
+            if user_email in game["players"]:
                 return False
         for invite in self.invites.values():
             for u in invite:
@@ -798,9 +1108,9 @@ To move subjects, send your message again, otherwise join the game using the lin
         return {}
 
     def get_game_id_by_email(self, user_email: str) -> str:
-        for instance in self.instances.values():
-            if user_email in instance.players:
-                return instance.game_id
+        for game_id, game in self.instances.summaries.items():
+            if user_email in game["players"]:
+                return game_id
         for game_id in self.invites:
             players = self.get_players(game_id)
             if user_email in players:
@@ -844,6 +1154,57 @@ class GameInstance:
         self.current_messages: List[str] = []
         self.is_changing_subject = False
 
+    def get_state(self) -> Dict[str, Any]:
+        """
+        What from_state needs to restore this game.  Models can keep more
+        than their current_board in it by defining get_state and
+        set_state methods.
+        """
+        if hasattr(self.model, "get_state"):
+            model_state = self.model.get_state()
+        else:
+            model_state = self.model.current_board
+        return deepcopy(
+            {
+                "is_private": self.is_private,
+                "subject": self.subject,
+                "players": self.players,
+                "stream": self.stream,
+                "turn": self.turn,
+                "current_draw": self.current_draw,
+                "is_changing_subject": self.is_changing_subject,
+                "pending_subject_change": self.game_id in self.game_adapter.pending_subject_changes,
+                "model": model_state,
+            }
+        )
+
+    @classmethod
+    def from_state(
+        cls, game_adapter: GameAdapter, game_id: str, state: Dict[str, Any]
+    ) -> "GameInstance":
+        instance = cls(
+            game_adapter,
+            state["is_private"],
+            state["subject"],
+            game_id,
+            state["players"],
+            state["stream"],
+        )
+        instance.turn = state["turn"]
+        instance.current_draw = state["current_draw"]
+        instance.is_changing_subject = state.get("is_changing_subject", False)
+        if (
+            state.get("pending_subject_change")
+            and game_id not in game_adapter.pending_subject_changes
+        ):
+            game_adapter.pending_subject_changes.append(game_id)
+        if hasattr(instance.model, "set_state"):
+            instance.model.set_state(state["model"])
+        else:
+            instance.model.current_board = state["model"]
+        instance.board = instance.model.current_board
+        return instance
+
     def start(self) -> None:
         self.current_messages.append(self.get_start_message())
         self.current_messages.append(self.parse_current_board())
@@ -5,14 +5,17 @@ import os
 import re
 import signal
 import sys
+import threading
 import time
 from contextlib import contextmanager
 from pathlib import Path
-from typing import IO, Any, Dict, Iterator, List, Optional, Set
+from typing import IO, Any, Dict, Iterator, List, Optional, Set, Union
 
 from typing_extensions import Protocol
 
 from zulip import Client, ZulipError
+from zulip_bots.codec import ValueMarshaller, make_marshaller
+from zulip_bots.storage import LocalStorage, open_storage_backend
 
 
 class NoBotConfigError(Exception):
@@ -136,24 +139,172 @@ class CachedStorage:
 
 
 class StateHandler:
-    def __init__(self, client: Client) -> None:
+    """
+    Stores the bot's state in the Zulip server's bot storage.
+
+    By default, every put is sent to the server right away.  With
+    `write_behind=True`, all keys are fetched in one request when the
+    StateHandler is created, and puts and removals are kept locally
+    until `flush()`,
+    which sends them all in one request: after each message the bot
+    handles, or, with `flush_interval` set, every `flush_interval`
+    seconds and on shutdown.  With `journal_path` set, puts are also
+    appended to that file, and synced to disk, before `put` returns;
+    puts that were not flushed before a crash are replayed from it on
+    restart.  The bot must be the only writer of its storage while
+    running in write-behind mode.
+
+    Values are marshalled to strings by `marshaller`, as JSON by
+    default.
+    """
+
+    def __init__(
+        self,
+        client: Client,
+        write_behind: bool = False,
+        flush_interval: Optional[float] = None,
+        journal_path: Optional[str] = None,
+        marshaller: Optional[ValueMarshaller] = None,
+    ) -> None:
+        if not write_behind and (flush_interval is not None or journal_path is not None):
+            raise ValueError("flush_interval and journal_path need write_behind=True")
         self._client = client
-        self.marshal = lambda obj: json.dumps(obj)
-        self.demarshal = lambda obj: json.loads(obj)
+        self.marshaller = marshaller if marshaller is not None else ValueMarshaller()
+        self.marshal = self.marshaller.marshal
+        self.demarshal = self.marshaller.demarshal
         self.state_: Dict[str, Any] = dict()
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self._dirty_keys: Set[str] = set()
+        # Keys removed since the last flush, and the keys the server has.
+        self._removed_keys: Set[str] = set()
+        self._stored_keys: Set[str] = set()
+        self._lock = threading.RLock()
+        self._journal: Optional[IO[str]] = None
+        self._closed = threading.Event()
+        if not write_behind:
+            return
+
+        response = self._client.get_storage()
+        if response["result"] != "success":
+            raise StateHandlerError(f"Error fetching state: {response}")
+        self.state_.update(response["storage"])
+        self._stored_keys.update(response["storage"])
+        if journal_path is not None:
+            self._replay_journal(journal_path)
+            # Rewrite the journal, without the entry a crash may have cut short.
+            self._journal = open(journal_path, "w")  # noqa: SIM115
+            for key in self._dirty_keys | self._removed_keys:
+                self._write_journal(key)
+        if flush_interval is not None:
+            threading.Thread(target=self._flush_periodically, daemon=True).start()
+
+    def _replay_journal(self, journal_path: str) -> None:
+        try:
+            with open(journal_path) as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last entry was cut short by the crash.
+                        break
+                    if entry.get("removed"):
+                        self._remove_locally(entry["key"])
+                    else:
+                        self.state_[entry["key"]] = entry["value"]
+                        self._dirty_keys.add(entry["key"])
+                        self._removed_keys.discard(entry["key"])
+        except FileNotFoundError:
+            pass
+        unflushed_keys = len(self._dirty_keys) + len(self._removed_keys)
+        if unflushed_keys:
+            logging.info("replaying %d unflushed keys from %s", unflushed_keys, journal_path)
+
+    def _write_journal(self, key: str) -> None:
+        assert self._journal is not None
+        if key in self.state_:
+            entry = {"key": key, "value": self.state_[key]}
+        else:
+            entry = {"key": key, "removed": True}
+        self._journal.write(json.dumps(entry) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def _flush_periodically(self) -> None:
+        assert self.flush_interval is not None
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Error flushing bot state; will retry")
 
     def put(self, key: str, value: Any) -> None:
-        self.state_[key] = self.marshal(value)
-        response = self._client.update_storage({"storage": {key: self.state_[key]}})
-        if response["result"] != "success":
-            raise StateHandlerError(f"Error updating state: {response}")
+        marshalled_value = self.marshal(value)
+        if not self.write_behind:
+            self.state_[key] = marshalled_value
+            response = self._client.update_storage({"storage": {key: marshalled_value}})
+            if response["result"] != "success":
+                raise StateHandlerError(f"Error updating state: {response}")
+            return
+
+        with self._lock:
+            self.state_[key] = marshalled_value
+            self._dirty_keys.add(key)
+            self._removed_keys.discard(key)
+            if self._journal is not None:
+                self._write_journal(key)
+
+    def remove(self, key: str) -> None:
+        if not self.write_behind:
+            self.state_.pop(key, None)
+            response = self._client.remove_storage({"keys": [key]})
+            if response["result"] != "success":
+                raise StateHandlerError(f"Error removing state: {response}")
+            return
+
+        with self._lock:
+            if key not in self.state_:
+                return
+            self._remove_locally(key)
+            if self._journal is not None:
+                self._write_journal(key)
+
+    def _remove_locally(self, key: str) -> None:
+        self.state_.pop(key, None)
+        self._dirty_keys.discard(key)
+        # The server rejects removing keys it doesn't have.
+        if key in self._stored_keys:
+            self._removed_keys.add(key)
 
     def get(self, key: str) -> Any:
         if key in self.state_:
             return self.demarshal(self.state_[key])
+        if self.write_behind:
+            # We fetched every key when starting.
+            raise KeyError("key not found: " + key)
+
+        response = self._client.get_storage({"keys": [key]})
+        if response["result"] != "success":
+            raise KeyError("key not found: " + key)
+
+        marshalled_value = response["storage"][key]
+        self.state_[key] = marshalled_value
+        return self.demarshal(marshalled_value)
+
+    def get_fresh(self, key: str) -> Any:
+        """
+        Like get, but fetches the value from the server even if it has
+        been fetched before, for keys that other processes running the
+        bot may change.  In write-behind mode, the bot is the only
+        writer, so the local value is returned.
+        """
+        if self.write_behind:
+            return self.get(key)
 
         response = self._client.get_storage({"keys": [key]})
         if response["result"] != "success":
+            # Maybe removed by another process.
+            self.state_.pop(key, None)
             raise KeyError("key not found: " + key)
 
         marshalled_value = response["storage"][key]
@@ -161,7 +312,90 @@ class StateHandler:
         return self.demarshal(marshalled_value)
 
     def contains(self, key: str) -> bool:
-        return key in self.state_
+        if key in self.state_ or self.write_behind:
+            return key in self.state_
+        try:
+            self.get(key)
+        except KeyError:
+            return False
+        return True
+
+    def flush(self) -> None:
+        """
+        Sends the values put since the last flush to the server, in one
+        request, and the keys removed since then in another.
+        """
+        with self._lock:
+            if not self._dirty_keys and not self._removed_keys:
+                return
+            if self._dirty_keys:
+                storage = {key: self.state_[key] for key in self._dirty_keys}
+                response = self._client.update_storage({"storage": storage})
+                if response["result"] != "success":
+                    raise StateHandlerError(f"Error updating state: {response}")
+                self._stored_keys.update(self._dirty_keys)
+                self._dirty_keys.clear()
+            if self._removed_keys:
+                response = self._client.remove_storage({"keys": sorted(self._removed_keys)})
+                if response["result"] != "success":
+                    raise StateHandlerError(f"Error removing state: {response}")
+                self._stored_keys.difference_update(self._removed_keys)
+                self._removed_keys.clear()
+            if self._journal is not None:
+                # Truncating doesn't move the file position.
+                self._journal.seek(0)
+                self._journal.truncate()
+
+    def migrate(self) -> int:
+        """
+        Rewrites the stored values that were marshalled in another
+        format than `marshaller`'s, in one request, and returns how
+        many there were.
+        """
+        if self.write_behind:
+            stored = dict(self.state_)
+        else:
+            response = self._client.get_storage()
+            if response["result"] != "success":
+                raise StateHandlerError(f"Error fetching state: {response}")
+            stored = response["storage"]
+
+        migrated = {
+            key: self.marshal(self.demarshal(marshalled_value))
+            for key, marshalled_value in stored.items()
+            if not self.marshaller.is_current(marshalled_value)
+        }
+        if not migrated:
+            return 0
+        with self._lock:
+            self.state_.update(migrated)
+            if self.write_behind:
+                self._dirty_keys.update(migrated)
+                self.flush()
+                return len(migrated)
+        response = self._client.update_storage({"storage": migrated})
+        if response["result"] != "success":
+            raise StateHandlerError(f"Error updating state: {response}")
+        return len(migrated)
+
+    def message_handled(self) -> None:
+        """
+        Called once the bot has handled a message.
+        """
+        if self.write_behind and self.flush_interval is None:
+            self.flush()
+
+    def close(self) -> None:
+        """
+        Flushes the values not sent to the server yet, and stops
+        flushing periodically.
+        """
+        self._closed.set()
+        if self.write_behind:
+            self.flush()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
 
 
 @contextmanager
@@ -217,6 +451,7 @@ class ExternalBotHandler:
         bot_details: Optional[Dict[str, Any]],
         bot_config_file: Optional[str] = None,
         bot_config_parser: Optional[configparser.ConfigParser] = None,
+        storage: Union[None, StateHandler, LocalStorage] = None,
     ) -> None:
         # Only expose a subset of our Client's functionality
         try:
@@ -247,7 +482,7 @@ class ExternalBotHandler:
         self.bot_details = bot_details
         self.bot_config_file = bot_config_file
         self._bot_config_parser = bot_config_parser
-        self._storage = StateHandler(client)
+        self._storage = storage if storage is not None else StateHandler(client)
         try:
             self.user_id = user_profile["user_id"]
             self.full_name = user_profile["full_name"]
@@ -260,7 +495,7 @@ class ExternalBotHandler:
             sys.exit(1)
 
     @property
-    def storage(self) -> StateHandler:
+    def storage(self) -> Union[StateHandler, LocalStorage]:
         return self._storage
 
     def identity(self) -> BotIdentity:
@@ -432,6 +667,36 @@ def prepare_message_handler(bot: str, bot_handler: BotHandler, bot_lib_module: A
     return message_handler
 
 
+def handle_message_for_bot(
+    message: Dict[str, Any],
+    flags: List[str],
+    message_handler: Any,
+    bot_handler: BotHandler,
+) -> None:
+    logging.info("waiting for next message")
+    # `mentioned` will be in `flags` if the bot is mentioned at ANY position
+    # (not necessarily the first @mention in the message).
+    is_mentioned = "mentioned" in flags
+    is_private_message = is_private_message_but_not_group_pm(message, bot_handler)
+
+    # Provide bots with a way to access the full, unstripped message
+    message["full_content"] = message["content"]
+    # Strip at-mention botname from the message
+    if is_mentioned:
+        # message['content'] will be None when the bot's @-mention is not at the beginning.
+        # In that case, the message shall not be handled.
+        message["content"] = extract_query_without_mention(message=message, client=bot_handler)
+        if message["content"] is None:
+            return
+
+    if is_private_message or is_mentioned:
+        try:
+            message_handler.handle_message(message=message, bot_handler=bot_handler)
+        finally:
+            if isinstance(bot_handler, ExternalBotHandler):
+                bot_handler.storage.message_handled()
+
+
 def run_message_handler_for_bot(
     lib_module: Any,
     quiet: bool,
@@ -439,6 +704,11 @@ def run_message_handler_for_bot(
     bot_config_file: Optional[str],
     bot_name: str,
     bot_source: str,
+    write_behind: bool = False,
+    flush_interval: Optional[float] = None,
+    storage_journal: Optional[str] = None,
+    storage_backend: str = "zulip",
+    storage_codec: Optional[str] = None,
 ) -> Any:
     """
     lib_module is of type Any, since it can contain any bot's
@@ -447,6 +717,13 @@ def run_message_handler_for_bot(
     function.
 
     Set default bot_details, then override from class, if provided
+
+    storage_backend is one of zulip_bots.storage.STORAGE_BACKENDS;
+    write_behind, flush_interval and storage_journal configure the
+    StateHandler used for the default, "zulip".  storage_codec is the
+    zulip_bots.codec.make_marshaller spec of the format the bot's
+    values are stored in; stored values in other formats are migrated
+    to it when starting.
     """
     bot_details = {
         "name": bot_name.capitalize(),
@@ -465,7 +742,20 @@ def run_message_handler_for_bot(
         sys.exit(1)
 
     bot_dir = os.path.dirname(lib_module.__file__)
-    restricted_client = ExternalBotHandler(client, bot_dir, bot_details, bot_config_file)
+    marshaller = make_marshaller(storage_codec) if storage_codec is not None else None
+    backend = open_storage_backend(storage_backend)
+    storage: Union[StateHandler, LocalStorage]
+    if backend is not None:
+        storage = backend.storage(bot_name, marshaller)
+    else:
+        storage = StateHandler(client, write_behind, flush_interval, storage_journal, marshaller)
+        if marshaller is not None:
+            migrated = storage.migrate()
+            if migrated:
+                logging.info("migrated %d stored values to %s", migrated, storage_codec)
+    restricted_client = ExternalBotHandler(
+        client, bot_dir, bot_details, bot_config_file, storage=storage
+    )
 
     message_handler = prepare_message_handler(bot_name, restricted_client, lib_module)
 
@@ -479,28 +769,10 @@ def run_message_handler_for_bot(
             print(f"WARNING: {bot_name} is missing usage handler, please add one eventually")
 
     def handle_message(message: Dict[str, Any], flags: List[str]) -> None:
-        logging.info("waiting for next message")
-        # `mentioned` will be in `flags` if the bot is mentioned at ANY position
-        # (not necessarily the first @mention in the message).
-        is_mentioned = "mentioned" in flags
-        is_private_message = is_private_message_but_not_group_pm(message, restricted_client)
-
-        # Provide bots with a way to access the full, unstripped message
-        message["full_content"] = message["content"]
-        # Strip at-mention botname from the message
-        if is_mentioned:
-            # message['content'] will be None when the bot's @-mention is not at the beginning.
-            # In that case, the message shall not be handled.
-            message["content"] = extract_query_without_mention(
-                message=message, client=restricted_client
-            )
-            if message["content"] is None:
-                return
-
-        if is_private_message or is_mentioned:
-            message_handler.handle_message(message=message, bot_handler=restricted_client)
+        handle_message_for_bot(message, flags, message_handler, restricted_client)
 
     signal.signal(signal.SIGINT, exit_gracefully)
+    signal.signal(signal.SIGTERM, exit_gracefully)
 
     logging.info("starting message handling...")
 
@@ -508,4 +780,9 @@ def run_message_handler_for_bot(
         if event["type"] == "message":
             handle_message(event["message"], event["flags"])
 
-    client.call_on_each_event(event_callback, ["message"])
+    try:
+        client.call_on_each_event(event_callback, ["message"])
+    finally:
+        storage.close()
+        if backend is not None:
+            backend.close()
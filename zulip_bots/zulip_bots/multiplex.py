@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# zulip-run-bots -- Runs many bots in one process.
+
+import argparse
+import asyncio
+import configparser
+import http.cookiejar
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Union
+
+import aiohttp
+import requests
+from typing_extensions import override
+
+from zulip import Client, MultipartEncoder, Transport
+from zulip.async_client import AsyncClient
+from zulip.connections import TimedHTTPAdapter
+from zulip_bots import finder
+from zulip_bots.lib import (
+    ExternalBotHandler,
+    display_config_file_errors,
+    handle_message_for_bot,
+    prepare_message_handler,
+)
+
+
+class SharedSession:
+    """
+    One requests session, and so one connection pool, through which
+    the clients of all the bots run by run_message_handlers_for_bots
+    send their requests, with the server settings each server answered
+    with, so that each server is asked once rather than once per bot.
+    """
+
+    def __init__(self, pool_maxsize: int) -> None:
+        self.session = requests.Session()
+        # Each bot authenticates as itself; don't let them share cookies.
+        self.session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        adapter = TimedHTTPAdapter(pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.lock = threading.Lock()
+        self.server_settings: Dict[str, Dict[str, Any]] = {}
+
+    def make_client(self, config: Dict[str, str], client_name: str) -> Client:
+        return SharedSessionClient(
+            self,
+            email=config["email"],
+            api_key=config["key"],
+            site=config["site"],
+            client=client_name,
+        )
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class SharedSessionTransport(Transport):
+    """
+    Sends the requests of `client` through the SharedSession's
+    session, with the client's own credentials and TLS settings.
+    """
+
+    def __init__(self, shared_session: SharedSession, client: Client) -> None:
+        self.session = shared_session.session
+        self.auth = requests.auth.HTTPBasicAuth(client.email, client.api_key)
+        self.verify = client.tls_verification
+        self.cert = (
+            (client.client_cert, client.client_cert_key)
+            if client.client_cert is not None and client.client_cert_key is not None
+            else client.client_cert
+        )
+        self.user_agent = client.get_user_agent()
+
+    @override
+    def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        params: Optional[bytes] = None,
+        data: Union[None, bytes, MultipartEncoder] = None,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+        stream: bool = False,
+    ) -> requests.Response:
+        return self.session.request(
+            method,
+            url,
+            params=params,
+            data=data,
+            headers={"User-agent": self.user_agent, **(headers or {})},
+            timeout=timeout,
+            stream=stream,
+            auth=self.auth,
+            verify=self.verify,
+            cert=self.cert,
+        )
+
+
+class SharedSessionClient(Client):
+    """
+    A Client whose requests go through `shared_session`.
+    """
+
+    def __init__(self, shared_session: SharedSession, **kwargs: Any) -> None:
+        self.shared_session = shared_session
+        super().__init__(
+            transport=lambda client: SharedSessionTransport(shared_session, client), **kwargs
+        )
+
+    @override
+    def load_server_settings(self) -> None:
+        with self.shared_session.lock:
+            server_settings = self.shared_session.server_settings.get(self.base_url)
+            if server_settings is None:
+                server_settings = self.get_server_settings()
+                self.shared_session.server_settings[self.base_url] = server_settings
+        self.set_server_settings(server_settings)
+
+
+class MultiplexedBot:
+    """
+    One bot run by run_message_handlers_for_bots: its configuration,
+    its ExternalBotHandler and its handler_class instance.  Its client
+    sends its requests through `shared_session`, if given.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        lib_module: Any,
+        config: Dict[str, str],
+        bot_config_parser: Optional[configparser.ConfigParser] = None,
+        shared_session: Optional[SharedSession] = None,
+    ) -> None:
+        self.name = name
+        self.config = config
+        self.client_name = f"Zulip{name.capitalize()}Bot"
+        if shared_session is None:
+            client = Client(
+                email=config["email"],
+                api_key=config["key"],
+                site=config["site"],
+                client=self.client_name,
+            )
+        else:
+            client = shared_session.make_client(config, self.client_name)
+        bot_details = {"name": name.capitalize(), "description": ""}
+        bot_details.update(getattr(lib_module.handler_class, "META", {}))
+        bot_dir = os.path.dirname(os.path.abspath(lib_module.__file__))
+        self.bot_handler = ExternalBotHandler(
+            client, bot_dir, bot_details, bot_config_parser=bot_config_parser
+        )
+        self.message_handler = prepare_message_handler(name, self.bot_handler, lib_module)
+
+    def make_event_client(self, connector: aiohttp.BaseConnector) -> AsyncClient:
+        return AsyncClient(
+            email=self.config["email"],
+            api_key=self.config["key"],
+            site=self.config["site"],
+            client=self.client_name,
+            connector=connector,
+        )
+
+
+def import_bot_module(bot: str) -> Any:
+    result = finder.resolve_bot_path(bot)
+    if result is not None:
+        bot_path, bot_name = result
+        return finder.import_module_from_source(bot_path.as_posix(), bot_name)
+    _, lib_module = finder.import_module_from_zulip_bot_registry(bot)
+    if lib_module is None:
+        lib_module = finder.import_module_by_name(bot)
+    return lib_module
+
+
+async def run_bots(bots: List[MultiplexedBot], max_workers: int = 16) -> None:
+    """
+    Long-polls the event queues of all `bots` from one event loop,
+    over one shared connection pool, and runs their message handlers
+    on a shared pool of `max_workers` threads.  Each bot still handles
+    its own messages one at a time, in order.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="zulip-bot")
+    # Every bot keeps one long-poll open, so don't cap the pool below that.
+    connector = aiohttp.TCPConnector(limit=len(bots) + max_workers)
+
+    async def listen(bot: MultiplexedBot) -> None:
+        async def event_callback(event: Dict[str, Any]) -> None:
+            if event["type"] != "message":
+                return
+            try:
+                await loop.run_in_executor(
+                    executor,
+                    handle_message_for_bot,
+                    event["message"],
+                    event["flags"],
+                    bot.message_handler,
+                    bot.bot_handler,
+                )
+            except Exception:
+                # Don't let one broken bot take down the others.
+                logging.exception("%s bot failed to handle message %s", bot.name, event["id"])
+
+        async with bot.make_event_client(connector) as event_client:
+            await event_client.call_on_each_event(event_callback, ["message"])
+
+    try:
+        await asyncio.gather(*(listen(bot) for bot in bots))
+    finally:
+        executor.shutdown(wait=False)
+        await connector.close()
+
+
+def run_message_handlers_for_bots(
+    bots_config: Dict[str, Dict[str, str]],
+    bot_config_file: Optional[str] = None,
+    max_workers: int = 16,
+    quiet: bool = False,
+) -> None:
+    """
+    bots_config maps the name of each bot to run (or the path to its
+    source) to its Zulip credentials, in the same format as a
+    botserverrc file: {"email": ..., "key": ..., "site": ...}.
+    """
+    bot_config_parser = None
+    if bot_config_file is not None:
+        bot_config_parser = configparser.ConfigParser()
+        with open(bot_config_file) as conf:
+            try:
+                bot_config_parser.read_file(conf)
+            except configparser.Error as e:
+                display_config_file_errors(str(e), bot_config_file)
+                sys.exit(1)
+
+    # The message handlers send their requests from up to max_workers
+    # threads at once.
+    shared_session = SharedSession(pool_maxsize=max_workers)
+    try:
+        bots = []
+        for bot, config in bots_config.items():
+            lib_module = import_bot_module(bot)
+            if lib_module is None:
+                sys.exit(f'ERROR: Could not load bot module for "{bot}". Exiting now.')
+            name = os.path.splitext(os.path.basename(bot))[0]
+            bots.append(MultiplexedBot(name, lib_module, config, bot_config_parser, shared_session))
+            if not quiet:
+                print(f"Running {name} Bot.")
+
+        logging.info("starting message handling for %d bots...", len(bots))
+        asyncio.run(run_bots(bots, max_workers))
+    finally:
+        shared_session.close()
+
+
+def parse_args() -> argparse.Namespace:
+    usage = """
+        zulip-run-bots --config-file <path/to/botsrc> [--bot-config-file <path>]
+        zulip-run-bots --help
+        """
+
+    parser = argparse.ArgumentParser(usage=usage)
+    parser.add_argument(
+        "--config-file",
+        "-c",
+        action="store",
+        required=True,
+        help="config file with one section per bot to run, named after the bot "
+        "and containing its email, key and site (the botserverrc format)",
+    )
+    parser.add_argument(
+        "--bot-config-file",
+        "-b",
+        action="store",
+        help="third party configuration file, with one section per bot that needs one",
+    )
+    parser.add_argument(
+        "--max-workers",
+        action="store",
+        type=int,
+        default=16,
+        help="number of messages handled concurrently, across all bots (default: %(default)d)",
+    )
+    parser.add_argument("--quiet", "-q", action="store_true", help="turn off logging output")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    if not args.quiet:
+        logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    config_file = os.path.abspath(os.path.expanduser(args.config_file))
+    if not os.path.isfile(config_file):
+        sys.exit(f"ERROR: {config_file} does not exist.")
+    parser = configparser.ConfigParser()
+    with open(config_file) as conf:
+        try:
+            parser.read_file(conf)
+        except configparser.Error as e:
+            display_config_file_errors(str(e), config_file)
+            sys.exit(1)
+    bots_config = {
+        section: {key: parser.get(section, key) for key in ["email", "key", "site"]}
+        for section in parser.sections()
+    }
+
+    run_message_handlers_for_bots(bots_config, args.bot_config_file, args.max_workers, args.quiet)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@ import sys
 from typing import Optional
 
 from zulip_bots import finder
+from zulip_bots.codec import make_marshaller
 from zulip_bots.lib import (
     NoBotConfigError,
     run_message_handler_for_bot,
@@ -57,7 +58,57 @@ def parse_args() -> argparse.Namespace:
 
     parser.add_argument("--provision", action="store_true", help="install dependencies for the bot")
 
+    parser.add_argument(
+        "--storage",
+        action="store",
+        default="zulip",
+        help="where to keep the bot's storage: in the Zulip server (the default), "
+        "an SQLite database (sqlite:PATH), an LMDB environment (lmdb:PATH), or memory, "
+        "optionally snapshotted to a file (memory or memory:PATH)",
+    )
+
+    parser.add_argument(
+        "--storage-codec",
+        action="store",
+        help="format to store the bot's values in: json, msgpack or cbor, optionally "
+        "followed by +zstd to compress large values (e.g. msgpack+zstd); values stored "
+        "in other formats are converted when the bot starts",
+    )
+
+    parser.add_argument(
+        "--write-behind",
+        action="store_true",
+        help="fetch the bot's storage when starting, and save what the bot puts in it "
+        "in one request per message, rather than one per put",
+    )
+
+    parser.add_argument(
+        "--flush-interval",
+        action="store",
+        type=float,
+        help="with --write-behind, save the bot's storage every this many seconds "
+        "(and on exit) instead of after each message",
+    )
+
+    parser.add_argument(
+        "--storage-journal",
+        action="store",
+        help="with --write-behind, also append what the bot puts in its storage to this file, "
+        "to save it on restart if the bot crashed before saving it",
+    )
+
     args = parser.parse_args()
+    if not args.write_behind and (
+        args.flush_interval is not None or args.storage_journal is not None
+    ):
+        parser.error("--flush-interval and --storage-journal require --write-behind")
+    if args.storage_codec is not None:
+        try:
+            make_marshaller(args.storage_codec)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.write_behind and args.storage != "zulip":
+        parser.error("--write-behind only applies to --storage=zulip")
     return args
 
 
@@ -180,6 +231,11 @@ def main() -> None:
             quiet=args.quiet,
             bot_name=bot_name,
             bot_source=bot_source,
+            write_behind=args.write_behind,
+            flush_interval=args.flush_interval,
+            storage_journal=args.storage_journal,
+            storage_backend=args.storage,
+            storage_codec=args.storage_codec,
         )
     except NoBotConfigError:
         print(
@@ -19,6 +19,9 @@ class SimpleStorage:
     def get(self, key: str) -> Any:
         return self.data[key]
 
+    def remove(self, key: str) -> None:
+        self.data.pop(key, None)
+
 
 class MockMessageServer:
     # This class is needed for the incrementor bot, which
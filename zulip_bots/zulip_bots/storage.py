@@ -0,0 +1,316 @@
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from typing_extensions import override
+
+from zulip_bots.codec import ValueMarshaller
+
+logger = logging.getLogger(__name__)
+
+
+class StorageBackend:
+    """
+    Keeps the storage of any number of bots, by `namespace`, locally
+    instead of in the Zulip server.  Values are marshalled strings;
+    get() raises KeyError for keys that were never put, or were removed.
+    """
+
+    def put(self, namespace: str, key: str, value: str) -> None:
+        raise NotImplementedError
+
+    def remove(self, namespace: str, key: str) -> None:
+        raise NotImplementedError
+
+    def get(self, namespace: str, key: str) -> str:
+        raise NotImplementedError
+
+    def contains(self, namespace: str, key: str) -> bool:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def storage(
+        self, namespace: str, marshaller: Optional[ValueMarshaller] = None
+    ) -> "LocalStorage":
+        return LocalStorage(self, namespace, marshaller)
+
+
+class LocalStorage:
+    """
+    The BotStorage of one bot, kept in a StorageBackend.
+    """
+
+    def __init__(
+        self,
+        backend: StorageBackend,
+        namespace: str,
+        marshaller: Optional[ValueMarshaller] = None,
+    ) -> None:
+        self.backend = backend
+        self.namespace = namespace
+        self.marshaller = marshaller if marshaller is not None else ValueMarshaller()
+        self.marshal = self.marshaller.marshal
+        self.demarshal = self.marshaller.demarshal
+
+    def put(self, key: str, value: Any) -> None:
+        self.backend.put(self.namespace, key, self.marshal(value))
+
+    def get(self, key: str) -> Any:
+        return self.demarshal(self.backend.get(self.namespace, key))
+
+    def remove(self, key: str) -> None:
+        self.backend.remove(self.namespace, key)
+
+    def contains(self, key: str) -> bool:
+        return self.backend.contains(self.namespace, key)
+
+    def message_handled(self) -> None:
+        # Every put is already saved.
+        pass
+
+    def close(self) -> None:
+        # The backend may be shared with other bots; its owner closes it.
+        pass
+
+
+class SQLiteStorageBackend(StorageBackend):
+    """
+    Keeps bot storage in an SQLite database, in WAL mode, so that
+    readers don't wait for writers, and commits only wait for the
+    write-ahead log to be written, not synced.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.lock = threading.Lock()
+        # Bots may be run from several threads.
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS zulip_bot_storage ("
+                "namespace TEXT, key TEXT, value TEXT, PRIMARY KEY (namespace, key))"
+            )
+
+    @override
+    def put(self, namespace: str, key: str, value: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO zulip_bot_storage (namespace, key, value) VALUES (?, ?, ?)",
+                (namespace, key, value),
+            )
+
+    @override
+    def remove(self, namespace: str, key: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM zulip_bot_storage WHERE namespace = ? AND key = ?", (namespace, key)
+            )
+
+    @override
+    def get(self, namespace: str, key: str) -> str:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM zulip_bot_storage WHERE namespace = ? AND key = ?",
+                (namespace, key),
+            ).fetchone()
+        if row is None:
+            raise KeyError("key not found: " + key)
+        return row[0]
+
+    @override
+    def contains(self, namespace: str, key: str) -> bool:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM zulip_bot_storage WHERE namespace = ? AND key = ?",
+                (namespace, key),
+            ).fetchone()
+        return row is not None
+
+    @override
+    def close(self) -> None:
+        self.connection.close()
+
+
+class LMDBStorageBackend(StorageBackend):
+    """
+    Keeps bot storage in a memory-mapped LMDB environment (a
+    directory), with one named database per namespace.  Reads don't
+    take any lock, and don't copy more than the value read.  Needs the
+    `lmdb` package.
+    """
+
+    def __init__(self, path: str, map_size: int = 2**30, max_namespaces: int = 128) -> None:
+        try:
+            import lmdb
+        except ImportError:  # nocoverage
+            raise ImportError(
+                "The LMDB bot storage backend requires lmdb; install it with `pip install lmdb`."
+            ) from None
+
+        self.env = lmdb.open(path, map_size=map_size, max_dbs=max_namespaces)
+        self.databases: Dict[str, Any] = {}
+        self.lock = threading.Lock()
+
+    def database(self, namespace: str) -> Any:
+        database = self.databases.get(namespace)
+        if database is None:
+            with self.lock:
+                database = self.env.open_db(namespace.encode())
+                self.databases[namespace] = database
+        return database
+
+    @override
+    def put(self, namespace: str, key: str, value: str) -> None:
+        with self.env.begin(db=self.database(namespace), write=True) as txn:
+            txn.put(key.encode(), value.encode())
+
+    @override
+    def remove(self, namespace: str, key: str) -> None:
+        with self.env.begin(db=self.database(namespace), write=True) as txn:
+            txn.delete(key.encode())
+
+    @override
+    def get(self, namespace: str, key: str) -> str:
+        with self.env.begin(db=self.database(namespace), buffers=True) as txn:
+            value = txn.get(key.encode())
+            if value is None:
+                raise KeyError("key not found: " + key)
+            return bytes(value).decode()
+
+    @override
+    def contains(self, namespace: str, key: str) -> bool:
+        with self.env.begin(db=self.database(namespace), buffers=True) as txn:
+            return txn.get(key.encode()) is not None
+
+    @override
+    def close(self) -> None:
+        self.env.close()
+
+
+class MemoryStorageBackend(StorageBackend):
+    """
+    Keeps bot storage in memory, split into `shards` dicts with a lock
+    each, so that bots run from different threads rarely wait for one
+    another.  With `snapshot_path` set, the storage is loaded from that
+    file, and written to it every `snapshot_interval` seconds and when
+    the backend is closed; what was put since the last snapshot is lost
+    if the process crashes.
+    """
+
+    def __init__(
+        self,
+        shards: int = 16,
+        snapshot_path: Optional[str] = None,
+        snapshot_interval: float = 60,
+    ) -> None:
+        self.shards: List[Tuple[threading.Lock, Dict[Tuple[str, str], str]]] = [
+            (threading.Lock(), {}) for _ in range(shards)
+        ]
+        self.snapshot_path = snapshot_path
+        self.closed = threading.Event()
+        if snapshot_path is None:
+            return
+        try:
+            with open(snapshot_path) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            snapshot = {}
+        for namespace, storage in snapshot.items():
+            for key, value in storage.items():
+                self.put(namespace, key, value)
+        threading.Thread(
+            target=self.snapshot_periodically, args=(snapshot_interval,), daemon=True
+        ).start()
+
+    def shard(self, namespace: str, key: str) -> Tuple[threading.Lock, Dict[Tuple[str, str], str]]:
+        return self.shards[hash((namespace, key)) % len(self.shards)]
+
+    @override
+    def put(self, namespace: str, key: str, value: str) -> None:
+        lock, shard = self.shard(namespace, key)
+        with lock:
+            shard[namespace, key] = value
+
+    @override
+    def remove(self, namespace: str, key: str) -> None:
+        lock, shard = self.shard(namespace, key)
+        with lock:
+            shard.pop((namespace, key), None)
+
+    @override
+    def get(self, namespace: str, key: str) -> str:
+        lock, shard = self.shard(namespace, key)
+        with lock:
+            try:
+                return shard[namespace, key]
+            except KeyError:
+                raise KeyError("key not found: " + key) from None
+
+    @override
+    def contains(self, namespace: str, key: str) -> bool:
+        lock, shard = self.shard(namespace, key)
+        with lock:
+            return (namespace, key) in shard
+
+    def snapshot(self) -> None:
+        """
+        Replaces the snapshot file atomically with the current storage.
+        Each shard is copied under its own lock, so that puts to other
+        shards go on meanwhile.
+        """
+        assert self.snapshot_path is not None
+        snapshot: Dict[str, Dict[str, str]] = {}
+        for lock, shard in self.shards:
+            with lock:
+                items = list(shard.items())
+            for (namespace, key), value in items:
+                snapshot.setdefault(namespace, {})[key] = value
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, prefix=".zulip-bot-storage-", delete=False
+        ) as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f.name, self.snapshot_path)
+
+    def snapshot_periodically(self, interval: float) -> None:
+        while not self.closed.wait(interval):
+            try:
+                self.snapshot()
+            except Exception:
+                logger.exception("Error writing bot storage snapshot; will retry")
+
+    @override
+    def close(self) -> None:
+        self.closed.set()
+        if self.snapshot_path is not None:
+            self.snapshot()
+
+
+STORAGE_BACKENDS = ["zulip", "sqlite:PATH", "lmdb:PATH", "memory", "memory:SNAPSHOT_PATH"]
+
+
+def open_storage_backend(spec: str) -> Optional[StorageBackend]:
+    """
+    Opens the StorageBackend described by `spec`, one of
+    STORAGE_BACKENDS, or returns None for "zulip", the Zulip server's
+    bot storage.
+    """
+    kind, _, path = spec.partition(":")
+    if kind == "zulip" and not path:
+        return None
+    if kind == "sqlite" and path:
+        return SQLiteStorageBackend(path)
+    if kind == "lmdb" and path:
+        return LMDBStorageBackend(path)
+    if kind == "memory":
+        return MemoryStorageBackend(snapshot_path=path or None)
+    raise ValueError(f"Unknown bot storage {spec!r}; use one of: {', '.join(STORAGE_BACKENDS)}")
@@ -0,0 +1,62 @@
+import importlib.util
+from typing import Any, Dict
+from unittest import TestCase, skipUnless
+
+from zulip_bots.codec import JSONCodec, ValueMarshaller, make_marshaller
+
+USERS: Dict[str, Any] = {
+    f"user{i}@example.com": {
+        "email": f"user{i}@example.com",
+        "full_name": f"User {i}",
+        "stats": {"total_games": i, "games_won": i // 2, "games_lost": i // 3, "games_drawn": 0},
+    }
+    for i in range(100)
+}
+
+
+def installed(*modules: str) -> bool:
+    return all(importlib.util.find_spec(module) is not None for module in modules)
+
+
+class CodecTest(TestCase):
+    def test_json(self) -> None:
+        marshaller = ValueMarshaller()
+        # The format StateHandler always wrote.
+        self.assertEqual(marshaller.marshal([1, 2, 3]), "[1, 2, 3]")
+        self.assertEqual(marshaller.demarshal('{"a": [1]}'), {"a": [1]})
+        self.assertTrue(marshaller.is_current("[1, 2, 3]"))
+
+    @skipUnless(installed("msgpack", "cbor2"), "needs msgpack and cbor2")
+    def test_binary_codecs(self) -> None:
+        json_marshaller = ValueMarshaller()
+        for spec in ["msgpack", "cbor"]:
+            marshaller = make_marshaller(spec)
+            marshalled_value = marshaller.marshal(USERS)
+            self.assertTrue(marshalled_value.startswith(f"~{spec[0]}:"))
+            self.assertLess(len(marshalled_value), len(json_marshaller.marshal(USERS)))
+            self.assertEqual(marshaller.demarshal(marshalled_value), USERS)
+            # Any marshaller reads any format.
+            self.assertEqual(json_marshaller.demarshal(marshalled_value), USERS)
+            self.assertEqual(marshaller.demarshal(json_marshaller.marshal(USERS)), USERS)
+            self.assertFalse(marshaller.is_current(json_marshaller.marshal(USERS)))
+            self.assertTrue(marshaller.is_current(marshalled_value))
+
+    @skipUnless(installed("msgpack", "zstandard"), "needs msgpack and zstandard")
+    def test_compression(self) -> None:
+        marshaller = make_marshaller("msgpack+zstd", compress_min_size=100)
+        self.assertTrue(marshaller.marshal({"small": 1}).startswith("~m:"))
+        marshalled_value = marshaller.marshal(USERS)
+        self.assertTrue(marshalled_value.startswith("~mz:"))
+        self.assertLess(len(marshalled_value), len(make_marshaller("msgpack").marshal(USERS)) / 3)
+        self.assertEqual(ValueMarshaller().demarshal(marshalled_value), USERS)
+
+        json_marshaller = ValueMarshaller(JSONCodec(), compress_min_size=100)
+        self.assertEqual(json_marshaller.marshal([1]), "[1]")
+        self.assertTrue(json_marshaller.marshal(USERS).startswith("~jz:"))
+
+    def test_errors(self) -> None:
+        for spec in ["pickle", "json+gzip"]:
+            with self.assertRaisesRegex(ValueError, "Unknown bot storage codec"):
+                make_marshaller(spec)
+        with self.assertRaisesRegex(ValueError, "Unknown codec tag"):
+            ValueMarshaller().demarshal("~p:abc")
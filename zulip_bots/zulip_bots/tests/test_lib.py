@@ -1,13 +1,19 @@
 import io
+import json
+import os
+import tempfile
+import time
 from typing import IO, Any, Callable, Dict, List, Optional, Set, Tuple, cast
 from unittest import TestCase
 from unittest.mock import ANY, MagicMock, create_autospec, patch
 
 from zulip import Client
+from zulip_bots.codec import ValueMarshaller
 from zulip_bots.lib import (
     BotHandler,
     ExternalBotHandler,
     StateHandler,
+    StateHandlerError,
     extract_query_without_mention,
     is_private_message_but_not_group_pm,
     run_message_handler_for_bot,
@@ -112,6 +118,162 @@ class LibTest(TestCase):
         client.get_storage.assert_not_called()
         self.assertEqual(val, [5])
 
+    def test_state_handler_contains(self) -> None:
+        client = MagicMock()
+        client.get_storage.return_value = dict(result="success", storage=dict(key="[5]"))
+        state_handler = StateHandler(client)
+        # Put by an earlier run of the bot.
+        self.assertTrue(state_handler.contains("key"))
+        client.get_storage.assert_called_once_with({"keys": ["key"]})
+        self.assertEqual(state_handler.get("key"), [5])
+
+        client.get_storage.return_value = dict(result="error", msg="Key does not exist.")
+        self.assertFalse(state_handler.contains("missing_key"))
+
+    def test_state_handler_get_fresh(self) -> None:
+        client = MagicMock()
+        client.get_storage.return_value = dict(result="success", storage=dict(key="[5]"))
+        state_handler = StateHandler(client)
+        self.assertEqual(state_handler.get("key"), [5])
+        # Changed, and then removed, by another process running the bot.
+        client.get_storage.return_value = dict(result="success", storage=dict(key="[6]"))
+        self.assertEqual(state_handler.get("key"), [5])
+        self.assertEqual(state_handler.get_fresh("key"), [6])
+        self.assertEqual(state_handler.get("key"), [6])
+        client.get_storage.return_value = dict(result="error", msg="Key does not exist.")
+        with self.assertRaises(KeyError):
+            state_handler.get_fresh("key")
+        self.assertFalse(state_handler.contains("key"))
+
+    def test_state_handler_write_behind(self) -> None:
+        client = MagicMock()
+        client.get_storage.return_value = dict(result="success", storage=dict(a="1", b="2"))
+        client.update_storage.return_value = dict(result="success")
+        state_handler = StateHandler(client, write_behind=True)
+        client.get_storage.assert_called_once_with()
+        self.assertTrue(state_handler.contains("b"))
+        self.assertFalse(state_handler.contains("c"))
+        self.assertRaises(KeyError, state_handler.get, "c")
+
+        state_handler.put("a", 3)
+        state_handler.put("c", [4])
+        state_handler.put("a", 5)
+        self.assertEqual(state_handler.get("a"), 5)
+        client.update_storage.assert_not_called()
+        state_handler.message_handled()
+        client.update_storage.assert_called_once_with(dict(storage=dict(a="5", c="[4]")))
+
+        # Nothing left to save.
+        state_handler.close()
+        self.assertEqual(client.update_storage.call_count, 1)
+        self.assertEqual(client.get_storage.call_count, 1)
+
+    def test_state_handler_remove(self) -> None:
+        client = MagicMock()
+        client.remove_storage.return_value = dict(result="success")
+        state_handler = StateHandler(client)
+        state_handler.remove("key")
+        client.remove_storage.assert_called_once_with({"keys": ["key"]})
+
+        client = MagicMock()
+        client.get_storage.return_value = dict(result="success", storage=dict(a="1", b="2"))
+        client.update_storage.return_value = dict(result="success")
+        client.remove_storage.return_value = dict(result="success")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            journal_path = os.path.join(tmpdir, "journal")
+            state_handler = StateHandler(client, write_behind=True, journal_path=journal_path)
+            state_handler.remove("a")
+            state_handler.put("b", 3)
+            state_handler.remove("b")
+            # Never sent to the server, so there is nothing to remove there.
+            state_handler.put("c", 4)
+            state_handler.remove("c")
+            self.assertFalse(state_handler.contains("a"))
+
+            # Replayed after a crash.
+            state_handler = StateHandler(client, write_behind=True, journal_path=journal_path)
+            self.assertFalse(state_handler.contains("b"))
+            state_handler.message_handled()
+            client.update_storage.assert_not_called()
+            client.remove_storage.assert_called_once_with({"keys": ["a", "b"]})
+            state_handler.close()
+
+    def test_state_handler_flush_interval(self) -> None:
+        client = MagicMock()
+        client.get_storage.return_value = dict(result="success", storage={})
+        client.update_storage.return_value = dict(result="success")
+        state_handler = StateHandler(client, write_behind=True, flush_interval=60)
+        state_handler.put("key", 1)
+        state_handler.message_handled()
+        client.update_storage.assert_not_called()
+        state_handler.close()
+        client.update_storage.assert_called_once_with(dict(storage=dict(key="1")))
+
+        client.update_storage.return_value = dict(result="error", msg="Too big")
+        state_handler = StateHandler(client, write_behind=True, flush_interval=0.01)
+        state_handler.put("key", 2)
+        with self.assertLogs(level="ERROR"):
+            time.sleep(0.05)
+        client.update_storage.return_value = dict(result="success")
+        state_handler.close()
+        client.update_storage.assert_called_with(dict(storage=dict(key="2")))
+
+    def test_state_handler_journal(self) -> None:
+        client = MagicMock()
+        client.get_storage.return_value = dict(result="success", storage=dict(a="1"))
+        client.update_storage.return_value = dict(result="error", msg="Server down")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            journal_path = os.path.join(tmpdir, "journal")
+            state_handler = StateHandler(client, write_behind=True, journal_path=journal_path)
+            state_handler.put("a", 2)
+            state_handler.put("b", 3)
+            with self.assertRaises(StateHandlerError):
+                state_handler.message_handled()
+            # The bot crashes in the middle of a put.
+            with open(journal_path, "a") as journal:
+                journal.write('{"key": "a", "val')
+
+            client.update_storage.reset_mock(return_value=True)
+            client.update_storage.return_value = dict(result="success")
+            state_handler = StateHandler(client, write_behind=True, journal_path=journal_path)
+            self.assertEqual(state_handler.get("a"), 2)
+            state_handler.put("c", 4)
+            client.update_storage.assert_not_called()
+            state_handler.message_handled()
+            client.update_storage.assert_called_once_with(dict(storage=dict(a="2", b="3", c="4")))
+            self.assertEqual(os.path.getsize(journal_path), 0)
+
+            # Puts after a flush are journaled from the start of the file.
+            state_handler.put("d", 5)
+            client.get_storage.return_value = dict(
+                result="success", storage=dict(a="2", b="3", c="4")
+            )
+            state_handler = StateHandler(client, write_behind=True, journal_path=journal_path)
+            self.assertEqual(state_handler.get("d"), 5)
+            state_handler.close()
+
+    def test_state_handler_migrate(self) -> None:
+        marshaller = ValueMarshaller(compress_min_size=1000)
+        client = MagicMock()
+        long_value = list(range(1000))
+        client.get_storage.return_value = dict(
+            result="success", storage=dict(short="[1]", long=json.dumps(long_value))
+        )
+        client.update_storage.return_value = dict(result="success")
+        state_handler = StateHandler(client, marshaller=marshaller)
+        self.assertEqual(state_handler.migrate(), 1)
+        migrated = client.update_storage.call_args[0][0]["storage"]
+        self.assertEqual(list(migrated), ["long"])
+        self.assertTrue(migrated["long"].startswith("~jz:"))
+        self.assertEqual(state_handler.get("long"), long_value)
+
+        client.get_storage.return_value = dict(
+            result="success", storage=dict(short="[1]", long=migrated["long"])
+        )
+        state_handler = StateHandler(client, write_behind=True, marshaller=marshaller)
+        self.assertEqual(state_handler.migrate(), 0)
+        self.assertEqual(client.update_storage.call_count, 1)
+
     def test_react(self) -> None:
         client = cast(Client, FakeClient())
         handler = ExternalBotHandler(
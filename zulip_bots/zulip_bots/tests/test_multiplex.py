@@ -0,0 +1,112 @@
+import asyncio
+import io
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import requests
+
+from zulip import Client
+from zulip_bots.multiplex import MultiplexedBot, SharedSession, run_bots
+
+
+class FakeEventClient:
+    def __init__(self, events: List[Dict[str, Any]]) -> None:
+        self.events = events
+
+    async def __aenter__(self) -> "FakeEventClient":
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        pass
+
+    async def call_on_each_event(
+        self, callback: Callable[[Dict[str, Any]], Awaitable[None]], event_types: List[str]
+    ) -> None:
+        for event in self.events:
+            await callback(event)
+
+
+class TestRunBots(TestCase):
+    def make_bot(
+        self, name: str, num_messages: int, handled: List[Tuple[str, int, str]]
+    ) -> MultiplexedBot:
+        lock = threading.Lock()
+
+        def handle_message(message: Dict[str, Any], bot_handler: Any) -> None:
+            # The slow bot must not hold up the fast one.
+            if name == "slow":
+                time.sleep(0.05)
+            if message["id"] == 1:
+                raise RuntimeError("broken bot")
+            with lock:
+                handled.append((name, message["id"], threading.current_thread().name))
+
+        events = [
+            {"type": "message", "id": i, "flags": [], "message": {"id": i, "content": "hi"}}
+            for i in range(num_messages)
+        ]
+        bot = MagicMock(spec=MultiplexedBot)
+        bot.name = name
+        bot.bot_handler = MagicMock()
+        bot.message_handler = MagicMock()
+        bot.message_handler.handle_message.side_effect = handle_message
+        bot.make_event_client.return_value = FakeEventClient(
+            [{"type": "heartbeat", "id": -1}, *events]
+        )
+        return bot
+
+    def test_run_bots(self) -> None:
+        handled: List[Tuple[str, int, str]] = []
+        bots = [self.make_bot("slow", 5, handled), self.make_bot("fast", 5, handled)]
+
+        def handle_message_for_bot(
+            message: Dict[str, Any], flags: List[str], message_handler: Any, bot_handler: Any
+        ) -> None:
+            message_handler.handle_message(message, bot_handler)
+
+        with patch(
+            "zulip_bots.multiplex.handle_message_for_bot", handle_message_for_bot
+        ), self.assertLogs(level="ERROR") as logs:
+            asyncio.run(run_bots(bots, max_workers=2))
+
+        for name in ["slow", "fast"]:
+            self.assertEqual([i for bot, i, _ in handled if bot == name], [0, 2, 3, 4])
+        self.assertTrue(all(thread.startswith("zulip-bot") for _, _, thread in handled))
+        # The fast bot finishes while the slow one is still working.
+        self.assertEqual([bot for bot, _, _ in handled][:4], ["fast"] * 4)
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn("failed to handle message 1", logs.output[0])
+
+
+class TestSharedSession(TestCase):
+    def test_clients_share_session(self) -> None:
+        shared_session = SharedSession(pool_maxsize=4)
+        self.addCleanup(shared_session.close)
+        with patch.object(
+            Client, "get_server_settings", return_value={"zulip_version": "8.0"}
+        ) as get_server_settings:
+            clients = [
+                shared_session.make_client(
+                    {"email": f"{name}-bot@example.com", "key": name, "site": "zulip.example.com"},
+                    f"Zulip{name.capitalize()}Bot",
+                )
+                for name in ["helloworld", "help"]
+            ]
+        # The server is only asked for its settings once.
+        get_server_settings.assert_called_once_with()
+        self.assertEqual([client.zulip_version for client in clients], ["8.0", "8.0"])
+
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = io.BytesIO(b'{"result": "success"}')
+        with patch.object(shared_session.session, "request", return_value=response) as request:
+            for client in clients:
+                client.get_profile()
+        self.assertEqual(
+            [call.kwargs["auth"].username for call in request.call_args_list],
+            ["helloworld-bot@example.com", "help-bot@example.com"],
+        )
+        self.assertIn("ZulipHelpBot", request.call_args.kwargs["headers"]["User-agent"])
@@ -34,6 +34,11 @@ class TestDefaultArguments(TestCase):
             lib_module=mock.ANY,
             bot_source="source",
             quiet=False,
+            write_behind=False,
+            flush_interval=None,
+            storage_journal=None,
+            storage_backend="zulip",
+            storage_codec=None,
         )
 
     @patch("sys.argv", ["zulip-run-bot", path_to_bot, "--config-file", "/foo/bar/baz.conf"])
@@ -51,6 +56,11 @@ class TestDefaultArguments(TestCase):
             lib_module=mock.ANY,
             bot_source="source",
             quiet=False,
+            write_behind=False,
+            flush_interval=None,
+            storage_journal=None,
+            storage_backend="zulip",
+            storage_codec=None,
         )
 
     @patch(
@@ -76,6 +86,11 @@ class TestDefaultArguments(TestCase):
             lib_module=mock.ANY,
             bot_source="packaged_bot: 1.0.0",
             quiet=False,
+            write_behind=False,
+            flush_interval=None,
+            storage_journal=None,
+            storage_backend="zulip",
+            storage_codec=None,
         )
 
     def test_adding_bot_parent_dir_to_sys_path_when_bot_name_specified(self) -> None:
@@ -0,0 +1,97 @@
+import importlib.util
+import os
+import tempfile
+import threading
+from unittest import TestCase, skipUnless
+
+from typing_extensions import override
+
+from zulip_bots.storage import (
+    LMDBStorageBackend,
+    MemoryStorageBackend,
+    SQLiteStorageBackend,
+    StorageBackend,
+    open_storage_backend,
+)
+
+
+class StorageBackendTest(TestCase):
+    @override
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def check_backend(self, backend: StorageBackend) -> None:
+        storage = backend.storage("tictactoe")
+        other_storage = backend.storage("merels")
+        self.assertFalse(storage.contains("users"))
+        self.assertRaises(KeyError, storage.get, "users")
+
+        storage.put("users", {"alice": {"wins": 1}})
+        storage.put("users", {"alice": {"wins": 2}})
+        self.assertTrue(storage.contains("users"))
+        self.assertEqual(storage.get("users"), {"alice": {"wins": 2}})
+        self.assertFalse(other_storage.contains("users"))
+        storage.put("game:abc", [1])
+        storage.remove("game:abc")
+        storage.remove("game:abc")
+        self.assertFalse(storage.contains("game:abc"))
+
+        def put_many(i: int) -> None:
+            for j in range(50):
+                other_storage.put(f"{i}-{j}", j)
+
+        threads = [threading.Thread(target=put_many, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(other_storage.get("3-49"), 49)
+
+    def test_sqlite(self) -> None:
+        path = os.path.join(self.directory, "storage.db")
+        backend = SQLiteStorageBackend(path)
+        self.check_backend(backend)
+        backend.close()
+
+        backend = SQLiteStorageBackend(path)
+        self.assertEqual(backend.storage("tictactoe").get("users"), {"alice": {"wins": 2}})
+        self.assertEqual(backend.connection.execute("PRAGMA journal_mode").fetchone(), ("wal",))
+        backend.close()
+
+    @skipUnless(importlib.util.find_spec("lmdb") is not None, "needs lmdb")
+    def test_lmdb(self) -> None:
+        path = os.path.join(self.directory, "storage")
+        backend = LMDBStorageBackend(path)
+        self.check_backend(backend)
+        backend.close()
+
+        backend = LMDBStorageBackend(path)
+        self.assertEqual(backend.storage("tictactoe").get("users"), {"alice": {"wins": 2}})
+        backend.close()
+
+    def test_memory(self) -> None:
+        self.check_backend(MemoryStorageBackend())
+
+        path = os.path.join(self.directory, "snapshot.json")
+        backend = MemoryStorageBackend(shards=4, snapshot_path=path)
+        self.check_backend(backend)
+        backend.close()
+        self.assertEqual(os.listdir(self.directory), ["snapshot.json"])
+
+        backend = MemoryStorageBackend(snapshot_path=path)
+        self.assertEqual(backend.storage("tictactoe").get("users"), {"alice": {"wins": 2}})
+        self.assertEqual(backend.storage("merels").get("0-0"), 0)
+        backend.close()
+
+    def test_open_storage_backend(self) -> None:
+        self.assertIsNone(open_storage_backend("zulip"))
+        self.assertIsInstance(open_storage_backend("memory"), MemoryStorageBackend)
+        backend = open_storage_backend("sqlite:" + os.path.join(self.directory, "storage.db"))
+        assert backend is not None
+        self.assertIsInstance(backend, SQLiteStorageBackend)
+        backend.close()
+        for spec in ["redis", "sqlite", "zulip:path"]:
+            with self.assertRaisesRegex(ValueError, "Unknown bot storage"):
+                open_storage_backend(spec)
@@ -11,6 +11,7 @@ import importlib_metadata as metadata
 from typing_extensions import override
 
 from zulip_bots.lib import BotHandler
+from zulip_bots.storage import MemoryStorageBackend
 from zulip_botserver import server
 from zulip_botserver.input_parameters import parse_args
 
@@ -162,6 +163,29 @@ class BotServerTests(BotServerTestCase):
         assert opts.bot_config_file is None
         assert opts.hostname == "127.0.0.1"
         assert opts.port == 5002
+        assert opts.storage == "zulip"
+
+    @mock.patch("zulip_bots.lib.ExternalBotHandler")
+    def test_load_bot_handlers_with_storage_backend(
+        self, mock_external_bot_handler: mock.Mock
+    ) -> None:
+        bots_config = {
+            bot: {
+                "email": f"{bot}-bot@zulip.com",
+                "key": "value",
+                "site": "http://localhost",
+                "token": "abcd1234",
+            }
+            for bot in ["helloworld", "help"]
+        }
+        bots_lib_modules = server.load_lib_modules(["helloworld", "help"])
+        backend = MemoryStorageBackend()
+        server.load_bot_handlers(
+            ["helloworld", "help"], bots_lib_modules, bots_config, storage_backend=backend
+        )
+        storages = [call.kwargs["storage"] for call in mock_external_bot_handler.call_args_list]
+        self.assertEqual([storage.namespace for storage in storages], ["helloworld", "help"])
+        self.assertTrue(all(storage.backend is backend for storage in storages))
 
     def test_read_config_from_env_vars(self) -> None:
         # We use an OrderedDict so that the order of the entries in
@@ -310,3 +334,16 @@ class BotServerTests(BotServerTestCase):
         mock_app.config.__setitem__.assert_any_call(
             "BOTS_LIB_MODULES", {"packaged_bot": packaged_bot_module}
         )
+        # With the Zulip server's storage, the reloader can run.
+        self.assertTrue(mock_app.run.call_args.kwargs["use_reloader"])
+
+    @mock.patch("zulip_botserver.server.app")
+    @mock.patch(
+        "sys.argv",
+        ["zulip-botserver", "--config-file", "/foo/bar/baz.conf", "--storage", "memory"],
+    )
+    def test_no_reloader_with_local_storage(self, mock_app: mock.Mock) -> None:
+        with mock.patch("zulip_botserver.server.read_config_file", return_value={}):
+            server.main()
+        # The storage is only opened by the process serving requests.
+        self.assertFalse(mock_app.run.call_args.kwargs["use_reloader"])
@@ -49,4 +49,12 @@ def parse_args() -> argparse.Namespace:
         type=int,
         help="Port on which you want to run the Botserver. (default: %(default)d)",
     )
+    parser.add_argument(
+        "--storage",
+        action="store",
+        default="zulip",
+        help="Where to keep the storage of the bots: in the Zulip server (the default), "
+        "an SQLite database (sqlite:PATH), an LMDB environment (lmdb:PATH), or memory, "
+        "optionally snapshotted to a file (memory or memory:PATH).",
+    )
     return parser.parse_args()
@@ -17,6 +17,7 @@ from werkzeug.exceptions import BadRequest, Unauthorized
 from zulip import Client
 from zulip_bots import lib
 from zulip_bots.finder import import_module_from_source, import_module_from_zulip_bot_registry
+from zulip_bots.storage import StorageBackend, open_storage_backend
 from zulip_botserver.input_parameters import parse_args
 
 
@@ -139,6 +140,7 @@ def load_bot_handlers(
     bot_lib_modules: Dict[str, ModuleType],
     bots_config: Dict[str, Dict[str, str]],
     third_party_bot_conf: Optional[configparser.ConfigParser] = None,
+    storage_backend: Optional[StorageBackend] = None,
 ) -> Dict[str, lib.ExternalBotHandler]:
     bot_handlers = {}
     for bot in available_bots:
@@ -151,7 +153,11 @@ def load_bot_handlers(
         assert bot_file is not None
         bot_dir = os.path.dirname(os.path.abspath(bot_file))
         bot_handler = lib.ExternalBotHandler(
-            client, bot_dir, bot_details={}, bot_config_parser=third_party_bot_conf
+            client,
+            bot_dir,
+            bot_details={},
+            bot_config_parser=third_party_bot_conf,
+            storage=storage_backend.storage(bot) if storage_backend is not None else None,
         )
 
         bot_handlers[bot] = bot_handler
@@ -247,14 +253,29 @@ def main() -> None:
     third_party_bot_conf = (
         parse_config_file(options.bot_config_file) if options.bot_config_file is not None else None
     )
+    try:
+        storage_backend = open_storage_backend(options.storage)
+    except ValueError as e:
+        sys.exit(f"Error: {e}")
     bot_handlers = load_bot_handlers(
-        available_bots, bots_lib_modules, bots_config, third_party_bot_conf
+        available_bots, bots_lib_modules, bots_config, third_party_bot_conf, storage_backend
     )
     message_handlers = init_message_handlers(available_bots, bots_lib_modules, bot_handlers)
     app.config["BOTS_LIB_MODULES"] = bots_lib_modules
     app.config["BOT_HANDLERS"] = bot_handlers
     app.config["MESSAGE_HANDLERS"] = message_handlers
-    app.run(host=options.hostname, port=int(options.port), debug=True)
+    try:
+        # Werkzeug's reloader would run this function in a second
+        # process too, and the two would write to the same local storage.
+        app.run(
+            host=options.hostname,
+            port=int(options.port),
+            debug=True,
+            use_reloader=storage_backend is None,
+        )
+    finally:
+        if storage_backend is not None:
+            storage_backend.close()
 
 
 if __name__ == "__main__":